@@ -0,0 +1,268 @@
+import argparse
+import base64
+import csv
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from hashlib import md5
+from netem import Link, UDPRelay, TCPRelay
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # the code directory, udp and tcp are below it
+SMALL_SIZE = 7400 # random bytes per object before base64, as in objects/generateobjects.sh
+LARGE_SIZE = 740000
+OBJECTS = 10 # of each size
+SERVER_START = 0.5 # seconds the server gets to bind before the client starts
+GRACE = 5 # seconds a side gets to wind down once the transfer is done: the UDP client acks the FIN, the UDP server reports
+FIELDS = ['transport', 'loss', 'delay', 'jitter', 'reorder', 'duplicate', 'bandwidth', 'pacing'] # a scenario
+UDP_DEFAULTS = ['aimd', 'none', 'none', '1'] # strategy, compression, FEC and workers of udp/server.py, filled in before its pacing argument
+METRICS = ['ok', 'total_time', 'goodput_mbps', 'p50', 'p99', 'retransmit_ratio', 'server_cpu', 'client_cpu', 'server_rss_mb', 'client_rss_mb']
+CHECKS = [('goodput_mbps', -1), ('p99', 1), ('server_cpu', 1), ('client_cpu', 1)] # compared with the baseline, -1 where lower is worse
+
+def generate_objects(directory, seed):
+    """
+    The objects of generateobjects.sh with their md5 sidecars, from a seeded generator so every run sends the same bytes
+    """
+    generator = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    total = 0
+    for i in range(OBJECTS):
+        for name, size in ((f"small-{i}.obj", SMALL_SIZE), (f"large-{i}.obj", LARGE_SIZE)):
+            data = base64.encodebytes(generator.randbytes(size)) # wrapped at 76 columns like the base64 tool
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+            with open(os.path.join(directory, name + '.md5'), 'w') as f:
+                f.write(md5(data).hexdigest() + '\n')
+            total += len(data)
+    return total
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start(args, cwd, port, log):
+    """
+    Run a script of the repo with unbuffered output to log, pointed at port on loopback
+    """
+    env = dict(os.environ, SERVER_HOST='127.0.0.1', SERVER_PORT=str(port), PYTHONUNBUFFERED='1')
+    return subprocess.Popen([sys.executable] + args, cwd=cwd, env=env, stdout=open(log, 'w'), stderr=subprocess.STDOUT)
+
+def wait(process, timeout, log = None, done = None):
+    """
+    Wait for a process, killing it after timeout seconds, returns (exit status, CPU seconds, peak RSS in MB) of that process
+    With done, the process is also stopped once log contains it, the UDP client keeps running after the transfer.
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if done is not None and done in open(log).read():
+            deadline = min(deadline, time.perf_counter() + GRACE) # let it send its last acks and exit on its own
+            done = None
+        if time.perf_counter() > deadline:
+            process.send_signal(signal.SIGKILL)
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.02)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+def tcp_counters():
+    """
+    (segments sent, segments retransmitted) of the whole host, None where /proc is not available
+    """
+    try:
+        with open('/proc/net/snmp') as f:
+            lines = [line.split() for line in f if line.startswith('Tcp:')]
+    except OSError:
+        return None
+    counters = dict(zip(lines[0][1:], lines[1][1:]))
+    return int(counters['OutSegs']), int(counters['RetransSegs'])
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)] if values else None
+
+def run_once(scenario, workspace, total_bytes, server_args, client_args, timeout, seed):
+    """
+    One transfer of all objects through the emulated link, returns the metrics
+    """
+    transport = scenario['transport']
+    uplink = Link(scenario['delay'], scenario['jitter'], scenario['loss'], scenario['duplicate'], scenario['reorder'], bandwidth=scenario['bandwidth'] * 125000, seed=seed)
+    downlink = Link(scenario['delay'], scenario['jitter'], scenario['loss'], scenario['duplicate'], scenario['reorder'], bandwidth=scenario['bandwidth'] * 125000, seed=seed + 1)
+    for side in ('server', 'client'):
+        shutil.rmtree(os.path.join(workspace, side), ignore_errors=True)
+        os.makedirs(os.path.join(workspace, side))
+    open(os.path.join(workspace, 'client', 'results.csv'), 'w').close() # the clients append their averages to it
+    if transport == 'udp':
+        port = free_port(socket.SOCK_DGRAM)
+        relay = UDPRelay(('127.0.0.1', 0), ('127.0.0.1', port), uplink, downlink)
+        server_script, client_script = os.path.join(CODE, 'udp', 'server.py'), os.path.join(CODE, 'udp', 'client.py')
+    else:
+        port = free_port(socket.SOCK_STREAM)
+        relay = TCPRelay(('127.0.0.1', 0), ('127.0.0.1', port), uplink, downlink)
+        server_script, client_script = os.path.join(CODE, 'tcp', 'tcpserver.py'), os.path.join(CODE, 'tcp', 'tcpclient.py')
+    relay.start()
+    server_log, client_log = os.path.join(workspace, 'server.log'), os.path.join(workspace, 'client.log')
+    server = start([server_script] + server_args, os.path.join(workspace, 'server'), port, server_log)
+    time.sleep(SERVER_START)
+    counters = tcp_counters()
+    client = start([client_script] + client_args, os.path.join(workspace, 'client'), relay.address[1], client_log)
+    _, client_cpu, client_rss = wait(client, timeout, client_log, "Average small time") # printed by both clients once all objects are in
+    after = tcp_counters()
+    if transport == 'udp':
+        deadline = time.perf_counter() + GRACE
+        while 'retransmitted' not in open(server_log).read() and time.perf_counter() < deadline:
+            time.sleep(0.05) # the server reports once the last acks arrived
+    server.send_signal(signal.SIGTERM)
+    _, server_cpu, server_rss = wait(server, 60)
+    output = open(client_log).read()
+    times = [float(t) for t in re.findall(r"Time taken: ([0-9.e+-]+)", output)]
+    ok = output.count("RESULT: True") if transport == 'udp' else output.count("Finished receiving")
+    retransmit_ratio = None
+    if transport == 'udp':
+        found = re.findall(r"retransmitted (\d+) of (\d+) segments", open(server_log).read()) # one line per connection
+        if found:
+            retransmit_ratio = sum(int(retransmitted) for retransmitted, _ in found) / max(sum(int(sent) for _, sent in found), 1)
+    elif counters is not None and after is not None:
+        retransmit_ratio = (after[1] - counters[1]) / max(after[0] - counters[0], 1) # host wide, keep the machine quiet
+    total_time = max(times) if len(times) == 2 * OBJECTS else None
+    return {
+        'ok': ok,
+        'total_time': total_time,
+        'goodput_mbps': total_bytes * 8 / total_time / 1e6 if total_time else 0,
+        'p50': percentile(times, 50),
+        'p99': percentile(times, 99),
+        'retransmit_ratio': retransmit_ratio,
+        'server_cpu': server_cpu,
+        'client_cpu': client_cpu,
+        'server_rss_mb': server_rss,
+        'client_rss_mb': client_rss,
+        'link': {'up': uplink.stats(), 'down': downlink.stats()},
+    }
+
+def key(scenario):
+    return " ".join(f"{field}={scenario[field]:g}" if field != 'transport' else f"{field}={scenario[field]}" for field in FIELDS
+                    if field != 'pacing' or scenario[field]) # 0 and 0.0 are the same scenario, no pacing keeps the keys of older baselines
+
+def udp_server_args(args, pacing):
+    """
+    Arguments of udp/server.py, with pacing turned on if asked
+    """
+    if not pacing:
+        return args
+    return args + UDP_DEFAULTS[len(args):] + ['pacing']
+
+def summarize(runs):
+    """
+    Median of every metric over the repetitions of a scenario, a failed repetition counts with its ok and 0 goodput
+    """
+    summary = {}
+    for metric in METRICS:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        summary[metric] = statistics.median(values) if values else None
+    summary['ok'] = min(run['ok'] for run in runs)
+    return summary
+
+def regressions(results, baseline, tolerance):
+    """
+    Lines describing every metric that got worse than the baseline by more than tolerance, and every failed transfer
+    """
+    found = []
+    for result in results:
+        if result['ok'] < 2 * OBJECTS:
+            found.append(f"{result['key']}: only {result['ok']} of {2 * OBJECTS} objects received intact")
+        base = baseline.get(result['key'])
+        if base is None:
+            continue
+        for metric, direction in CHECKS:
+            value, reference = result[metric], base.get(metric)
+            if value is None or not reference:
+                continue
+            change = (value - reference) / reference
+            if change * direction > tolerance:
+                found.append(f"{result['key']}: {metric} {value:.3f} against {reference:.3f} in the baseline ({change:+.0%})")
+    return found
+
+def numbers(text):
+    return [float(value) for value in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the UDP and TCP transports over loopback through an emulated link")
+    parser.add_argument('--transports', default='udp,tcp', help="comma separated, udp and/or tcp")
+    parser.add_argument('--loss', type=numbers, default=[0], help="packet loss probabilities per direction, comma separated")
+    parser.add_argument('--delay', type=numbers, default=[0], help="one way delays in seconds, the RTT is twice this")
+    parser.add_argument('--jitter', type=numbers, default=[0], help="seconds the delay varies by either way")
+    parser.add_argument('--reorder', type=numbers, default=[0], help="probabilities a packet is held back behind later ones")
+    parser.add_argument('--duplicate', type=numbers, default=[0], help="probabilities a packet is delivered twice")
+    parser.add_argument('--bandwidth', type=numbers, default=[0], help="link rates in Mbit/s, 0 for unlimited")
+    parser.add_argument('--pacing', type=numbers, default=[0], help="1 to pace the sends of the UDP server, 0,1 to compare both")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario, the median is reported")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the objects and of the link impairments")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds before a transfer counts as failed")
+    parser.add_argument('--udp-args', default='', help="arguments of udp/server.py, e.g. 'cubic zlib 8/2'")
+    parser.add_argument('--udp-client-args', default='', help="arguments of udp/client.py, e.g. '- 4' for 4 connections of a sharded server")
+    parser.add_argument('--tcp-args', default='', help="arguments of tcp/tcpserver.py, e.g. 'zlib'")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--csv', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with the results in this JSON file, exit 1 on a regression")
+    parser.add_argument('--save-baseline', action='store_true', help="write the results to the baseline file instead")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative change of a metric that counts as a regression")
+    args = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix='bench-')
+    total_bytes = generate_objects(os.path.join(workspace, 'objects'), args.seed) # the scripts read ../objects
+    server_args = {'udp': args.udp_args.split(), 'tcp': args.tcp_args.split()}
+    client_args = {'udp': args.udp_client_args.split(), 'tcp': []}
+    results = []
+    for values in itertools.product(args.transports.split(','), args.loss, args.delay, args.jitter, args.reorder, args.duplicate, args.bandwidth, args.pacing):
+        scenario = dict(zip(FIELDS, values))
+        if scenario['transport'] == 'tcp' and (scenario['loss'] or scenario['reorder'] or scenario['duplicate']):
+            print(f"Skipping {key(scenario)}: a TCP proxy can not lose, reorder or duplicate segments, use tc netem for that")
+            continue
+        if scenario['transport'] == 'tcp' and scenario['pacing']:
+            print(f"Skipping {key(scenario)}: pacing is an option of the UDP server, the kernel paces TCP")
+            continue
+        transport_args = udp_server_args(server_args['udp'], scenario['pacing']) if scenario['transport'] == 'udp' else server_args['tcp']
+        runs = [run_once(scenario, workspace, total_bytes, transport_args, client_args[scenario['transport']], args.timeout, args.seed + 2 * i) for i in range(args.repeat)]
+        result = dict(scenario, key=key(scenario), repeat=args.repeat, **summarize(runs))
+        result['link'] = runs[-1]['link']
+        results.append(result)
+        print("{key}: ok {ok}, total {total_time}, goodput {goodput_mbps:.1f} Mbit/s, p50 {p50}, p99 {p99}, retransmit ratio {retransmit_ratio}, CPU {server_cpu:.2f}+{client_cpu:.2f} s, RSS {server_rss_mb:.0f}+{client_rss_mb:.0f} MB".format(**result), flush=True)
+    shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS + ['repeat'] + METRICS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({result['key']: {metric: result[metric] for metric in METRICS} for result in results}, f, indent=1)
+        return 0
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    found = regressions(results, baseline, args.tolerance)
+    for line in found:
+        print("REGRESSION " + line)
+    return 1 if found else 0
+
+if __name__ == "__main__":
+    # python bench.py --loss 0,0.01,0.05 --delay 0,0.02 --json results.json --baseline baseline.json
+    sys.exit(main())
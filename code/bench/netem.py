@@ -0,0 +1,176 @@
+import heapq
+import random
+import socket
+import time
+from threading import Thread, Condition
+
+class Link:
+    """
+    Impairments of one direction of an emulated link, like a netem qdisc on an interface.
+    delay and jitter are in seconds, jitter spreads the delay uniformly by up to that much either way.
+    loss, duplicate and reorder are probabilities per packet, a reordered packet is held back for reorder_gap seconds more.
+    bandwidth is in bytes per second, 0 for unlimited, packets are serialized one after the other and dropped when
+    more than queue_limit seconds of them wait, like a tail drop router queue.
+    """
+    def __init__(self, delay = 0, jitter = 0, loss = 0, duplicate = 0, reorder = 0, reorder_gap = 0.005, bandwidth = 0, queue_limit = 0.5, seed = 1):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_gap = reorder_gap
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+        self.random = random.Random(seed) # seeded, the same packets are lost in every run
+        self.busy_until = 0 # when the serialization of the packets queued so far ends
+        self.packets = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def schedule(self, size, now):
+        """
+        Delivery times of a packet of size bytes that arrives now, empty if it is lost
+        """
+        self.packets += 1
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return []
+        if self.bandwidth:
+            start = max(now, self.busy_until)
+            if start - now > self.queue_limit:
+                self.dropped += 1 # queue full
+                return []
+            self.busy_until = start + size / self.bandwidth
+            now = self.busy_until
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+        times = []
+        for _ in range(copies):
+            at = now + max(self.delay + self.random.uniform(-self.jitter, self.jitter), 0)
+            if self.random.random() < self.reorder:
+                self.reordered += 1
+                at += self.reorder_gap
+            times.append(at)
+        return times
+
+    def stats(self):
+        return {'packets': self.packets, 'dropped': self.dropped, 'duplicated': self.duplicated, 'reordered': self.reordered}
+
+class DelayLine(Thread):
+    """
+    Sends packets at the times they are due, with a heap like the retransmission scheduler
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.heap = [] # (due time, sequence, send function, data)
+        self.sequence = 0 # keeps packets due at the same time in order
+        self.condition = Condition()
+
+    def put(self, at, send, data):
+        with self.condition:
+            heapq.heappush(self.heap, (at, self.sequence, send, data))
+            self.sequence += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.perf_counter():
+                    self.condition.wait(self.heap[0][0] - time.perf_counter() if self.heap else None)
+                _, _, send, data = heapq.heappop(self.heap)
+            try:
+                send(data)
+            except OSError:
+                pass # the other end is gone, like a packet sent to a closed port
+
+class UDPRelay(Thread):
+    """
+    Lossy link emulator for a UDP transport: clients send to the relay, which forwards to the server through the
+    uplink impairments and sends the answers back from the same address through the downlink ones.
+    Each client gets its own socket towards the server, so the server tells them apart by address as usual.
+    """
+    def __init__(self, listen, server, uplink, downlink):
+        super().__init__(daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20) # the relay must not be the lossy part
+        self.socket.bind(listen)
+        self.address = self.socket.getsockname()
+        self.server = server
+        self.uplink = uplink
+        self.downlink = downlink
+        self.line = DelayLine()
+        self.line.start()
+        self.clients = {} # client address -> socket towards the server
+
+    def run(self):
+        while True:
+            data, addr = self.socket.recvfrom(65536)
+            upstream = self.clients.get(addr)
+            if upstream is None:
+                upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                upstream.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+                upstream.connect(self.server)
+                self.clients[addr] = upstream
+                Thread(target=self.answers, args=(upstream, addr), daemon=True).start()
+            for at in self.uplink.schedule(len(data), time.perf_counter()):
+                self.line.put(at, upstream.send, data)
+
+    def answers(self, upstream, addr):
+        send = lambda data: self.socket.sendto(data, addr)
+        while True:
+            try:
+                data = upstream.recv(65536)
+            except OSError:
+                return
+            for at in self.downlink.schedule(len(data), time.perf_counter()):
+                self.line.put(at, send, data)
+
+class TCPRelay(Thread):
+    """
+    Link emulator for a TCP transport, a proxy that delays and throttles both byte streams.
+    A user space proxy terminates TCP, so loss, duplication and reordering can not be emulated: the kernel recovers
+    them on the loopback hop before the proxy sees the bytes. Only delay, jitter and bandwidth apply, jitter never
+    reorders bytes of a stream. The proxy forwards what it reads as one packet, reads are at most CHUNK bytes.
+    """
+    CHUNK = 16384
+
+    def __init__(self, listen, server, uplink, downlink):
+        super().__init__(daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(listen)
+        self.socket.listen()
+        self.address = self.socket.getsockname()
+        self.server = server
+        self.uplink = uplink
+        self.downlink = downlink
+
+    def run(self):
+        while True:
+            client, _ = self.socket.accept()
+            upstream = socket.create_connection(self.server)
+            for source, target, link in ((client, upstream, self.uplink), (upstream, client, self.downlink)):
+                Thread(target=self.pump, args=(source, target, link), daemon=True).start()
+
+    def pump(self, source, target, link):
+        line = DelayLine() # one per direction, in order
+        line.start()
+        last = 0
+        while True:
+            try:
+                data = source.recv(self.CHUNK)
+            except OSError:
+                data = b''
+            now = time.perf_counter()
+            if not data:
+                line.put(max(now + link.delay, last), lambda _: target.shutdown(socket.SHUT_WR), None) # forward the FIN
+                return
+            link.packets += 1
+            if link.bandwidth:
+                link.busy_until = max(now, link.busy_until) + len(data) / link.bandwidth
+                now = link.busy_until
+            last = max(now + max(link.delay + link.random.uniform(-link.jitter, link.jitter), 0), last)
+            line.put(last, target.sendall, data)
@@ -0,0 +1,101 @@
+import os
+import time
+import zlib
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import lzma
+except ImportError:
+    lzma = None # Python built without liblzma, only zlib is offered
+
+NONE = 0 # payload sent as is
+ZLIB = 1
+LZMA = 2
+CODECS = {'none': NONE, 'zlib': ZLIB, 'lzma': LZMA}
+ZLIB_LEVEL = 6 # base64 text only compresses through its 6 bit alphabet, higher levels gain nothing
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 0}] if lzma is not None else None # raw stream, no container per block
+PREFETCH = 4 # blocks compressed ahead of the one being sent
+
+pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1) # zlib and lzma release the GIL, so blocks compress in parallel
+
+def supported():
+    """
+    Bitmask of the codecs this side can decode, bit c for codec c, offered when connecting
+    """
+    return 1 << ZLIB | (1 << LZMA if lzma is not None else 0)
+
+def negotiate(offered, preferred):
+    """
+    The preferred codec of the sender if the receiver offered it, no compression otherwise
+    """
+    return preferred if preferred != NONE and offered & (1 << preferred) else NONE
+
+def compress(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == LZMA:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    return bytes(data)
+
+def decompress(codec, data):
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == LZMA:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    raise ValueError("Unknown codec {}".format(codec))
+
+class CompressionStats:
+    """
+    Bytes in and out and CPU time of the (de)compression of a connection, to tell whether it pays off on a link:
+    it does when the time saved sending (1 - ratio) of the bytes exceeds the CPU time spread over the workers.
+    """
+    def __init__(self, codec = NONE):
+        self.codec = codec
+        self.raw = 0 # bytes before compression
+        self.compressed = 0 # bytes after compression
+        self.cpu = 0 # seconds of CPU time spent in the codec
+        self.blocks = 0
+        self.lock = Lock() # updated from the workers
+
+    def add(self, raw, compressed, cpu):
+        with self.lock:
+            self.raw += raw
+            self.compressed += compressed
+            self.cpu += cpu
+            self.blocks += 1
+
+    def ratio(self):
+        return self.compressed / self.raw if self.raw else 1
+
+    def report(self):
+        name = next(name for name, codec in CODECS.items() if codec == self.codec)
+        rate = self.raw / self.cpu / 1e6 if self.cpu else 0
+        return "{}: {} blocks, {} -> {} bytes, ratio {:.3f}, {:.1f} ms CPU ({:.1f} MB/s per core)".format(name, self.blocks, self.raw, self.compressed, self.ratio(), self.cpu * 1000, rate)
+
+def timed(function, codec, data, stats):
+    """
+    Run compress or decompress and account its CPU time, the time of the thread that ran it
+    """
+    start = time.thread_time()
+    out = function(codec, data)
+    cpu = time.thread_time() - start
+    if function is compress:
+        stats.add(len(data), len(out), cpu)
+    else:
+        stats.add(len(out), len(data), cpu)
+    return out
+
+def compressed_blocks(codec, blocks, stats):
+    """
+    Lazily yield (key, block, compressed block) for an iterable of (key, block) pairs, compressing up to PREFETCH blocks
+    ahead in the pool so the caller only waits when the workers fall behind
+    """
+    pending = []
+    for key, block in blocks:
+        pending.append((key, block, pool.submit(timed, compress, codec, block, stats)))
+        if len(pending) > PREFETCH:
+            key, block, future = pending.pop(0)
+            yield key, block, future.result()
+    for key, block, future in pending:
+        yield key, block, future.result()
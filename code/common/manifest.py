@@ -0,0 +1,121 @@
+import os
+from hashlib import md5, blake2b
+from threading import Lock
+import logging
+
+DIGEST_SIZE = 8 # bytes of a digest on the wire, objects are named by the first bytes of their md5 and chunks by a short blake2b
+MANIFEST_DIR = '../objects/.manifests' # manifests of every version of an object served so far, named <md5>.<chunk size>
+log = logging.getLogger(__name__)
+
+def chunk_digests(data, chunk_size):
+    """
+    Digests of the fixed-size chunks of a buffer, the last chunk may be shorter
+    """
+    view = memoryview(data)
+    return [blake2b(view[i:i + chunk_size], digest_size=DIGEST_SIZE).digest() for i in range(0, len(view), chunk_size)]
+
+def file_digests(path, chunk_size):
+    """
+    (md5, chunk digests) of a file read one chunk at a time, for objects that are never held in memory as a whole
+    """
+    digest = md5()
+    chunks = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            chunks.append(blake2b(chunk, digest_size=DIGEST_SIZE).digest())
+    return digest.digest()[:DIGEST_SIZE], chunks
+
+class ManifestStore:
+    """
+    Content-addressed view of the served objects for dedup and delta transfer.
+    Every object is split into fixed-size chunks and its manifest is the list of their digests. A client advertises the
+    md5 of the objects it already holds (under any name, in any version), and the manifests of those versions tell which
+    chunks of the current objects it has: those are not sent again, the client copies them out of its own files.
+    Manifests are kept on disk by object md5, so after an object changes the client can still be sent a delta against
+    the version it holds. Manifests of the current files are computed once per file version and cached.
+    """
+    def __init__(self, chunk_size, directory = MANIFEST_DIR):
+        self.chunk_size = chunk_size
+        self.directory = directory
+        self.manifests = {} # object digest -> chunk digests
+        self.files = {} # path -> ((mtime, size), object digest) of the last version hashed
+        self.lock = Lock() # connections are served from several threads
+
+    def manifest(self, path, data = None):
+        """
+        (object digest, chunk digests) of the file at path whose content is data, read from the file if data is None
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1], self.manifests[cached[1]]
+        if data is None:
+            digest, chunks = file_digests(path, self.chunk_size)
+        else:
+            digest = md5(data).digest()[:DIGEST_SIZE]
+            chunks = chunk_digests(data, self.chunk_size)
+        with self.lock:
+            self.files[path] = (version, digest)
+            self.manifests[digest] = chunks
+        self.save(digest, chunks)
+        return digest, chunks
+
+    def path(self, digest):
+        return os.path.join(self.directory, "{}.{}".format(digest.hex(), self.chunk_size))
+
+    def save(self, digest, chunks):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(digest) + '.tmp', 'wb') as f:
+                f.write(b"".join(chunks))
+            os.replace(self.path(digest) + '.tmp', self.path(digest))
+        except OSError as e:
+            log.warning("Manifest not saved, deltas against this version need it, %s", e)
+
+    def lookup(self, digest):
+        """
+        Chunk digests of an object version, None if it was never served
+        """
+        with self.lock:
+            chunks = self.manifests.get(digest)
+        if chunks is not None:
+            return chunks
+        try:
+            with open(self.path(digest), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        chunks = [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+        with self.lock:
+            self.manifests[digest] = chunks
+        return chunks
+
+    def index(self, bases):
+        """
+        Map the chunk digests of the advertised objects to (base number, chunk number) where the client finds them
+        """
+        index = {}
+        for base, digest in enumerate(bases):
+            for i, chunk in enumerate(self.lookup(digest) or []):
+                index.setdefault(chunk, (base, i))
+        return index
+
+def copy_runs(chunks, index):
+    """
+    Chunks found in the index as (first chunk, chunk after the last, base number, first source chunk) runs,
+    consecutive chunks copied from consecutive chunks of the same base are merged, so an unchanged object is one run
+    """
+    runs = []
+    for i, chunk in enumerate(chunks):
+        found = index.get(chunk)
+        if found is None:
+            continue
+        base, source = found
+        if runs and runs[-1][1] == i and runs[-1][2] == base and runs[-1][3] + i - runs[-1][0] == source:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1, base, source])
+    return [tuple(run) for run in runs]
@@ -1,22 +1,219 @@
 import struct
+from asyncio import IncompleteReadError
+import shared # code/common on the path, see shared.py
+from manifest import DIGEST_SIZE
+from compress import NONE
 
 HEADER_SIZE = 10
 HEADER_NAME_SIZE = 20
+HEADER_OFFSET_SIZE = 10
+HEADER_TOTAL_SIZE = 10
+HEADER_BASE_SIZE = 4
+HEADER_SOURCE_SIZE = 10
+HEADER_CODEC_SIZE = 2
+HEADER_REQUEST_SIZE = 10
+HEADER_FIELDS = (HEADER_SIZE, HEADER_NAME_SIZE, HEADER_OFFSET_SIZE, HEADER_TOTAL_SIZE, HEADER_BASE_SIZE, HEADER_SOURCE_SIZE, HEADER_CODEC_SIZE, HEADER_REQUEST_SIZE)
+PACKET_HEADER_SIZE = sum(HEADER_FIELDS)
+CHUNK_SIZE = 32768 # bytes per dedup chunk, see ManifestStore, also the block size of compressed packets
+BUFFER_SIZE = 4 * CHUNK_SIZE # receive buffer of a FrameReader, holds any header or compressed block
+PUSH = 0 # the server sends every object unasked, in its own order
+REQUESTS = 1 # the server sends the objects the client asks for with encode_request, in the order asked
+NOT_FOUND = -1 # total of the only packet answering a request for an object the server does not have
 class Packet:
     """
     Our HTTP-like message class that has name, data and data's size to get the payload from a byte stream like TCP.
     Main logic for encoding and decoding the data to be sent over TCP is here.
+    offset is where data starts in the object, it is not 0 when the client resumes an object it already holds a part of.
+    An object may be sent as several packets with increasing offsets, the last one ends at total.
+    A packet with a base is a copy: no data follows, the client copies size bytes from source in the object it
+    advertised as that base (see encode_resume) instead of receiving them.
+    A packet with a codec carries a compressed block, size is the compressed size and the block decompresses to the bytes at offset.
+    request is the id of the request the packet answers, -1 for pushed objects.
     """
-    def __init__(self, name, data):
+    def __init__(self, name, data, offset = 0, total = None, base = -1, source = 0, size = None, codec = NONE, request = -1):
         self.name = name
-        self.data = data
+        self.data = data # bytes
+        self.offset = offset
+        self.total = total if total is not None else offset + len(data) # size of the whole object
+        self.base = base # number of the base copied from, -1 for data
+        self.source = source # offset in the base
+        self.size = size if size is not None else len(data)
+        self.codec = codec
+        self.request = request
     def encode(self):
-        payload_size = len(self.data)
-        return f"{payload_size:<{HEADER_SIZE}}{self.name:<{HEADER_NAME_SIZE}}{self.data}"
+        header = f"{self.size:<{HEADER_SIZE}}{self.name:<{HEADER_NAME_SIZE}}{self.offset:<{HEADER_OFFSET_SIZE}}{self.total:<{HEADER_TOTAL_SIZE}}{self.base:<{HEADER_BASE_SIZE}}{self.source:<{HEADER_SOURCE_SIZE}}{self.codec:<{HEADER_CODEC_SIZE}}{self.request:<{HEADER_REQUEST_SIZE}}"
+        return header.encode() + bytes(self.data)
     
     @staticmethod
     def decode(data):
-        payload_size = int(data[:HEADER_SIZE].strip())
-        name = data[HEADER_SIZE:HEADER_SIZE+HEADER_NAME_SIZE].strip()
-        data = data[HEADER_SIZE+HEADER_NAME_SIZE:]
-        return Packet(name, data[:payload_size])
\ No newline at end of file
+        fields = []
+        start = 0
+        for size in HEADER_FIELDS:
+            fields.append(str(data[start:start+size], 'ascii').strip()) # also parses a memoryview without copying it first
+            start += size
+        size, name, offset, total, base, source, codec, request = fields
+        packet = Packet(name, b'', int(offset), int(total), int(base), int(source), int(size), int(codec), int(request))
+        if packet.base < 0:
+            packet.data = bytes(data[start:start+packet.size])
+        return packet
+
+def recv_exact(sock, size):
+    """
+    Receive exactly size bytes, fewer only if the connection is closed
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            break
+        received += n
+    return bytes(view[:received])
+
+def header_packet(header):
+    """
+    Packet of a header read from the stream, None if the stream ended cleanly before it
+    """
+    if not header:
+        return None
+    if len(header) < PACKET_HEADER_SIZE:
+        raise ConnectionError(f"Connection closed in a packet header, {len(header)} of {PACKET_HEADER_SIZE} bytes")
+    return Packet.decode(header)
+
+class FrameReader:
+    """
+    Buffered reader of the packets of a blocking socket.
+    Bytes are received with recv_into into one preallocated buffer, headers are parsed straight out of it and bodies
+    are handed out as views of it as they arrive, so a body of any size is never held whole and nothing is concatenated.
+    A view is only valid until the next call, write or hash it before reading on.
+    """
+    def __init__(self, sock, size = BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not read yet
+        self.end = 0 # end of the bytes received
+
+    def fill(self):
+        """
+        Receive more bytes after the ones not read yet, returns how many, 0 once the connection is closed
+        """
+        if self.start == self.end:
+            self.start = self.end = 0 # all read, receive at the front
+        return self.receive()
+
+    def receive(self):
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def compact(self):
+        """
+        Move the bytes not read yet to the front of the buffer
+        """
+        unread = self.end - self.start
+        self.view[:unread] = self.view[self.start:self.end]
+        self.start, self.end = 0, unread
+
+    def read_exact(self, size):
+        """
+        View of the next size bytes, fewer only if the connection is closed
+        """
+        if size > len(self.buffer):
+            raise ValueError(f"Frame of {size} bytes does not fit the {len(self.buffer)} byte buffer")
+        if self.start + size > len(self.buffer):
+            self.compact()
+        while self.end - self.start < size:
+            if not self.receive():
+                break
+        size = min(size, self.end - self.start)
+        view = self.view[self.start:self.start + size]
+        self.start += size
+        return view
+
+    def read_packet(self):
+        """
+        Next packet header, None at the end of the stream. The body of a data packet is read with body.
+        """
+        return header_packet(self.read_exact(PACKET_HEADER_SIZE))
+
+    def body(self, size):
+        """
+        Yield views of the next size bytes as they arrive
+        """
+        while size > 0:
+            if self.start == self.end and not self.fill():
+                raise ConnectionError(f"Connection closed with {size} bytes of a packet left")
+            n = min(size, self.end - self.start)
+            yield self.view[self.start:self.start + n]
+            self.start += n
+            size -= n
+
+class AsyncFrameReader:
+    """
+    FrameReader over an asyncio StreamReader, which already receives into its own buffer
+    """
+    def __init__(self, reader):
+        self.reader = reader
+
+    async def read_exact(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except IncompleteReadError as e:
+            return e.partial
+
+    async def read_packet(self):
+        return header_packet(await self.read_exact(PACKET_HEADER_SIZE))
+
+    async def body(self, size):
+        while size > 0:
+            data = await self.reader.read(min(size, BUFFER_SIZE))
+            if not data:
+                raise ConnectionError(f"Connection closed with {size} bytes of a packet left")
+            yield data
+            size -= len(data)
+
+def encode_resume(held, bases = (), codecs = 0, mode = PUSH):
+    """
+    Resume request sent by the client right after connecting: how many bytes of each object it already holds,
+    then the digests of the complete objects it holds, which the server copies unchanged chunks from,
+    the codecs it can decompress (see compress.supported), of which the server may pick one,
+    and whether the server pushes every object or waits for requests (PUSH or REQUESTS).
+    TCP delivers in order, so what the client holds of an object is always a prefix and its length is enough.
+    """
+    return (f"{len(held):<{HEADER_SIZE}}" + "".join(f"{name:<{HEADER_NAME_SIZE}}{offset:<{HEADER_OFFSET_SIZE}}" for name, offset in held.items())
+            + f"{len(bases):<{HEADER_SIZE}}" + "".join(digest.hex() for digest in bases) + f"{codecs:<{HEADER_SIZE}}{mode:<{HEADER_SIZE}}")
+
+def read_resume(sock):
+    """
+    Read the resume request of encode_resume from the socket, returns a dict of name -> bytes held, the base digests,
+    the codecs offered and the mode
+    """
+    count = int(recv_exact(sock, HEADER_SIZE).decode().strip() or 0)
+    held = {}
+    for _ in range(count):
+        entry = recv_exact(sock, HEADER_NAME_SIZE + HEADER_OFFSET_SIZE).decode()
+        held[entry[:HEADER_NAME_SIZE].strip()] = int(entry[HEADER_NAME_SIZE:].strip())
+    count = int(recv_exact(sock, HEADER_SIZE).decode().strip() or 0)
+    bases = [bytes.fromhex(recv_exact(sock, DIGEST_SIZE * 2).decode()) for _ in range(count)]
+    codecs = int(recv_exact(sock, HEADER_SIZE).decode().strip() or 0)
+    mode = int(recv_exact(sock, HEADER_SIZE).decode().strip() or 0)
+    return held, bases, codecs, mode
+
+def encode_request(request, name):
+    """
+    Request for an object by name after a resume request in REQUESTS mode. Requests may be pipelined, the server
+    answers them one after the other with the packets of the object, carrying the request id.
+    """
+    return f"{request:<{HEADER_SIZE}}{name:<{HEADER_NAME_SIZE}}"
+
+def read_request(sock):
+    """
+    Read a request of encode_request from the socket, returns (request id, name), None once the client is done
+    """
+    entry = recv_exact(sock, HEADER_SIZE + HEADER_NAME_SIZE)
+    if len(entry) < HEADER_SIZE + HEADER_NAME_SIZE:
+        return None
+    entry = entry.decode()
+    return int(entry[:HEADER_SIZE].strip()), entry[HEADER_SIZE:].strip()
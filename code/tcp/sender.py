@@ -1,4 +1,7 @@
-from packet import Packet, HEADER_SIZE, HEADER_NAME_SIZE
+from packet import Packet, HEADER_SIZE, HEADER_NAME_SIZE, CHUNK_SIZE, REQUESTS, NOT_FOUND, read_resume, read_request
+import shared # code/common on the path, see shared.py
+from manifest import ManifestStore, copy_runs
+from compress import NONE, CompressionStats, compressed_blocks, negotiate
 from threading import Thread
 import socket
 import os
@@ -6,13 +9,20 @@ import glob
 from traceback import print_exc
 from pathlib import Path
 
+manifests = ManifestStore(CHUNK_SIZE) # chunk digests of every object version served, shared by all senders
+MSG_MORE = getattr(socket, 'MSG_MORE', 0) # Linux, the header waits for the body instead of going out alone and stalling on a delayed ack
+
 class TCPSender(Thread):
     """
     TCP sender class that is responsible for constructing packets for the files and sending them to the socket
     """
-    def __init__(self, socket):
+    def __init__(self, socket, compression = NONE):
         super().__init__()
         self.socket = socket
+        self.compression = compression # codec used if the client offers it, see compress.py
+        self.codec = NONE # negotiated codec of this connection
+        self.stats = CompressionStats()
+        self.bytes_sent = 0 # bytes written to the socket, headers included
 
     def getfiles(self,dir):
         # get all files in the directory
@@ -20,33 +30,117 @@ class TCPSender(Thread):
         large_files = glob.glob(os.path.join(dir, 'large*.obj'))
         return [f for f in small_files if os.path.isfile(f)], [f for f in large_files if os.path.isfile(f)]
 
-    def run(self):
-        dir = '../objects'
+    def send_file(self, path, held, index, request = -1):
+        """
+        Send a file, or the part of it the client does not hold yet
+        Chunks the client holds in one of its bases are sent as copies, only the rest is sent as data.
+        request is the id of the request it answers, -1 when pushed.
+        The file is never read as a whole: data follows its header straight from the file with sendfile, so the
+        kernel copies it into the socket, and compressed blocks are read one at a time, whatever the object size.
+        """
+        name = Path(path).name
+        with open(path, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            offset = held.get(name, 0) # bytes the client kept from an earlier connection
+            if not 0 <= offset <= total:
+                offset = 0 # a bogus offset, or a part of a longer earlier version, the client truncates it to the first packet's offset
+            _, chunks = manifests.manifest(path) # recorded even without bases, later clients may hold this version
+            ranges = [] # (start, end, copy packet or None for data) in offset order
+            position = offset
+            for first, stop, base, source in copy_runs(chunks, index):
+                start, end = max(first * CHUNK_SIZE, position), min(stop * CHUNK_SIZE, total)
+                if start >= end:
+                    continue # the client already holds this prefix
+                if start > position:
+                    ranges.append((position, start, None))
+                ranges.append((start, end, Packet(name, b'', start, total, base, source * CHUNK_SIZE + start - first * CHUNK_SIZE, end - start, request=request)))
+                position = end
+            if position < total or not ranges:
+                ranges.append((position, total, None)) # also tells the client that a held object is complete
+            sent = 0
+            for packet, count in self.packets(name, f, total, ranges, request): # HTTP-like packets
+                header = packet.encode()
+                self.socket.sendall(header, MSG_MORE if count else 0)
+                if count:
+                    self.socket.sendfile(f, packet.offset, count) # the body of a data packet, straight from the page cache
+                self.bytes_sent += len(header) + count
+                sent += len(packet.data) + count
+        copied = sum(copy.size for _, _, copy in ranges if copy is not None)
+        print(f"Sent {name}" + (f" from {offset}" if offset else "") + (f", {copied} bytes as copies" if copied else "") + (f", {sent} bytes of data" if self.codec != NONE else ""))
+
+    def packets(self, name, f, total, ranges, request = -1):
+        """
+        (packet, bytes of the file that follow its header) of the ranges. Without compression a data range is one packet
+        whose body is sent from the file. With compression the data is split in blocks of CHUNK_SIZE that are read and
+        compressed in the worker pool ahead of sending, a block that does not get smaller is sent as is.
+        """
+        if self.codec == NONE:
+            for start, end, copy in ranges:
+                yield (copy, 0) if copy is not None else (Packet(name, b'', start, total, size=end - start, request=request), end - start)
+            return
+        blocks = compressed_blocks(self.codec, ((i, os.pread(f.fileno(), min(CHUNK_SIZE, end - i), i)) for start, end, copy in ranges if copy is None for i in range(start, end, CHUNK_SIZE)), self.stats)
+        for start, end, copy in ranges:
+            if copy is not None:
+                yield copy, 0
+            elif start == end:
+                yield Packet(name, b'', start, total, request=request), 0
+            else:
+                for i in range(start, end, CHUNK_SIZE):
+                    offset, block, compressed = next(blocks)
+                    if len(compressed) < len(block):
+                        yield Packet(name, compressed, offset, total, codec=self.codec, request=request), 0
+                    else:
+                        yield Packet(name, block, offset, total, request=request), 0
+
+    def pushed(self, dir):
+        """
+        (path, request) of every object, small and large alternately, when the client asked for all of them
+        """
         small_files, large_files = self.getfiles(dir)
+        while small_files or large_files:
+            if small_files:
+                yield small_files.pop(), -1
+            if large_files:
+                yield large_files.pop(), -1
+
+    def requested(self, dir):
+        """
+        (path, request) of the objects the client requests, until it stops sending requests
+        A request for anything but an object in dir is answered with a NOT_FOUND packet.
+        """
         while True:
-            try:
-                if len(small_files) == 0 and len(large_files) == 0:
-                    break
-                with open(small_files.pop(), 'r') as f:
-                    data = f.read()
-                    packet = Packet(Path(f.name).name, data) # HTTP-like packet
-                    self.socket.send(packet.encode().encode())
-                    print(f"Sent {Path(f.name).name}")
-                with open(large_files.pop(), 'r') as f:
-                    data = f.read()
-                    packet = Packet(Path(f.name).name, data) # HTTP-like packet
-                    self.socket.send(packet.encode().encode())
-            except BrokenPipeError as e:
-                self.socket.close()
-                break
-            except OSError as e:
-                self.socket.close()
-                print_exc()
-                break
-            except Exception as e:
-                print_exc()
-                break
+            request = read_request(self.socket)
+            if request is None:
+                return
+            request, name = request
+            path = os.path.join(dir, name)
+            if os.path.basename(name) != name or not name.endswith('.obj') or not os.path.isfile(path):
+                print(f"Possible fault: Request {request} for unknown object {name}")
+                self.socket.sendall(Packet(name, b'', 0, NOT_FOUND, request=request).encode())
+                continue
+            yield path, request
+
+    def run(self):
+        dir = '../objects'
+        try:
+            held, bases, codecs, mode = read_resume(self.socket) # the client tells what it already holds before anything is sent
+        except (OSError, ValueError) as e:
+            print_exc()
+            self.socket.close()
+            return
+        index = manifests.index(bases)
+        self.codec = negotiate(codecs, self.compression)
+        self.stats = CompressionStats(self.codec)
+        try:
+            for path, request in (self.requested(dir) if mode == REQUESTS else self.pushed(dir)):
+                self.send_file(path, held, index, request)
+        except BrokenPipeError as e:
+            pass
+        except Exception as e:
+            print_exc()
         self.socket.close()
+        if self.codec != NONE:
+            print("Compression {}".format(self.stats.report()))
         return
 
 
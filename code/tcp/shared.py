@@ -0,0 +1,10 @@
+"""
+Puts code/common on the import path, the modules there (manifest, compress) are shared by both transports.
+Imported before them by every module that uses them.
+"""
+import os
+import sys
+
+COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common')
+if COMMON not in sys.path:
+    sys.path.append(COMMON)
@@ -1,77 +1,349 @@
 # echo-client.py
 
 import socket
-from packet import Packet, HEADER_SIZE, HEADER_NAME_SIZE
+import asyncio
+from collections import deque
+from threading import Thread, Lock
+from packet import CHUNK_SIZE, PUSH, REQUESTS, NOT_FOUND, FrameReader, AsyncFrameReader, encode_resume, encode_request
+import shared # code/common on the path, see shared.py
+from manifest import DIGEST_SIZE
+from compress import NONE, CompressionStats, supported, decompress, timed
 import traceback
 from hashlib import md5
 import time
 import csv
-HOST = socket.gethostbyname("server")  # Use this if you are using docker compose
+import glob
+import os
+import sys
+HOST = os.environ.get("SERVER_HOST", "server")  # Use this if you are using docker compose, resolved when connecting
 # if you do not use docker compose, instead of resolving name
 # set host to the ip address directly
 #HOST = "172.19.0.2"
-PORT = 8000  # socket server port number
+PORT = int(os.environ.get("SERVER_PORT", 8000))  # socket server port number
+POOL_SIZE = 4 # connections of a ConnectionPool
+PIPELINE = 2 # requests sent ahead on each pooled connection, so the next object follows without a round trip
 
-  # instantiate
- # connect to the server
+class ObjectWriter:
+    """
+    Writes the received objects to disk whichever way the packets are read, see receive and receive_async.
+    Data is written and hashed as it arrives, an object is renamed in place once its md5 matched.
+    """
+    def __init__(self, directory):
+        self.directory = directory # keep the objects in this directory and resume from it after a restart
+        self.held = {} # name -> bytes of it already on disk, the journal of a TCP transfer is the length of its .part file
+        self.bases = [] # (digest, path) of the complete objects on disk, the server sends copies of the chunks it finds in them
+        self.receiving = {} # name -> (file, digest) of the objects whose last packet did not arrive yet
+        self.stats = CompressionStats() # decompression of the compressed packets
+        self.large_times = []
+        self.small_times = []
+        self.start = time.perf_counter()
+        self.lock = Lock() # objects complete on several connections of a ConnectionPool
+        if directory is not None:
+            for path in glob.glob(os.path.join(directory, '*.obj')):
+                if os.path.exists(path + '.md5'):
+                    with open(path + '.md5', 'r') as f:
+                        digest = bytes.fromhex(f.read().strip()) # written when it was received
+                else:
+                    md5sum = md5()
+                    with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            md5sum.update(chunk) # a chunk at a time, the object may be larger than memory
+                    digest = md5sum.digest()
+                self.bases.append((digest[:DIGEST_SIZE], path)) # complete, only renamed after its md5 matched
+            for path in glob.glob(os.path.join(directory, '*.obj.part')):
+                self.held[os.path.basename(path)[:-len('.part')]] = os.path.getsize(path)
 
-with socket.socket() as s:
-    s.connect((HOST, PORT))
-    start = time.perf_counter() # start timer
-    large_times = []
-    small_times = []
-    while True:
-        try:
-            size = s.recv(HEADER_SIZE) # receive size of packet
-            if not size:
-                break
-            size = int(size.decode())
-            name = s.recv(HEADER_NAME_SIZE)  # receive name of packet
-            name = name.decode()
-            name = name.split()[0]
-            print(f"Receiving {name} with size {size}")
-            data = b''
-            data = s.recv(size)
-            while len(data) < size:
-                data += s.recv(size - len(data)) # receive all data of a packet
-            if not data or len(data) != size:
-                print(f"Error receiving data, {name}, {len(data), size}")
-                break
-            print(f"Received {name}, md5: {md5(data).hexdigest()}")
+    def resume(self, mode = PUSH):
+        return encode_resume(self.held, [digest for digest, _ in self.bases], supported(), mode).encode() # the server only sends what we do not hold yet
+
+    def catalogue(self):
+        """
+        Names of the objects to fetch, small ones first, from the digests we check them against
+        """
+        names = [os.path.basename(path)[:-len('.md5')] for path in glob.glob("../objects/*.obj.md5")]
+        return sorted(names, key=lambda name: (not name.startswith("small"), name))
+
+    def path(self, name):
+        return os.path.join(self.directory or ".", name)
+
+    def begin(self, packet):
+        """
+        Start a packet, opens its object on the first one
+        """
+        name = packet.name
+        print(f"Receiving {name} with size {packet.size} from {packet.offset}" + (f" as a copy of base {packet.base}" if packet.base >= 0 else ""))
+        if name not in self.receiving:
+            f = open(self.path(name) + ".part", 'ab+')
+            f.truncate(packet.offset) # drop anything after what we reported
+            f.seek(0)
+            digest = md5()
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk) # the part held from an earlier connection
+            self.receiving[name] = (f, digest)
+
+    def write(self, name, data):
+        f, digest = self.receiving[name]
+        f.write(data)
+        digest.update(data)
+
+    def copy(self, packet):
+        """
+        Append size bytes from source in a base to the object, returns the bytes missing from the base
+        """
+        size = packet.size
+        if packet.base >= len(self.bases):
+            return size
+        with open(self.bases[packet.base][1], 'rb') as b:
+            b.seek(packet.source)
+            while size > 0:
+                data = b.read(min(size, CHUNK_SIZE))
+                if not data:
+                    break
+                self.write(packet.name, data)
+                size -= len(data)
+        return size
+
+    def block(self, packet, compressed):
+        """
+        Decompress a compressed block and append it, returns its length in the object
+        """
+        data = timed(decompress, packet.codec, compressed, self.stats)
+        self.write(packet.name, data)
+        return len(data)
+
+    def end(self, packet, length):
+        """
+        Finish a packet that covered length bytes of its object, returns False once nothing more should be received
+        """
+        name = packet.name
+        if packet.offset + length < packet.total:
+            return True # more packets of this object follow
+        f, digest = self.receiving.pop(name)
+        f.close()
+        print(f"Received {name}, md5: {digest.hexdigest()}")
+        with self.lock:
             if name.startswith("large"):
-                large_times.append(time.perf_counter() - start) # calculate time taken
+                self.large_times.append(time.perf_counter() - self.start) # calculate time taken
             elif name.startswith("small"):
-                small_times.append(time.perf_counter() - start)
-            print(f"Time taken: {time.perf_counter() - start}")
-            with open(f"../objects/{name}.md5", "r") as f:
-                md5sum = f.read().strip() # read md5 sum from file
-            if md5(data).hexdigest() != md5sum:
-                print(f"MD5 sum mismatch, {name}")
+                self.small_times.append(time.perf_counter() - self.start)
+        print(f"Time taken: {time.perf_counter() - self.start}")
+        with open(f"../objects/{name}.md5", "r") as f:
+            md5sum = f.read().strip() # read md5 sum from file
+        path = self.path(name)
+        if digest.hexdigest() != md5sum:
+            print(f"MD5 sum mismatch, {name}")
+            os.remove(path + ".part") # start over next time
+            return False
+        os.replace(path + ".part", path)
+        if self.directory is not None:
+            with open(path + ".md5", "w") as f:
+                f.write(md5sum) # the next run advertises the object by this digest
+        print(f"Finished receiving {name}")
+        with self.lock:
+            if len(self.large_times) == 10 and len(self.small_times) == 10:
+                self.report()
+                return False
+        return True
+
+    def report(self):
+        avg_large = sum(self.large_times)/len(self.large_times)
+        avg_small = sum(self.small_times)/len(self.small_times)
+        total = time.perf_counter() - self.start
+        print("Average large time: {}".format(avg_large))
+        print("Average small time: {}".format(avg_small))
+        if self.stats.blocks:
+            print("Decompression: {} blocks, {:.1f} ms CPU".format(self.stats.blocks, self.stats.cpu * 1000))
+        with open("results.csv", "r") as f:
+            reader = csv.reader(f)
+            rows = list(reader)
+        if len(rows) == 0:
+            rows = [[], [], []]
+        rows[0].append(avg_large)
+        rows[1].append(avg_small)
+        rows[2].append(total)
+        with open("results.csv", "w") as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+
+def packet_reads(packet, objects):
+    """
+    What follows the header of a packet, as the reads it needs, shared by receive_packet and receive_packet_async.
+    Yields (size, write): write is None to be sent back the next size bytes, or where each piece of a body of size
+    bytes goes as it arrives. Returns the bytes of the object the packet covers, None on error.
+    """
+    objects.begin(packet)
+    if packet.base >= 0:
+        if objects.copy(packet):
+            print(f"Error copying data, {packet.name}, base {packet.base}")
+            return None
+        return packet.size
+    if packet.codec != NONE:
+        compressed = yield packet.size, None # a block, fits the buffer of the reader
+        if len(compressed) < packet.size:
+            print(f"Error receiving data, {packet.name}, {len(compressed), packet.size}")
+            return None
+        return objects.block(packet, compressed)
+    yield packet.size, lambda data: objects.write(packet.name, data) # views of the receive buffer, written straight into the file
+    return packet.size
+
+def receive_packet(reader, packet, objects):
+    """
+    Receive what follows the header of a packet into its object, see packet_reads
+    """
+    reads = packet_reads(packet, objects)
+    data = None
+    try:
+        while True:
+            size, write = reads.send(data)
+            if write is None:
+                data = reader.read_exact(size)
+            else:
+                for data in reader.body(size):
+                    write(data)
+                data = None
+    except StopIteration as e:
+        return e.value
+
+async def receive_packet_async(reader, packet, objects):
+    """
+    receive_packet over an AsyncFrameReader
+    """
+    reads = packet_reads(packet, objects)
+    data = None
+    try:
+        while True:
+            size, write = reads.send(data)
+            if write is None:
+                data = await reader.read_exact(size)
+            else:
+                async for data in reader.body(size):
+                    write(data)
+                data = None
+    except StopIteration as e:
+        return e.value
+
+def receive(objects):
+    with socket.socket() as s:
+        s.connect((HOST, PORT))
+        s.sendall(objects.resume())
+        objects.start = time.perf_counter() # start timer
+        reader = FrameReader(s)
+        while True:
+            try:
+                packet = reader.read_packet() # size, name, offset, total, base, source, codec and request of packet
+                if packet is None:
+                    break
+                length = receive_packet(reader, packet, objects) # bytes of the object the packet covers
+                if length is None or not objects.end(packet, length):
+                    break
+            except Exception as e:
+                traceback.print_exc()
                 break
-            packet = Packet(name, data.decode())
-            with open(f"{name}", 'w') as f:
-                f.write(packet.data)
-                
-            print(f"Finished receiving {name}")
-            if len(large_times) == 10 and len(small_times) == 10:
-                avg_large = sum(large_times)/len(large_times)
-                avg_small = sum(small_times)/len(small_times)
-                total = time.perf_counter() - start
-                print("Average large time: {}".format(sum(large_times)/len(large_times)))
-                print("Average small time: {}".format(sum(small_times)/len(small_times)))
-                with open("results.csv", "r") as f:
-                    reader = csv.reader(f)
-                    rows = list(reader)
-                if len(rows) == 0:
-                    rows = [[], [], []]
-                rows[0].append(avg_large)
-                rows[1].append(avg_small)
-                rows[2].append(total)
-                with open("results.csv", "w") as f:
-                    writer = csv.writer(f)
-                    writer.writerows(rows)
-                exit(0)
+
+class ConnectionPool:
+    """
+    Fetches objects by name over several connections in REQUESTS mode.
+    Every connection keeps up to PIPELINE requests outstanding and takes the next name from a shared queue whenever an
+    object completes, so the connections pull work as fast as they drain it and a small object only waits behind the
+    objects already requested on its connection, never behind every large object.
+    """
+    def __init__(self, objects, names, size = POOL_SIZE, depth = PIPELINE):
+        self.objects = objects
+        self.names = deque(names) # not requested yet
+        self.size = size
+        self.depth = depth
+        self.next_id = 0
+        self.lock = Lock() # protects names and next_id, shared by the connections
+
+    def next(self):
+        """
+        (request id, name) of the next object to request, None once all are requested
+        """
+        with self.lock:
+            if not self.names:
+                return None
+            self.next_id += 1
+            return self.next_id, self.names.popleft()
+
+    def fetch(self):
+        self.objects.start = time.perf_counter()
+        threads = [Thread(target=self.connection) for _ in range(min(self.size, len(self.names)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def connection(self):
+        """
+        One connection of the pool, answers arrive in the order of the requests
+        """
+        outstanding = deque() # (request id, name) sent and not answered yet
+        try:
+            with socket.socket() as s:
+                s.connect((HOST, PORT))
+                s.sendall(self.objects.resume(REQUESTS))
+                reader = FrameReader(s)
+                self.request(s, outstanding)
+                while outstanding:
+                    packet = reader.read_packet()
+                    if packet is None:
+                        print(f"Possible fault: Connection closed with {len(outstanding)} requests outstanding")
+                        return
+                    request, name = outstanding[0]
+                    if packet.request != request:
+                        print(f"Possible fault: Answer to request {packet.request} while waiting for {request}")
+                        return
+                    if packet.total == NOT_FOUND:
+                        print(f"Possible fault: {name} not found on the server")
+                    else:
+                        length = receive_packet(reader, packet, self.objects)
+                        if length is None or not self.objects.end(packet, length):
+                            return
+                        if name in self.objects.receiving:
+                            continue # more packets of this object follow
+                    outstanding.popleft()
+                    self.request(s, outstanding)
         except Exception as e:
             traceback.print_exc()
-            break
 
+    def request(self, s, outstanding):
+        while len(outstanding) < self.depth:
+            item = self.next()
+            if item is None:
+                return
+            s.sendall(encode_request(*item).encode())
+            outstanding.append(item)
+
+async def receive_async(objects):
+    """
+    receive over asyncio streams
+    """
+    stream, writer = await asyncio.open_connection(HOST, PORT)
+    writer.write(objects.resume())
+    await writer.drain()
+    objects.start = time.perf_counter()
+    reader = AsyncFrameReader(stream)
+    try:
+        while True:
+            packet = await reader.read_packet()
+            if packet is None:
+                break
+            length = await receive_packet_async(reader, packet, objects) # bytes of the object the packet covers
+            if length is None or not objects.end(packet, length):
+                break
+    except Exception as e:
+        traceback.print_exc()
+    finally:
+        writer.close()
+
+if __name__ == "__main__":
+    # python tcpclient.py [directory|-] [asyncio|pool [connections]]
+    directory = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '-' else None # - for none, to pass a mode alone
+    mode = sys.argv[2] if len(sys.argv) > 2 else None
+    objects = ObjectWriter(directory)
+    if mode == 'asyncio':
+        asyncio.run(receive_async(objects))
+    elif mode == 'pool':
+        ConnectionPool(objects, objects.catalogue(), int(sys.argv[3]) if len(sys.argv) > 3 else POOL_SIZE).fetch()
+    else:
+        receive(objects)
@@ -3,23 +3,175 @@
 import socket
 from sender import TCPSender
 import traceback
-HOST = "server"  # Set to the IP address of the server eth0 if you do not use docker compose 
-PORT = 8000  # Port to listen on (non-privileged ports are > 1023)
-
-# This implementation supports only one client
-# You have to implement threading for handling multiple TCP connections
-
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((HOST, PORT))
-    s.listen()
-    while True:
-        conn, addr = s.accept()
-        with conn:
+import sys
+import os
+import queue
+import signal
+import time
+from threading import Thread, Event, Lock
+import shared # code/common on the path, see shared.py
+from compress import CODECS, NONE
+HOST = os.environ.get("SERVER_HOST", "server")  # Set to the IP address of the server eth0 if you do not use docker compose
+PORT = int(os.environ.get("SERVER_PORT", 8000))  # Port to listen on (non-privileged ports are > 1023), both can be set from the environment
+COMPRESSION = CODECS[sys.argv[1] if len(sys.argv) > 1 else 'none'] # opt-in, used for the clients that offer it
+WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 4 # clients served at the same time
+BACKLOG = 64 # connections accepted but not served yet, beyond this they wait in the kernel listen queue
+ACCEPT_POLL = 0.5 # seconds between checks for shutdown while waiting for a connection
+DRAIN_TIMEOUT = 30 # seconds the clients being served get to finish after shutdown, then their sockets are shut down
+
+class TCPServer:
+    """
+    Concurrent TCP server, a fixed pool of worker threads serves the accepted connections with one TCPSender each.
+    Accepted connections wait in a bounded queue, when all workers are busy and the queue is full the accept loop stops
+    accepting and new clients wait in the kernel listen queue, so a burst of clients can not exhaust threads or memory.
+    shutdown stops accepting, the clients already accepted are still served, up to DRAIN_TIMEOUT, then the ones still
+    waiting in the queue are closed and the ones being served are shut down.
+    """
+    def __init__(self, host, port, workers = WORKERS, backlog = BACKLOG, compression = NONE):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # restart right after a shutdown
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        self.socket.settimeout(ACCEPT_POLL)
+        self.compression = compression
+        self.pending = queue.Queue(maxsize=backlog) # (socket, address, accept time) of the connections waiting for a worker
+        self.stopping = Event()
+        self.expired = False # set when the drain timed out, connections still queued are closed instead of served
+        self.active = {} # address -> socket of the connections being served
+        self.lock = Lock() # protects active and the statistics, updated by the workers
+        self.clients = 0 # connections served
+        self.bytes_sent = 0
+        self.latencies = [] # seconds from accept to the last byte of each client
+        self.waits = [] # seconds each client waited for a worker
+        self.first = None # accept time of the first client and completion of the last, the span of the aggregate throughput
+        self.last = None
+        self.workers = [Thread(target=self.worker, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def serve_forever(self):
+        """
+        Accept connections until shutdown, then wait for the workers to drain
+        """
+        while not self.stopping.is_set():
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                if self.stopping.is_set():
+                    break
+                traceback.print_exc()
+                continue
+            conn.settimeout(None) # accepted sockets inherit the timeout of the listening socket
             print(f"Connected by {addr}")
+            while True:
+                try:
+                    self.pending.put((conn, addr, time.perf_counter()), timeout=ACCEPT_POLL) # blocks while the backlog is full
+                    break
+                except queue.Full:
+                    if self.stopping.is_set():
+                        conn.close() # shutting down and no room, not served
+                        break
+        self.socket.close()
+        self.drain()
+
+    def worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return # shutdown, the queue is drained
+            conn, addr, accepted = item
+            if self.expired:
+                conn.close()
+                continue
+            with self.lock:
+                self.active[addr] = conn
+            started = time.perf_counter()
+            sender = TCPSender(conn, self.compression) # per connection state, run in this worker instead of its own thread
             try:
-                sender = TCPSender(conn) # create a sender thread for each client
                 sender.run()
-            except Exception as e:
+            except Exception:
                 traceback.print_exc()
-                break
+            finally:
+                conn.close()
+            done = time.perf_counter()
+            with self.lock:
+                del self.active[addr]
+                self.clients += 1
+                self.bytes_sent += sender.bytes_sent
+                self.latencies.append(done - accepted)
+                self.waits.append(started - accepted)
+                self.first = accepted if self.first is None else min(self.first, accepted)
+                self.last = done
+            print(f"Served {addr}: {sender.bytes_sent} bytes in {done - started:.3f} s, waited {started - accepted:.3f} s")
+
+    def shutdown(self):
+        """
+        Stop accepting, may be called from a signal handler or another thread
+        """
+        self.stopping.set()
+
+    def drain(self):
+        """
+        Let the workers finish the accepted clients, then stop them
+        """
+        deadline = time.perf_counter() + DRAIN_TIMEOUT # also bounds the wait for room in a full queue
+        sentinels = 0 # put in the queue
+        try:
+            for _ in self.workers:
+                self.pending.put(None, timeout=max(deadline - time.perf_counter(), 0)) # after every accepted connection, the queue is FIFO
+                sentinels += 1
+        except queue.Full:
+            pass # the workers are still busy and the backlog is full at the deadline
+        for worker in self.workers:
+            worker.join(max(deadline - time.perf_counter(), 0))
+        self.expired = True
+        sentinels -= self.cancel()
+        with self.lock:
+            stuck = list(self.active.items())
+        for addr, conn in stuck:
+            print(f"Possible fault: {addr} not served within {DRAIN_TIMEOUT} s of shutdown, closing it")
+            try:
+                conn.shutdown(socket.SHUT_RDWR) # the blocked sendall fails and the worker exits
+            except OSError:
+                pass
+        for _ in range(len(self.workers) - sentinels):
+            self.pending.put(None) # for the workers that did not get one, the queue was emptied by cancel
+        for worker in self.workers:
+            worker.join()
+        print(self.report())
+
+    def cancel(self):
+        """
+        Close the connections still waiting for a worker, returns how many sentinels were taken out of the queue with them
+        """
+        removed = 0
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                return removed
+            if item is None:
+                removed += 1
+                continue
+            conn, addr, accepted = item
+            print(f"Possible fault: {addr} still waiting for a worker {DRAIN_TIMEOUT} s after shutdown, closing it")
+            conn.close()
+
+    def report(self):
+        with self.lock:
+            if not self.latencies:
+                return "Served no clients"
+            elapsed = max(self.last - self.first, 1e-9)
+            latencies = sorted(self.latencies)
+            return "Served {} clients with {} workers, {} bytes, {:.1f} MB/s aggregate, latency average {:.3f} s, p50 {:.3f} s, max {:.3f} s, average wait {:.3f} s".format(
+                self.clients, len(self.workers), self.bytes_sent, self.bytes_sent / elapsed / 1e6, sum(latencies) / len(latencies),
+                latencies[len(latencies) // 2], latencies[-1], sum(self.waits) / len(self.waits))
 
+if __name__ == "__main__":
+    # python tcpserver.py [compression] [workers]
+    server = TCPServer(HOST, PORT, compression=COMPRESSION)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown()) # docker stop
+    signal.signal(signal.SIGINT, lambda signum, frame: server.shutdown()) # Ctrl-C
+    server.serve_forever()
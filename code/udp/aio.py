@@ -0,0 +1,330 @@
+import asyncio
+import socket
+import sys
+import time
+from segment import Segment, TOTAL_SIZE, DATAGRAM_SIZE, CONNECT, FIN
+from connection import Connection, ConnectionTable, FIN_RETRIES
+from client import ReliableReceiver, ACK_EVERY, ACK_DELAY, CONNECT_TIMEOUT, SERVER, PORT, received
+from server import HOST, construct_segments, report, parse_fec, parse_pacing
+from timer import LoopScheduler
+from streams import Stream
+from batchio import BatchReceiver, set_buffer_sizes
+from congestion import AIMD, controller
+from packet import Reassembler, encode_resume
+import shared # code/common on the path, see shared.py
+from compress import NONE, CODECS, supported
+from metrics import registry, configure
+import logging
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None # optional, the default asyncio event loop is used without it
+log = logging.getLogger(__name__)
+
+class AsyncConnection(Connection):
+    """
+    Connection driven by the event loop instead of a sender thread.
+    Waiting for the window to open, for new streams and for the FIN_ACK are awaitables instead of locks used as semaphores.
+    Ack handling, fast retransmit and timeouts are inherited and run as callbacks of the loop, so they never contend for a lock.
+    """
+    def start(self):
+        self.window_moved = asyncio.Event() # set when acks open the window
+        self.progress = asyncio.Event() # set on every ack that moved anything, wakes drain
+        self.data_ready = asyncio.Event() # set when a stream is opened or the connection is closing
+        self.closed = asyncio.Event() # set when the client acknowledged our FIN
+        self.task = asyncio.get_running_loop().create_task(self.sender())
+
+    def notify(self):
+        self.window_moved.set()
+        self.progress.set()
+
+    async def sender(self):
+        """
+        Task that constructs segments from the streams opened by send while they fit in the windows
+        """
+        next_send = 0
+        while not self.aborted:
+            while not self.window_open() and not self.aborted:
+                self.window_moved.clear()
+                await self.window_moved.wait() # backpressure, wait for acks
+            item = self.streams.take() # next segment of the highest priority stream
+            if item is None:
+                if self.streams.closed:
+                    return # connection closed
+                if self.fec is not None:
+                    self.send_parity(self.fec.flush(self.conn_id)) # out of data, protect the partial group
+                self.data_ready.clear()
+                await self.data_ready.wait()
+                continue
+            seg = self.next_segment(*item) # numbered before any await so drain sees it as in flight
+            interval = self.congestion.pacing_interval(self.rtt.rtt())
+            if interval:
+                now = time.perf_counter()
+                if next_send > now:
+                    await asyncio.sleep(next_send - now) # pace sends over the RTT instead of sending the window in one burst
+                next_send = max(now, next_send) + interval
+            await self.server.writable.wait() # the transport buffer is full, wait until the kernel takes it
+            self.server.transmit(self, seg)
+            self.protect(seg)
+
+    async def send(self, packet, weight = 1):
+        """
+        Our TCP-like send function that opens a stream for a SegmentedPacket
+        Returns once the stream is scheduled, its fragments are only produced when the window allows. While the send
+        buffer is full it waits for acks to drain it instead of blocking the loop, see StreamScheduler.
+        Returns a future of the seconds until every segment of the stream was acked.
+        """
+        stream = Stream(packet.name_id, packet.fragments(), packet.count(), weight)
+        while not self.streams.fits(stream) and not self.aborted:
+            self.progress.clear()
+            await self.progress.wait() # set on every ack that moved anything
+        self.streams.add(stream)
+        if self.aborted:
+            self.fail([stream])
+        self.data_ready.set()
+        future = asyncio.wrap_future(stream.future)
+        future.add_done_callback(lambda done: done.cancelled() or done.exception()) # an abort fails every stream, not only the awaited ones, see fail
+        return future
+
+    async def drain(self):
+        """
+        Wait until everything passed to send is acked, or the connection is aborted (see MAX_TIMEOUTS)
+        """
+        while (self.streams.heap or self.window_base < self.seq) and not self.aborted:
+            self.progress.clear()
+            await self.progress.wait()
+
+    async def close(self):
+        """
+        Wait until everything is acked, then send a FIN until the client acknowledges it and forget the connection
+        """
+        await self.drain()
+        self.streams.close()
+        self.data_ready.set() # stop the sender task
+        for _ in range(FIN_RETRIES if not self.aborted else 0):
+            self.server.send_control(Segment(self.seq, kind=FIN, conn_id=self.conn_id), self.addr)
+            try:
+                await asyncio.wait_for(self.closed.wait(), self.rtt.timeout())
+                break
+            except asyncio.TimeoutError:
+                pass
+        self.server.remove(self)
+
+class AsyncUDPServer(ConnectionTable, asyncio.DatagramProtocol):
+    """
+    asyncio version of UDPServer with the same selective repeat semantics and wire format, created by start_server.
+    The loop reads one datagram per wakeup, so datagram_received drains the rest that are already queued on the socket
+    and handles them together like the threaded ack receiver does.
+    Retransmission timers are loop timers (see LoopScheduler) and a full transport buffer pauses the senders through
+    pause_writing, so everything runs on the loop thread.
+    """
+    connection_class = AsyncConnection
+
+    def __init__(self, sock, congestion = AIMD, compression = NONE, fec = None):
+        ConnectionTable.__init__(self, congestion, compression, fec)
+        self.receiver = BatchReceiver(sock, TOTAL_SIZE) # the loop made the socket non-blocking already
+        self.accept_queue = asyncio.Queue() # connections that completed the handshake but were not accepted yet
+        self.writable = asyncio.Event() # cleared while the transport asks us to stop writing
+        self.writable.set()
+        self.transport = None
+        self.scheduler = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        registry.gauge('udp_transport_buffer_bytes', "Bytes in the transport buffer not taken by the kernel yet", transport.get_write_buffer_size)
+        self.scheduler = LoopScheduler(asyncio.get_running_loop(), self.timer)
+
+    def datagram_received(self, data, addr):
+        moved = set() # connections whose window moved in this batch
+        for data, addr in [(data, addr), *self.receiver.drain()]:
+            found = self.demux(data, addr)
+            if found is not None:
+                conn, seg = found
+                if conn.handle_ack(seg):
+                    moved.add(conn)
+        for conn in moved:
+            conn.notify()
+
+    def error_received(self, exc):
+        log.warning("Transport error, %s", exc)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def transmit(self, conn, seg):
+        """
+        Send a segment of a connection and arm its retransmission timer
+        """
+        conn.sent_times[seg.seq] = time.perf_counter() # record send time to calculate RTT
+        self.transport.sendto(seg.encode(), conn.addr)
+        self.scheduler.schedule((conn.conn_id, seg.seq), seg, conn.rtt.timeout())
+
+    def send_parity(self, conn, seg):
+        self.transport.sendto(seg.encode(), conn.addr)
+
+    def send_control(self, seg, addr):
+        self.transport.sendto(seg.encode(), addr)
+
+    async def accept(self):
+        """
+        Wait until a client connects and return its AsyncConnection
+        """
+        return await self.accept_queue.get()
+
+class AsyncUDPClient(ReliableReceiver, asyncio.DatagramProtocol):
+    """
+    asyncio version of UDPClient, created by open_connection, with an awaitable receive.
+    Like the server, every wakeup drains the datagrams already queued on the socket and acks the whole batch once,
+    delayed acks are a loop timer.
+    """
+    def __init__(self, sock, host, port, ack_every = ACK_EVERY, ack_delay = ACK_DELAY, resume = b''):
+        ReliableReceiver.__init__(self, host, port, ack_every, ack_delay, resume)
+        self.receiver = BatchReceiver(sock, DATAGRAM_SIZE)
+        self.data_ready = asyncio.Event() # set when new segments are delivered
+        self.transport = None
+        self.loop = None
+        self.ack_timer = None # loop timer of the delayed ack
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.handshake()
+
+    def handshake(self):
+        """
+        Send CONNECT until the server answers
+        """
+        if not self.connected:
+            self.send_control(CONNECT)
+            self.loop.call_later(CONNECT_TIMEOUT, self.handshake)
+
+    def datagram_received(self, data, addr):
+        moved = False
+        urgent = False # out-of-order arrivals are acked right away so the server can detect the loss quickly
+        for data, addr in [(data, addr), *self.receiver.drain()]:
+            delivered, hurry = self.handle(data, addr)
+            moved = moved or delivered
+            urgent = urgent or hurry
+        if moved:
+            self.data_ready.set()
+        if urgent or self.ack_due():
+            self.flush()
+        elif self.pending and self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(self.ack_delay, self.flush)
+
+    def error_received(self, exc):
+        log.warning("Transport error, %s", exc)
+
+    def flush(self):
+        """
+        Send the pending ack
+        """
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.pending:
+            self.send_ack()
+
+    def transmit(self, seg):
+        self.transport.sendto(seg.encode(), self.addr)
+
+    async def receive(self, count = 1):
+        """
+        A TCP socket-like receive function that waits until count packets are received
+        """
+        while len(self.received) < count:
+            self.data_ready.clear()
+            await self.data_ready.wait()
+        return self.take(count)
+
+async def start_server(host, port, congestion = AIMD, sndbuf = None, rcvbuf = None, compression = NONE, fec = None):
+    """
+    Bind an AsyncUDPServer to (host, port) on the running loop
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    set_buffer_sizes(sock, sndbuf, rcvbuf)
+    sock.bind((host, port))
+    _, server = await asyncio.get_running_loop().create_datagram_endpoint(lambda: AsyncUDPServer(sock, congestion, compression, fec), sock=sock)
+    return server
+
+async def open_connection(host, port, ack_every = ACK_EVERY, ack_delay = ACK_DELAY, sndbuf = None, rcvbuf = None, resume = b''):
+    """
+    Connect an AsyncUDPClient to the server at (host, port) from an ephemeral port, the handshake continues in the background
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    set_buffer_sizes(sock, sndbuf, rcvbuf)
+    sock.bind(('', 0))
+    _, client = await asyncio.get_running_loop().create_datagram_endpoint(lambda: AsyncUDPClient(sock, host, port, ack_every, ack_delay, resume), sock=sock)
+    return client
+
+def run(main):
+    """
+    Run a coroutine on uvloop when it is installed and on the default event loop otherwise, nothing else depends on the loop type
+    """
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
+
+
+async def serve(conn, strategy):
+    """
+    Send every object to one client and close the connection, like server.serve
+    """
+    start = time.perf_counter()
+    packets = construct_segments(conn.resume, conn.bases, conn.codec, conn.compression, conn.shard)
+    names = {packet.name_id: packet.name for packet in packets}
+    for packet in packets:
+        await conn.send(packet)
+    await conn.drain()
+    report(conn, strategy, time.perf_counter() - start, names)
+    await conn.close()
+
+async def main_server(strategy, compression, fec, pacing = False):
+    server = await start_server(HOST, PORT, controller(strategy, pacing), compression=CODECS[compression], fec=fec)
+    tasks = set() # keep references so running tasks are not garbage collected
+    while True:
+        conn = await server.accept()
+        task = asyncio.get_running_loop().create_task(serve(conn, strategy + (" paced" if pacing else "")))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+async def main_client():
+    client = await open_connection(SERVER, PORT, resume=encode_resume({}, codecs=supported()))
+    assembler = Reassembler()
+    small_times = []
+    large_times = []
+    start = None
+    while len(small_times) < 10 or len(large_times) < 10:
+        for packet in await client.receive():
+            if start is None:
+                start = time.perf_counter()
+            obj = assembler.add(packet.data)
+            if obj is not None:
+                if received(obj.name, start, obj.started, obj.hexdigest(), large_times, small_times):
+                    obj.close()
+                else:
+                    obj.discard()
+    log.info("Average large time: {}".format(sum(large_times)/len(large_times)))
+    log.info("Average small time: {}".format(sum(small_times)/len(small_times)))
+    log.info("Total time: {}".format(time.perf_counter() - start))
+    log.info("Event loop: {}".format("uvloop" if uvloop is not None else "asyncio"))
+    if client.fec.recovered:
+        log.info("Rebuilt from parity: {} segments".format(client.fec.recovered))
+    if assembler.stats.blocks:
+        log.info("Decompression: {} blocks, {:.1f} ms CPU".format(assembler.stats.blocks, assembler.stats.cpu * 1000))
+
+
+if __name__ == "__main__":
+    exporter = configure() # LOG_LEVEL and METRICS_FILE, see metrics.py
+    # python aio.py server [strategy] [compression] [k/r] [pacing] on the server, python aio.py client on the client
+    if len(sys.argv) > 1 and sys.argv[1] == "server":
+        run(main_server(sys.argv[2] if len(sys.argv) > 2 else 'aimd', sys.argv[3] if len(sys.argv) > 3 else 'none', parse_fec(sys.argv[4] if len(sys.argv) > 4 else 'none'),
+                        parse_pacing(sys.argv[5] if len(sys.argv) > 5 else 'none')))
+    else:
+        run(main_client())
+        if exporter is not None:
+            exporter.stop()
@@ -0,0 +1,74 @@
+import selectors
+import socket
+
+RING_SIZE = 256 # number of preallocated receive buffers
+BATCH_SIZE = 64 # maximum number of datagrams handled per wakeup, must not exceed RING_SIZE
+
+def set_buffer_sizes(sock, sndbuf = None, rcvbuf = None):
+    """
+    Resize the kernel socket buffers, None keeps the system default
+    Larger buffers absorb bursts instead of dropping datagrams when the reader falls behind.
+    """
+    if sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+class BatchReceiver:
+    """
+    Drains as many datagrams as are queued on a non-blocking socket per wakeup, up to BATCH_SIZE.
+    Datagrams are received with recvfrom_into into a preallocated ring of buffers, so no bytes object is allocated per datagram.
+    The returned views stay valid until the ring wraps around (RING_SIZE datagrams later),
+    callers have to copy anything they keep for longer than that.
+    """
+    def __init__(self, sock, size, ring_size = RING_SIZE, batch_size = BATCH_SIZE):
+        sock.setblocking(False)
+        self.socket = sock
+        self.views = [memoryview(bytearray(size)) for _ in range(ring_size)]
+        self.next = 0 # next free buffer in the ring
+        self.batch_size = min(batch_size, ring_size)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def receive(self, timeout = None):
+        """
+        Wait up to timeout seconds (forever if None) for datagrams, then return all that are ready as (view, address) pairs
+        An empty list means the timeout expired.
+        """
+        if not self.selector.select(timeout):
+            return []
+        return self.drain()
+
+    def drain(self):
+        """
+        Return the datagrams that are already queued without waiting, e.g. right after an event loop reported one
+        """
+        batch = []
+        while len(batch) < self.batch_size:
+            view = self.views[self.next]
+            try:
+                n, addr = self.socket.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break # socket drained
+            batch.append((view[:n], addr))
+            self.next = (self.next + 1) % len(self.views)
+        return batch
+
+class BatchSender:
+    """
+    Sends on a non-blocking socket, waiting for buffer space instead of failing when the kernel send buffer is full.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_WRITE)
+
+    def send(self, buffers, addr):
+        """
+        Scatter-gather send of a list of buffers as a single datagram
+        """
+        while True:
+            try:
+                return self.socket.sendmsg(buffers, [], 0, addr)
+            except (BlockingIOError, InterruptedError):
+                self.selector.select() # wait until the send buffer drains
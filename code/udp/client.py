@@ -1,139 +1,351 @@
 import socket
 from threading import Thread, Lock
-from segment import Segment, HEADER_SIZE, TOTAL_SIZE, WINDOW_SIZE
+from segment import Segment, HEADER_SIZE, DATAGRAM_SIZE, WINDOW_SIZE, DATA, PARITY, ACK, CONNECT, ACCEPT, FIN, FIN_ACK, sack_bitmap, unwrap
 import time
+import random
 import csv
-from packet import SegmentedPacket
-from hashlib import md5
+from packet import Reassembler, encode_resume
+import shared # code/common on the path, see shared.py
+from compress import supported
+from fec import ParityDecoder
+from ring import SequenceRing
+from metrics import registry, configure
+from batchio import BatchReceiver, BatchSender, set_buffer_sizes
+import struct
+import sys
+import os
+import logging
 
-class UDPClient(Thread):
+ACK_EVERY = 32 # send an ack after this many segments
+ACK_DELAY = 0.01 # or after this many seconds since the first unacked segment, whichever comes first
+CONNECT_TIMEOUT = 0.5 # resend CONNECT after this many seconds without an answer
+SERVER = os.environ.get("SERVER_HOST", "server") # Set to the IP address of the server eth0 if you do not use docker compose
+PORT = int(os.environ.get("SERVER_PORT", 5000)) # both can be set from the environment, see bench/bench.py
+log = logging.getLogger(__name__)
+segments_received = registry.counter('udp_client_segments_received_total', "Data segments received, new ones and duplicates")
+duplicates = registry.counter('udp_client_duplicates_total', "Data segments received again, their ack was lost or late")
+out_of_window = registry.counter('udp_client_out_of_window_total', "Data segments dropped above the receive window")
+unknown = registry.counter('udp_client_segments_unknown_total', "Datagrams dropped from another address or connection, or malformed")
+rebuilt_segments = registry.counter('udp_client_rebuilt_total', "Data segments rebuilt from parity")
+acks_sent = registry.counter('udp_client_acks_sent_total', "Acks sent to the server")
+completion = registry.histogram('udp_client_object_completion_seconds', "Time from the start of the transfer to the last segment of each object")
+
+class ReliableReceiver:
     """
-    Our TCP-like client class that handles the receiving of segments and sending of acks to achieve in-order and reliable delivery.
-    Interfaces are similar to the socket library, with a blocking receive function.
+    Receiving side of the protocol, shared by the threaded UDPClient and the asyncio AsyncUDPClient (see aio.py).
+    It only keeps the state and decides what to deliver and when to ack, subclasses move the datagrams with transmit.
     We implemented selective repeat as our windowing strategy to avoid retransmitting packets that have already been received.
+    Acks are cumulative with a SACK bitmap of the out-of-order segments, and are delayed until ack_every segments
+    arrived or ack_delay seconds passed, so a single ack covers many segments. ack_every=1 acks every segment.
+    While there are holes in the window, every batch is acked right away so the server sees the SACK evidence without delay.
+    The client connects to the server with a CONNECT handshake under a random connection id, the server serves many clients
+    on one port and tells them apart by that id. The server ends the connection with a FIN once everything is acked.
+    Acks follow the connection sequence numbers, but delivery follows the streams: a segment is handed to receive as soon as
+    the earlier segments of its own stream arrived, so a lost segment of one object does not hold back the others.
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, ack_every = ACK_EVERY, ack_delay = ACK_DELAY, resume = b'', conn_id = None, shard = None):
         self.host = host
         self.port = port
-        self.socket = socket.socket(socket.AF_INET,
-                                    socket.SOCK_DGRAM)
-        self.socket.bind((self.host, self.port))
-        self.packets = {} # dict to store acked packets
-        self.received = [] # list to store received packets
-        self.ack = 0 # ack number
+        self.resume = resume # sent with CONNECT, fragments kept from an earlier transfer (see Reassembler and encode_resume)
+        self.packets = SequenceRing(WINDOW_SIZE) # sequence numbers received above the window base
+        self.received = [] # list to store received packets, in order within each stream
+        self.stream_next = {} # stream id -> offset of the next segment to deliver
+        self.held = {} # (stream id, offset) -> segment that arrived before the earlier segments of its stream
+        self.ack = 0 # last cumulative ack sent
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.pending = 0 # segments received since the last ack
+        self.pending_since = 0 # time the first of them was received
+        self.highest = -1 # highest sequence number received, bounds the SACK bitmap
+        self.advertised = WINDOW_SIZE # receive window sent with the last ack
         self.window_size = WINDOW_SIZE 
         self.window_base = 0
-        self.lock = Lock() # lock to protect the packets dict
+        self.lock = Lock() # lock to protect the packets ring
+        self.addr = (socket.gethostbyname(host), port) # server address, segments from anywhere else are dropped
+        self.conn_id = conn_id if conn_id is not None else random.getrandbits(32) # connection id, tells our segments apart from other clients' on the server
+        self.shard = shard # (index, count) of the objects to fetch on this connection, None for all, see shard.py
+        self.connected = False # set once the server accepted the connection
+        self.last_connect = 0 # time the last CONNECT was sent
+        self.finished = False # set once the server sent its FIN
+        self.fec = ParityDecoder() # rebuilds lost segments if the server sends parity, see fec.py
+        registry.gauge('udp_client_received_depth', "Delivered segments the application has not read yet", lambda: len(self.received))
+        registry.gauge('udp_client_held_segments', "Segments held until the earlier segments of their stream arrive", lambda: len(self.held))
+        registry.gauge('udp_client_window_lag_segments', "Segments between the window base and the highest one received", lambda: max(self.highest + 1 - self.window_base, 0))
+
+    def transmit(self, seg):
+        """
+        Send a segment to the server, implemented by the subclasses
+        """
+        raise NotImplementedError
+
+    def handle(self, data, address):
+        """
+        Handle one datagram, returns (moved, urgent): whether new segments were delivered and whether the ack should not be delayed
+        Called with the lock held.
+        """
+        if self.addr != address:
+            unknown.inc()
+            log.debug("Received packet from unknown source, expected: %s, received: %s", self.addr, address)
+            return False, False
+        try:
+            seg = Segment.decode(bytes(data)) # copy out of the receive buffer, the segment outlives it
+        except (ValueError, struct.error) as e:
+            unknown.inc()
+            log.warning("Malformed segment, %s", e)
+            return False, False
+        if seg.conn_id != self.conn_id:
+            unknown.inc()
+            log.debug("Received packet for another connection, %s", seg.conn_id)
+            return False, False
+        self.connected = True # any segment of our connection means the server accepted it, even if the ACCEPT was lost
+        if seg.kind == ACCEPT:
+            return False, False
+        if seg.kind == FIN:
+            self.finished = True
+            self.send_control(FIN_ACK) # answer every FIN, the previous FIN_ACK may have been lost
+            return False, False
+        seg.seq = unwrap(seg.seq, self.window_base) # the 32 bits sent, the window base is within the window of it
+        if seg.kind == PARITY:
+            moved = urgent = False
+            for rebuilt in self.fec.add_parity(seg, self.is_received):
+                rebuilt_segments.inc()
+                rebuilt_moved, rebuilt_urgent = self.receive_data(rebuilt)
+                moved, urgent = moved or rebuilt_moved, urgent or rebuilt_urgent
+            return moved, urgent
+        if seg.kind != DATA:
+            log.warning("Received non-data segment, %s", seg.seq)
+            return False, False
+        return self.receive_data(seg)
+
+    def receive_data(self, seg):
+        """
+        Handle a data segment, received or rebuilt from parity, returns (moved, urgent) like handle
+        """
+        segments_received.inc()
+        if seg.seq >= self.window_base + self.window_size: # selective repeat
+            out_of_window.inc()
+            log.debug("Segment out of window, %s, %s, %s", seg.seq, self.window_base, self.window_size)
+            return False, False
+        moved = False
+        urgent = seg.seq != self.window_base or seg.ack_now # a hole, a duplicate or the server is waiting for this ack
+        rebuilt = []
+        if seg.seq >= self.window_base and seg.seq not in self.packets:
+            self.packets.add(seg.seq)
+            self.highest = max(self.highest, seg.seq)
+            moved = self.deliver(seg)
+            rebuilt = self.fec.add_data(seg, self.is_received) # may complete a parity group missing one segment
+            rebuilt_segments.inc(len(rebuilt))
+        else:
+            duplicates.inc()
+        if seg.seq == self.window_base:
+            self.window_base = self.packets.pop_run(self.window_base) # advance window until unack'd packet
+            self.fec.prune(self.window_base)
+            urgent = urgent or self.window_base <= self.highest # filled a hole but another one remains
+        if self.pending == 0:
+            self.pending_since = time.perf_counter()
+        self.pending += 1 # duplicates count too, their ack was probably lost
+        for seg in rebuilt:
+            rebuilt_moved, rebuilt_urgent = self.receive_data(seg)
+            moved, urgent = moved or rebuilt_moved, urgent or rebuilt_urgent
+        return moved, urgent
+
+    def is_received(self, seq):
+        return seq < self.window_base or seq in self.packets
+
+    def deliver(self, seg):
+        """
+        Deliver seg and the held segments following it if it is the next one of its stream, otherwise hold it
+        Returns whether anything was delivered. Called with the lock held.
+        """
+        stream = seg.stream
+        expected = self.stream_next.get(stream, 0)
+        seg.offset = unwrap(seg.offset, expected)
+        if seg.offset != expected:
+            self.held[(stream, seg.offset)] = seg
+            return False
+        while seg is not None:
+            self.received.append(seg)
+            expected += 1
+            if seg.end:
+                self.stream_next.pop(stream, None) # stream complete, forget it
+                return True
+            seg = self.held.pop((stream, expected), None)
+        self.stream_next[stream] = expected
+        return True
+
+    def ack_due(self):
+        """
+        Whether enough segments arrived or the oldest of them waited long enough to send the delayed ack
+        """
+        return self.pending >= self.ack_every or (self.pending and time.perf_counter() - self.pending_since >= self.ack_delay)
+
+    def send_ack(self):
+        """
+        Send a cumulative ack for the window base with a bitmap of the out-of-order segments already held
+        and the receive window left for the server
+        """
+        with self.lock:
+            self.ack = self.window_base
+            bitmap = sack_bitmap(self.window_base, self.packets.held(self.window_base + 1, self.highest + 1), self.highest)
+            window = max(self.window_size - len(self.received) - len(self.held), 0) # delivered segments the application has not read yet and held ones use up the buffer
+            self.advertised = window
+        self.transmit(Segment(self.ack, bitmap, kind=ACK, window=window, conn_id=self.conn_id))
+        acks_sent.inc()
+        self.pending = 0
+
+    def send_control(self, kind):
+        """
+        Send a handshake segment of our connection to the server
+        """
+        if kind != CONNECT:
+            self.transmit(Segment(0, kind=kind, conn_id=self.conn_id))
+            return
+        self.last_connect = time.perf_counter()
+        index, count = self.shard or (0, 0)
+        self.transmit(Segment(0, self.resume, kind=CONNECT, conn_id=self.conn_id, stream=index, offset=count))
+
+    def take(self, count):
+        """
+        Remove the first count delivered segments, they must be there
+        """
+        with self.lock:
+            ret = self.received[:count]
+            self.received = self.received[count:]
+        if self.connected and not self.finished and self.advertised < self.window_size // 4:
+            self.send_ack() # window update, the server may be stalled on a small advertised window, unless it already said FIN
+        return ret
+
+class UDPClient(ReliableReceiver, Thread):
+    """
+    Our TCP-like client class that handles the receiving of segments and sending of acks to achieve in-order and reliable delivery.
+    Interfaces are similar to the socket library, with a blocking receive function.
+    Segments are drained from the socket in batches and handled under a single lock acquisition.
+    """
+    def __init__(self, host, port, ack_every = ACK_EVERY, ack_delay = ACK_DELAY, sndbuf = None, rcvbuf = None, resume = b'', conn_id = None, shard = None):
+        ReliableReceiver.__init__(self, host, port, ack_every, ack_delay, resume, conn_id, shard)
+        self.socket = socket.socket(socket.AF_INET,
+                                    socket.SOCK_DGRAM)
+        set_buffer_sizes(self.socket, sndbuf, rcvbuf)
+        self.socket.bind(('', 0)) # ephemeral port, the server learns it from the CONNECT
+        self.receiver = BatchReceiver(self.socket, DATAGRAM_SIZE) # makes the socket non-blocking, segments are drained in batches
+        self.batch_sender = BatchSender(self.socket)
         self.notify_receiver = Lock() # lock to notify receiver thread that window has moved (new packets are ready)
-        self.addr = None # attached client address
-        super().__init__()
+        Thread.__init__(self)
     
     def run(self):
         with self.socket as s:
             while True:
-                data, address = s.recvfrom(TOTAL_SIZE)
-                if self.addr is None:
-                    self.addr = address
-                elif self.addr != address:
-                    print("Possible fault: Received packet from unknown source, expected: {}, received: {}".format(self.addr, address))
+                if not self.connected and time.perf_counter() - self.last_connect >= CONNECT_TIMEOUT:
+                    self.send_control(CONNECT) # first CONNECT or the previous one or its ACCEPT was lost
+                batch = self.receiver.receive(self.ack_delay) # wake up after ack_delay to flush delayed acks even if no segment arrives
+                if not batch:
+                    if self.pending:
+                        self.send_ack()
                     continue
-                seg = Segment.decode(data)
-                if seg.seq < self.window_base + self.window_size: # selective repeat
-                    with self.lock:
-                        self.packets[seg.seq] = seg
-                        self.ack = seg.seq
-                        self.send_ack() # send ack for received packet
-                        if seg.seq == self.window_base:
-                            while self.window_base in self.packets:
-                                self.received.append(self.packets[self.window_base])
-                                self.window_base += 1 # advance window until unack'd packet
-                            try:
-                                self.notify_receiver.release() # notify that the window is moved and new packets can be received
-                            except:
-                                pass
-                else:
-                    print("Possible fault: Segment out of window, {}, {}, {}".format(seg.seq, self.window_base, self.window_size))
+                moved = False
+                urgent = False # out-of-order arrivals are acked right away so the server can detect the loss quickly
+                with self.lock: # one lock acquisition for the whole batch
+                    for data, address in batch:
+                        delivered, hurry = self.handle(data, address)
+                        moved = moved or delivered
+                        urgent = urgent or hurry
+                if moved or self.finished:
+                    try:
+                        self.notify_receiver.release() # notify that the window is moved and new packets can be received
+                    except:
+                        pass
+                if urgent or self.ack_due():
+                    self.send_ack()
 
-    def send_ack(self):
-        self.socket.sendto(Segment(self.ack).encode().encode(), self.addr) # send ack for received packet
+    def transmit(self, seg):
+        self.batch_sender.send(seg.buffers(), self.addr)
     
     def receive(self, count = 1):
         """
         A TCP socket-like receive function that blocks (with a lock that is notified
-        by the receiver thread) until count packets are received
+        by the receiver thread) until count packets are received, or returns fewer once the server ended the connection
         """
-        while len(self.received) < count:
+        while len(self.received) < count and not self.finished:
             self.notify_receiver.acquire()
-        ret = self.received[:count]
-        with self.lock:
-            self.received = self.received[count:]
-        return ret
+        return self.take(count)
+
 
+def received(name, start, started, md5sum, large_times, small_times):
+    """
+    Report an object that arrived complete, start is the time the transfer started and started the time its first fragment arrived
+    Appends its time to large_times or small_times, returns whether its md5 matched.
+    """
+    now = time.perf_counter()
+    completion.observe(now - start)
+    log.info("Name {}".format(name))
+    if name.startswith("large"):
+        large_times.append(now - start)
+        log.info("Large file time: {}".format(now - started))
+    elif name.startswith("small"):
+        log.info("Small file time: {}".format(now - started))
+        small_times.append(now - start)
+    log.info("Time taken: {}".format(now - start))
+    with open(f"../objects/{name}.md5", "r") as f:
+        md5sum2 = f.read().strip()
+    log.info(f"RESULT: {md5sum == md5sum2} MD5 sums: {md5sum} {md5sum2}")
+    return md5sum == md5sum2
+
+def report(large_times, small_times, total, stats, recovered):
+    """
+    Print the averages once every object arrived and add them to results.csv
+    """
+    avg_large = sum(large_times)/len(large_times)
+    avg_small = sum(small_times)/len(small_times)
+    log.info("Average large time: {}".format(avg_large))
+    log.info("Average small time: {}".format(avg_small))
+    if stats.blocks:
+        log.info("Decompression: {} blocks, {:.1f} ms CPU".format(stats.blocks, stats.cpu * 1000))
+    if recovered:
+        log.info("Rebuilt from parity: {} segments".format(recovered))
+    with open("results.csv", "r") as f:
+        reader = csv.reader(f)
+        rows = list(reader)
+    if len(rows) == 0:
+        rows = [[], [], []]
+    rows[0].append(avg_large)
+    rows[1].append(avg_small)
+    rows[2].append(total)
+    with open("results.csv", "w") as f:
+        writer = csv.writer(f)
+        writer.writerows(rows)
 
 
 if __name__ == "__main__":
-    client = UDPClient("172.30.0.3", 5000)
-    client.start()
-    # This concludes the implementation, the rest of the code is just to handle receiving the files and calculating the md5sum
-    packets = {}
-    times = {}
+    # python client.py [directory|-] [connections]
+    exporter = configure() # LOG_LEVEL and METRICS_FILE, see metrics.py
+    directory = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '-' else None # keep the objects in this directory and resume from it after a restart, - for none
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 1 # one process per connection, see shard.py
+    if connections > 1:
+        from shard import receive_sharded
+        receive_sharded(directory, connections)
+        if exporter is not None:
+            exporter.stop()
+        exit(0)
+    assembler = Reassembler(directory) # reads the journals of an earlier run
     large_times = []
     small_times = []
+    client = UDPClient(SERVER, PORT, resume=encode_resume(assembler.held, [digest for digest, _ in assembler.bases], supported())) # the server skips the fragments we already hold
+    client.start()
+    # This concludes the implementation, the rest of the code is just to handle receiving the files and calculating the md5sum
     start = None
     while True:
         for packet in client.receive():
             if start is None:
                 start = time.perf_counter()
-            name, curr, end, total, data = SegmentedPacket.decode(packet.data)
-            if name not in packets:
-                packets[name] = []
-                times[name] = time.perf_counter()
-            packets[name].append(data.decode())
-            if len(packets[name]) == end + 1:
-                payload = "".join(packets[name])[:total]
-                print("Name {}".format(name))
-                if name.decode().startswith("large"):
-                    large_times.append(time.perf_counter() - start)
-                    print("Large file time: {}".format(time.perf_counter() - times[name]))
-                elif name.decode().startswith("small"):
-                    print("Small file time: {}".format(time.perf_counter() - times[name]))
-                    small_times.append(time.perf_counter() - start)
-                print("Time taken: {}".format(time.perf_counter() - start))
-                md5sum = md5(payload.encode()).hexdigest()
-                with open(f"../objects/{name.decode()}.md5", "r") as f:
-                    md5sum2 = f.read().strip()
-                print(f"RESULT: {md5sum == md5sum2} MD5 sums: {md5sum} {md5sum2}")
+            obj = assembler.add(packet.data) # fragments are written in place and hashed as they arrive
+            if obj is not None:
+                md5sum = obj.hexdigest() # already computed while the fragments arrived
+                if received(obj.name, start, obj.started, md5sum, large_times, small_times):
+                    obj.close()
+                else:
+                    obj.discard() # start over next time
                 if len(large_times) == 10 and len(small_times) == 10:
-                    avg_large = sum(large_times)/len(large_times)
-                    avg_small = sum(small_times)/len(small_times)
-                    total = time.perf_counter() - start
-                    print("Average large time: {}".format(sum(large_times)/len(large_times)))
-                    print("Average small time: {}".format(sum(small_times)/len(small_times)))
-                    with open("results.csv", "r") as f:
-                        reader = csv.reader(f)
-                        rows = list(reader)
-                    if len(rows) == 0:
-                        rows = [[], [], []]
-                    rows[0].append(avg_large)
-                    rows[1].append(avg_small)
-                    rows[2].append(total)
-                    with open("results.csv", "w") as f:
-                        writer = csv.writer(f)
-                        writer.writerows(rows)
-
+                    report(large_times, small_times, time.perf_counter() - start, assembler.stats, client.fec.recovered)
+                    if exporter is not None:
+                        exporter.stop() # the last snapshot holds every object
                     exit(0)
-
-                
-
-
-
-            
-        
-                
-            
-
-
-
-
-
-    
@@ -0,0 +1,117 @@
+from functools import partial
+from segment import WINDOW_SIZE
+
+INITIAL_WINDOW = 10 # segments, like TCP's initial window
+MIN_WINDOW = 2 # never shrink below this on loss
+BETA_AIMD = 0.5 # multiplicative decrease of AIMD
+BETA_CUBIC = 0.7 # multiplicative decrease of CUBIC
+C_CUBIC = 0.4 # CUBIC scaling constant
+
+class FixedWindow:
+    """
+    Congestion controller that keeps the window constant, the original behaviour of blasting a full WINDOW_SIZE.
+    All controllers share this interface: UDPServer asks window() before sending a new segment,
+    reports acked segments with on_ack and lost ones with on_loss, and sleeps pacing_interval between sends.
+    """
+    def __init__(self, window = WINDOW_SIZE, pacing = False):
+        self.cwnd = window
+        self.pacing = pacing
+
+    def window(self):
+        """
+        Number of segments that may be in flight
+        """
+        return max(int(self.cwnd), 1)
+
+    def on_ack(self, count, now):
+        """
+        count new segments were acked
+        """
+        pass
+
+    def on_loss(self, seq, next_seq, now, timeout = False):
+        """
+        Segment seq was detected lost while next_seq was the next unsent sequence number, timeout tells whether the
+        retransmission timer detected it (as opposed to the ack stream)
+        """
+        pass
+
+    def pacing_interval(self, rtt):
+        """
+        Seconds to wait between two sends so that a window is spread over an RTT, 0 disables pacing
+        """
+        if not self.pacing:
+            return 0
+        return rtt / self.window()
+
+class AIMD(FixedWindow):
+    """
+    TCP Reno-like slow start and additive increase, multiplicative decrease.
+    The window is only reduced once per window of data: losses of segments sent before the last reduction are ignored.
+    """
+    def __init__(self, initial = INITIAL_WINDOW, ssthresh = WINDOW_SIZE, pacing = False):
+        super().__init__(initial, pacing)
+        self.ssthresh = ssthresh
+        self.recovery = 0 # segments below this were sent before the last reduction
+
+    def on_ack(self, count, now):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += count # slow start, doubles every RTT
+        else:
+            self.cwnd += count / self.cwnd # congestion avoidance, one segment per RTT
+        self.cwnd = min(self.cwnd, WINDOW_SIZE)
+
+    def reduce(self, now):
+        self.ssthresh = max(self.cwnd * BETA_AIMD, MIN_WINDOW)
+        return self.ssthresh
+
+    def on_loss(self, seq, next_seq, now, timeout = False):
+        if seq < self.recovery:
+            return # already reacted to this window's losses
+        self.recovery = next_seq
+        self.cwnd = self.reduce(now)
+        if timeout:
+            self.cwnd = MIN_WINDOW # retransmission timeout, restart with slow start
+
+class Cubic(AIMD):
+    """
+    CUBIC-like growth: after a loss the window grows along a cubic curve that plateaus around the window of the last loss (w_max),
+    so it recovers quickly to the previous operating point and then probes carefully above it.
+    """
+    def __init__(self, initial = INITIAL_WINDOW, ssthresh = WINDOW_SIZE, pacing = False):
+        super().__init__(initial, ssthresh, pacing)
+        self.w_max = 0 # window at the last reduction
+        self.epoch = None # time of the last reduction
+        self.k = 0 # time to reach w_max again
+
+    def on_ack(self, count, now):
+        if self.cwnd < self.ssthresh or self.epoch is None:
+            super().on_ack(count, now)
+            return
+        t = now - self.epoch
+        target = C_CUBIC * (t - self.k) ** 3 + self.w_max
+        if target > self.cwnd:
+            increase = (target - self.cwnd) / self.cwnd * count # approach the curve within about an RTT
+        else:
+            increase = 0.01 * count / self.cwnd # stay close to the plateau
+        self.cwnd += max(increase, count / self.cwnd) # never grow slower than AIMD would (TCP-friendly region)
+        self.cwnd = min(self.cwnd, WINDOW_SIZE)
+
+    def reduce(self, now):
+        self.w_max = self.cwnd
+        self.epoch = now
+        self.k = (self.w_max * (1 - BETA_CUBIC) / C_CUBIC) ** (1 / 3)
+        self.ssthresh = max(self.cwnd * BETA_CUBIC, MIN_WINDOW)
+        return self.ssthresh
+
+STRATEGIES = {
+    'fixed': FixedWindow,
+    'aimd': AIMD,
+    'cubic': Cubic,
+}
+
+def controller(strategy, pacing = False):
+    """
+    Factory of the congestion controller of each connection, one of STRATEGIES, pacing its sends or not
+    """
+    return partial(STRATEGIES[strategy], pacing=pacing)
@@ -0,0 +1,412 @@
+import time
+import logging
+from threading import Thread, Lock, Event
+import struct
+from segment import Segment, WINDOW_SIZE, ACK, CONNECT, ACCEPT, FIN, FIN_ACK, sack_sequences, unwrap
+from congestion import AIMD
+from rtt import RTTEstimator
+from streams import Stream, StreamScheduler
+from packet import decode_resume
+import shared # code/common on the path, see shared.py
+from compress import NONE, CompressionStats, negotiate
+from fec import ParityEncoder
+from ring import SequenceRing
+from metrics import registry
+
+DUPTHRESH = 3 # a segment is considered lost once this many segments sent after it are acked
+FIN_RETRIES = 5 # how many times a FIN is sent before giving up on the client
+MAX_TIMEOUTS = 10 # consecutive retransmission timeouts without an ack before the client is considered gone, 40 to 75 s at the default RTO bounds
+
+log = logging.getLogger(__name__)
+segments_sent = registry.counter('udp_segments_sent_total', "Distinct data segments sent")
+timeout_retransmits = registry.counter('udp_timeout_retransmits_total', "Segments resent after their retransmission timeout")
+fast_retransmits = registry.counter('udp_fast_retransmits_total', "Segments resent from SACK evidence before their timeout")
+parity_sent = registry.counter('udp_parity_segments_sent_total', "FEC parity segments sent")
+acks_received = registry.counter('udp_acks_received_total', "ACK segments received")
+acks_duplicate = registry.counter('udp_acks_duplicate_total', "ACKs that acked nothing new")
+acks_out_of_window = registry.counter('udp_acks_out_of_window_total', "ACKs beyond the send window, dropped")
+segments_malformed = registry.counter('udp_segments_malformed_total', "Datagrams that did not decode as a segment")
+segments_unknown = registry.counter('udp_segments_unknown_connection_total', "Segments for a connection that is closed or never existed")
+rtt_seconds = registry.histogram('udp_rtt_seconds', "RTT samples of the acked segments that were sent once")
+connections_aborted = registry.counter('udp_connections_aborted_total', "Connections given up after MAX_TIMEOUTS timeouts without an ack")
+completion_seconds = registry.histogram('udp_object_completion_seconds', "Time from send until the last segment of an object was acked")
+
+class Connection:
+    """
+    Sender side state of a single client, created by UDPServer when a client connects.
+    Everything that used to live on the server (window, acked segments, RTT estimation, congestion control) is kept per connection,
+    so clients with different paths do not disturb each other, while the socket, the ack receiver, the queue sender and the timer are shared.
+    The interface is the TCP-like send function of the server, plus close to tear the connection down.
+    Every object sent is its own stream, the StreamScheduler decides which stream the next segment is taken from.
+    """
+    def __init__(self, server, conn_id, addr, congestion = None, resume = None, bases = None, codec = NONE, fec = None, shard = None):
+        self.server = server
+        self.shard = shard # (index, count): only the objects of this shard are sent, the client fetches the others on other connections
+        self.fec = ParityEncoder(*fec) if fec is not None else None # (k, r): r parity segments after every k data segments
+        self.parity_segments = 0
+        self.codec = codec # compression of the data fragments, negotiated in the CONNECT
+        self.compression = CompressionStats(codec) # ratio and CPU time of the compression of this connection's data
+        self.resume = resume if resume is not None else {} # name -> (digest, fragment ranges) the client kept from an earlier connection
+        self.bases = bases if bases is not None else [] # digests of the complete objects the client holds, see ManifestStore
+        self.conn_id = conn_id
+        self.addr = addr # address of the client
+        self.seq = 0
+        self.window_size = WINDOW_SIZE
+        self.window_base = 0
+        self.lock = Lock() # lock to protect the packets ring
+        self.notify_sender = Lock() # lock to notify sender thread that window has moved
+        self.packets = SequenceRing(self.window_size) # sequence numbers acked above the window base and the time they were acked
+        self.sent_times = SequenceRing(self.window_size) # time each unacked segment was last (re)sent, to calculate RTT
+        self.retransmitted = set() # unacked segments that were sent more than once, their acks are ambiguous RTT samples (Karn's algorithm), few and discarded on ack
+        self.streams = StreamScheduler() # open streams, their segments are produced lazily when the window allows
+        self.stream_of = SequenceRing(self.window_size) # unacked sequence number -> stream it belongs to
+        self.completed = [] # streams whose segments are all acked, in completion order
+        self.rtt = RTTEstimator() # SRTT/RTTVAR based retransmission timeout
+        self.last_backoff = 0 # time of the last RTO backoff, the timeout is backed off once per flight of segments
+        self.timeouts = 0 # backoffs since the last ack that acked something, see MAX_TIMEOUTS
+        self.aborted = False # set once the client is considered gone, see abort
+        self.highest_acked = -1 # highest sequence number acked so far
+        self.fast_retransmitted = set() # holes already retransmitted from ack evidence, further losses are left to the timer
+        self.fast_retransmits = 0 # retransmissions triggered by the ack stream instead of a timeout
+        self.congestion = congestion if congestion is not None else AIMD()
+        self.rwnd = WINDOW_SIZE # receive window advertised by the client
+        self.sent_segments = 0 # distinct segments sent
+        self.retransmitted_segments = 0 # retransmissions, comparable across congestion controllers
+        self.closed = Event() # set when the client acknowledged our FIN
+        self.start()
+
+    def start(self):
+        Thread(target=self.sender, daemon=True).start()
+
+    def handle_ack(self, seg):
+        """
+        Mark everything covered by a cumulative ack and its SACK bitmap as acked, returns whether anything new was acked
+        Called with the lock held.
+        """
+        ack = unwrap(seg.seq, self.window_base) # cumulative ack, every sequence number below it is received
+        acks_received.inc()
+        if ack < self.window_base:
+            acks_duplicate.inc() # reordered or repeated, not worth a log line on the hot path
+            return False
+        end = min(self.window_base + self.window_size, self.seq) # never beyond what was sent
+        if ack > end:
+            acks_out_of_window.inc()
+            log.debug("Received ack out of window, %d, base %d", ack, self.window_base)
+            return False
+        sack = seg.data[:(end - ack + 7) // 8] # a longer bitmap only covers segments never sent
+        now = time.perf_counter()
+        acked = self.packets.missing(self.window_base, ack)
+        acked.extend(i for i in sack_sequences(ack, sack) if i < end and i not in self.packets) # selectively acked segments above the cumulative ack
+        if not acked:
+            acks_duplicate.inc()
+            return False
+        self.packets.fill(acked, now) # add ack'd packets in bulk
+        self.timeouts = 0
+        samples = [i for i in acked if i not in self.retransmitted]
+        if samples:
+            sent = self.sent_times.get(max(samples)) # the newest acked segment is the one that most likely triggered this ack
+            if sent is not None:
+                self.rtt.sample(now - sent)
+                rtt_seconds.observe(now - sent)
+        for stream in self.stream_of.pop_many(acked):
+            if stream is not None:
+                stream.unacked -= 1
+                if stream.unacked == 0 and stream.remaining() == 0:
+                    stream.completed = now
+                    self.completed.append(stream)
+                    completion_seconds.observe(now - stream.added)
+                    stream.future.set_result(now - stream.added)
+        self.sent_times.pop_many(acked)
+        self.retransmitted.difference_update(acked)
+        self.fast_retransmitted.difference_update(acked)
+        self.server.scheduler.cancel_all([(self.conn_id, i) for i in acked]) # ACK received, no need to retransmit
+        self.rwnd = seg.window
+        self.congestion.on_ack(len(acked), now)
+        self.highest_acked = max(self.highest_acked, max(acked))
+        self.window_base = self.packets.pop_run(self.window_base) # advance window until unack'd packet, the slots below it are free for base + window_size
+        if self.fec is not None:
+            self.fec.prune(self.window_base)
+        self.fast_retransmit(now)
+        return True # either the window moved or fewer segments are in flight
+
+    def notify(self):
+        try:
+            self.notify_sender.release() # notify that the window is moved and new packets can be sent
+        except:
+            pass
+
+    def fast_retransmit(self, now):
+        """
+        Retransmit holes right away once DUPTHRESH segments above them are acked instead of waiting for their timer, like TCP fast retransmit with SACK
+        Called with the lock held.
+        """
+        if self.highest_acked <= self.window_base:
+            return # no holes
+        holes = self.packets.missing(self.window_base, self.highest_acked)
+        for above_holes, i in enumerate(reversed(holes)):
+            above = self.highest_acked - i - above_holes # acked segments above this hole, highest_acked is one
+            if above >= DUPTHRESH and i not in self.fast_retransmitted and self.repair_hopeless(i):
+                segment = self.server.scheduler.take((self.conn_id, i)) # disarm its timer, queue_sender arms a new one when it is resent
+                if segment is None:
+                    continue # the timer already fired and queued the retransmission
+                self.fast_retransmitted.add(i)
+                self.retransmitted.add(i)
+                self.congestion.on_loss(i, self.seq, now)
+                self.fast_retransmits += 1
+                self.retransmitted_segments += 1
+                fast_retransmits.inc()
+                segment.ack_now = True
+                self.server.transmit(self, segment)
+
+    def repair_hopeless(self, seq):
+        """
+        Whether the client had its chance to rebuild seq from parity: its group is unprotected, or DUPTHRESH segments sent
+        after the parities of its group are acked, so the parities most likely arrived and did not cover the loss
+        """
+        if self.fec is None:
+            return True
+        end = self.fec.protected(seq)
+        return end is None or self.highest_acked >= end + DUPTHRESH - 1
+
+    def protect(self, seg):
+        """
+        Send the parity segments due after a newly numbered data segment
+        """
+        if self.fec is not None:
+            self.send_parity(self.fec.add(seg))
+
+    def send_parity(self, parities):
+        for parity in parities:
+            self.server.send_parity(self, parity)
+            self.parity_segments += 1
+            parity_sent.inc()
+
+    def in_flight(self):
+        """
+        Number of segments sent but not acked yet, the segments acked above the window base are in packets
+        """
+        return self.seq - self.window_base - len(self.packets)
+
+    def sender(self):
+        """
+        Thread that only handles constructing segments from the streams opened by the send function.
+        New segments are sent while they fit in the selective repeat window, the congestion window and the advertised receive window.
+        """
+        next_send = 0
+        while True:
+            self.notify_sender.acquire() # wait until window is moved or segments are acked
+            if self.aborted:
+                return
+            while self.window_open():
+                item = self.streams.take() # next segment of the highest priority stream
+                if item is None:
+                    if self.fec is not None:
+                        self.send_parity(self.fec.flush(self.conn_id)) # out of data, protect the partial group
+                    item = self.streams.get()
+                if item is None:
+                    return # connection closed
+                interval = self.congestion.pacing_interval(self.rtt.rtt())
+                if interval:
+                    now = time.perf_counter()
+                    if next_send > now:
+                        time.sleep(next_send - now) # pace sends over the RTT instead of sending the window in one burst
+                    next_send = max(now, next_send) + interval
+                seg = self.next_segment(*item)
+                self.server.transmit(self, seg)
+                self.protect(seg)
+
+    def window_open(self):
+        """
+        Whether a new segment fits in the selective repeat window, the congestion window and the advertised receive window
+        """
+        return self.seq < self.window_base + self.window_size and self.in_flight() < min(self.congestion.window(), max(self.rwnd, 1)) # always allow one segment to probe a closed receive window
+
+    def next_segment(self, stream, offset, data, last):
+        """
+        Attach the next sequence number to a segment taken from the stream scheduler
+        """
+        seg = Segment(self.seq, data, conn_id=self.conn_id, stream=stream.stream_id, offset=offset, end=last)
+        self.stream_of[self.seq] = stream
+        seg.ack_now = self.in_flight() + 1 >= min(self.congestion.window(), max(self.rwnd, 1)) # window is full after this one, do not let the client delay its ack
+        self.seq += 1
+        self.sent_segments += 1
+        segments_sent.inc()
+        return seg
+
+    def timer(self, seq, segment):
+        """
+        Called by the scheduler when a segment's timeout expires without being cancelled by an ACK
+        """
+        if self.aborted:
+            return
+        if seq >= self.window_base and seq not in self.packets: # if ACK is not received, resend
+            with self.lock:
+                now = time.perf_counter()
+                if self.sent_times.get(seq, now) >= self.last_backoff: # back off once per flight, not for every segment of it
+                    self.rtt.on_timeout()
+                    self.last_backoff = now
+                    self.timeouts += 1
+                dead = self.timeouts > MAX_TIMEOUTS
+                if not dead:
+                    self.congestion.on_loss(seq, self.seq, now, timeout=True)
+                    self.retransmitted.add(seq)
+            if dead:
+                self.abort() # the client is gone, stop retransmitting to it
+                return
+            self.retransmitted_segments += 1
+            timeout_retransmits.inc()
+            segment.ack_now = True
+            self.server.transmit(self, segment)
+
+    def send(self, packet, weight = 1):
+        """
+        Our TCP-like send function that opens a stream for a SegmentedPacket, its name id is the stream id
+        The fragments are only produced when the scheduler picks the stream. Blocks while the send buffer is full (see
+        SEND_BUFFER), like a socket send, and returns a Future of the seconds until every segment of the stream was acked.
+        """
+        stream = Stream(packet.name_id, packet.fragments(), packet.count(), weight)
+        self.streams.add(stream)
+        if self.aborted:
+            self.fail([stream])
+        return stream.future
+
+    def abort(self):
+        """
+        Give up on a client that stopped acking: fail the streams, stop the sender and the timers and forget the connection
+        """
+        with self.lock:
+            if self.aborted:
+                return
+            self.aborted = True
+            streams = self.streams.abort() + [stream for stream in self.stream_of.values if stream is not None]
+            self.fail(streams)
+            pending = [(self.conn_id, i) for i in range(self.window_base, self.seq)]
+        self.server.scheduler.cancel_all(pending)
+        connections_aborted.inc()
+        log.warning("Possible fault: connection %d aborted, no ack for %d retransmission timeouts", self.conn_id, MAX_TIMEOUTS)
+        self.notify() # the sender sees the abort and returns
+        self.server.remove(self)
+
+    def fail(self, streams):
+        """
+        Resolve the futures of streams that will never complete with a ConnectionError
+        """
+        for stream in streams:
+            if not stream.future.done():
+                stream.future.set_exception(ConnectionError("Connection {} aborted".format(self.conn_id)))
+
+    def completion_times(self):
+        """
+        (stream id, segments, seconds from send until the last segment was acked) of the completed streams
+        """
+        with self.lock:
+            return [(stream.stream_id, stream.size, stream.completed - stream.added) for stream in self.completed]
+
+    def rto_state(self):
+        """
+        Snapshot of the RTT estimator (srtt, rttvar, rto, backoff) for monitoring
+        """
+        with self.lock:
+            return self.rtt.state()
+
+    def drain(self):
+        """
+        Block until everything passed to send is acked, or the connection is aborted (see MAX_TIMEOUTS)
+        """
+        self.streams.join()
+        while self.window_base < self.seq and not self.aborted:
+            time.sleep(0.01)
+
+    def close(self):
+        """
+        Wait until everything is acked, then send a FIN until the client acknowledges it and forget the connection
+        """
+        self.drain()
+        self.streams.close() # stop the sender thread
+        for _ in range(FIN_RETRIES if not self.aborted else 0):
+            self.server.send_control(Segment(self.seq, kind=FIN, conn_id=self.conn_id), self.addr)
+            if self.closed.wait(self.rtt.timeout()):
+                break
+        self.server.remove(self)
+
+class ConnectionTable:
+    """
+    Connection bookkeeping shared by the threaded UDPServer and the asyncio AsyncUDPServer (see aio.py):
+    the CONNECT handshake, demultiplexing of incoming segments by connection id and dispatching of retransmission timers.
+    Subclasses provide accept_queue, transmit, send_parity and send_control, and set connection_class to the Connection type they drive.
+    """
+    connection_class = Connection
+
+    def __init__(self, congestion, compression = NONE, fec = None):
+        self.congestion = congestion # factory of the congestion controller of each connection
+        self.compression = compression # codec used for clients that offer it, see compress.py
+        self.fec = fec # (k, r) forward error correction of every connection, see fec.py, None for plain retransmission
+        self.connections = {} # connection id -> Connection
+        self.lock = Lock() # lock to protect the connections dict
+        registry.gauge('udp_connections', "Open connections", lambda: len(self.connections))
+        registry.gauge('udp_in_flight_segments', "Segments sent and not acked yet, over all connections", lambda: sum(conn.in_flight() for conn in list(self.connections.values())))
+        registry.gauge('udp_window_lag_segments', "Largest distance between the next sequence number and the window base of a connection", lambda: max((conn.seq - conn.window_base for conn in list(self.connections.values())), default=0))
+        registry.gauge('udp_rto_seconds', "Largest retransmission timeout of a connection", lambda: max((conn.rtt.timeout() for conn in list(self.connections.values())), default=None))
+
+    def demux(self, data, addr):
+        """
+        Handle a datagram from a client, returns (connection, ack segment) for acks and None for anything else
+        """
+        try:
+            seg = Segment.decode(data)
+        except (ValueError, struct.error) as e:
+            segments_malformed.inc()
+            log.warning("Malformed segment from %s, %s", addr, e)
+            return None
+        if seg.kind == CONNECT:
+            self.handle_connect(seg, addr)
+            return None
+        conn = self.connections.get(seg.conn_id)
+        if conn is None or conn.addr != addr:
+            segments_unknown.inc() # mostly late acks of a closed connection
+            log.debug("Received packet for unknown connection %d from %s", seg.conn_id, addr)
+            return None
+        if seg.kind == ACK:
+            return conn, seg
+        if seg.kind == FIN_ACK:
+            conn.closed.set()
+        else:
+            log.warning("Received unexpected segment type %d, %d", seg.kind, seg.seq)
+        return None
+
+    def handle_connect(self, seg, addr):
+        """
+        Open a connection for a CONNECT, or confirm it again if our ACCEPT was lost
+        """
+        with self.lock:
+            conn = self.connections.get(seg.conn_id)
+            if conn is None:
+                try:
+                    resume, bases, codecs = decode_resume(seg.data) # ranges and objects the client already holds, see Reassembler
+                except (ValueError, struct.error, UnicodeDecodeError) as e:
+                    log.warning("Malformed resume request from %s, %s", addr, e)
+                    resume, bases, codecs = {}, [], 0
+                shard = (seg.stream, seg.offset) if seg.offset else None # a CONNECT carries its shard in the stream and offset fields
+                conn = self.connection_class(self, seg.conn_id, addr, self.congestion(), resume, bases, negotiate(codecs, self.compression), self.fec, shard)
+                self.connections[seg.conn_id] = conn
+                self.accept_queue.put_nowait(conn)
+            elif conn.addr != addr:
+                log.warning("Connection id %d already used by %s, received from %s", seg.conn_id, conn.addr, addr)
+                return
+        self.send_control(Segment(0, kind=ACCEPT, conn_id=seg.conn_id), addr)
+
+    def remove(self, conn):
+        """
+        Forget a closed connection, late segments for it are reported as unknown
+        """
+        with self.lock:
+            self.connections.pop(conn.conn_id, None)
+
+    def timer(self, key, segment):
+        """
+        Called by the scheduler when a segment's timeout expires without being cancelled by an ACK
+        """
+        conn_id, seq = key
+        conn = self.connections.get(conn_id)
+        if conn is not None:
+            conn.timer(seq, segment)
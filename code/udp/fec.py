@@ -0,0 +1,205 @@
+import bisect
+from threading import Lock
+from segment import Segment, PARITY, PARITY_HEADER, SEQ_SPACE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # parity is computed on Python integers instead, exact but slower
+
+def parity_input(seg):
+    """
+    What the parity of a data segment covers: its delivery fields and payload, everything but the sequence number,
+    which the receiver knows from the position of the lost segment in its group
+    """
+    data = b"".join(seg.data) if isinstance(seg.data, (list, tuple)) else bytes(seg.data)
+    return PARITY_HEADER.pack(seg.end, seg.stream, seg.offset % SEQ_SPACE, len(data)) + data
+
+def xor(buffers):
+    """
+    XOR of buffers of different lengths, shorter ones are padded with zeros
+    """
+    size = max(len(buffer) for buffer in buffers)
+    if numpy is not None:
+        out = numpy.zeros(size, dtype=numpy.uint8)
+        for buffer in buffers:
+            out[:len(buffer)] ^= numpy.frombuffer(buffer, dtype=numpy.uint8)
+        return out.tobytes()
+    acc = 0
+    for buffer in buffers:
+        acc ^= int.from_bytes(buffer, 'little') # zero padding at the end is the high end in little endian
+    return acc.to_bytes(size, 'little')
+
+def interleaved_parity(buffers, count):
+    """
+    count parities of a group, parity i is the XOR of the buffers i, i + count, i + 2 * count, ...
+    With NumPy the group is one (buffers, size) array and every parity is a single reduction over a strided view.
+    """
+    if numpy is None:
+        return [xor(buffers[i::count]) for i in range(count)]
+    size = max(len(buffer) for buffer in buffers)
+    group = numpy.zeros((len(buffers), size), dtype=numpy.uint8)
+    for row, buffer in zip(group, buffers):
+        row[:len(buffer)] = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    return [numpy.bitwise_xor.reduce(group[i::count], axis=0).tobytes() for i in range(count)]
+
+def members(start, size, count, index):
+    """
+    Sequence numbers covered by parity index of the group of size segments from start with count parities
+    """
+    return range(start + index, start + size, count)
+
+class ParityEncoder:
+    """
+    Sender side of the forward error correction of a connection.
+    New data segments are grouped in runs of k consecutive sequence numbers, after the last one of a group r PARITY
+    segments follow, parity i covering the segments i, i + r, i + 2r, ... of the group. The receiver rebuilds any
+    segment that is the only one missing among those covered by a parity, so a group survives up to r losses when
+    they are spread over different parities, in particular any burst of up to r consecutive losses.
+    This is interleaved XOR rather than Reed-Solomon: any r losses would need arithmetic over GF(256), too slow
+    per segment in Python, while XOR runs at memory speed and bursts are the losses that matter.
+    A group is cut short with flush when the sender runs out of data, so the tail of a transfer is protected too.
+    """
+    def __init__(self, k, r):
+        self.k = k # data segments per group
+        self.r = r # parity segments per group
+        self.group = [] # parity inputs of the current group
+        self.start = 0 # sequence number of its first segment
+        self.starts = [] # first sequence numbers of the groups whose parity was sent, ascending
+        self.ends = [] # sequence numbers after their last segment
+        self.lock = Lock() # groups are added by the sender and looked up by the ack handling
+
+    def add(self, seg):
+        """
+        Account a newly numbered data segment, returns the parity segments to send after it (none until the group is full)
+        """
+        if not self.group:
+            self.start = seg.seq
+        self.group.append(parity_input(seg))
+        if len(self.group) == self.k:
+            return self.flush(seg.conn_id)
+        return []
+
+    def flush(self, conn_id):
+        """
+        Parity segments of the current group, however few segments it has
+        seq is the first sequence number of the group, window its size, stream the number of parities and offset the index.
+        """
+        if not self.group:
+            return []
+        count = min(self.r, len(self.group))
+        parities = [Segment(self.start, payload, kind=PARITY, window=len(self.group), stream=count, offset=i, conn_id=conn_id)
+                    for i, payload in enumerate(interleaved_parity(self.group, count))]
+        with self.lock:
+            self.starts.append(self.start)
+            self.ends.append(self.start + len(self.group))
+        self.group = []
+        return parities
+
+    def protected(self, seq):
+        """
+        Sequence number after the group of seq if its parity was sent, None otherwise
+        """
+        with self.lock:
+            i = bisect.bisect_right(self.starts, seq) - 1
+            if i >= 0 and seq < self.ends[i]:
+                return self.ends[i]
+        return None
+
+    def prune(self, base):
+        """
+        Forget the groups that are acked completely
+        """
+        with self.lock:
+            i = bisect.bisect_right(self.ends, base)
+            del self.starts[:i]
+            del self.ends[:i]
+
+class ParityDecoder:
+    """
+    Receiver side of the forward error correction, rebuilds lost data segments from PARITY segments.
+    Once the first parity arrives, the parity input of every data segment is kept until no group can need it anymore.
+    A segment is rebuilt when it is the only one missing among the members of a parity, no matter whether the parity
+    or the last other member arrived last. Segments received before the first parity can not help, their content is gone.
+    """
+    def __init__(self):
+        self.active = False # set by the first parity, the sender has FEC on
+        self.k = 0 # largest group seen, inputs older than this below the window base are never needed
+        self.inputs = {} # sequence number -> parity input of a received data segment
+        self.parities = {} # (start, index) -> (group size, parity count, payload) of parities still waiting for a loss to repair
+        self.covering = {} # sequence number -> keys of the parities covering it
+        self.pruned = 0 # inputs below this were dropped
+        self.recovered = 0 # segments rebuilt from parity
+
+    def add_data(self, seg, received):
+        """
+        Keep a new data segment, returns the segments it lets us rebuild
+        received(seq) tells whether a sequence number was received, with or without its input kept.
+        """
+        if not self.active:
+            return []
+        self.inputs[seg.seq] = parity_input(seg)
+        rebuilt = []
+        for key in self.covering.get(seg.seq, ()):
+            seg = self.repair(key, received)
+            if seg is not None:
+                rebuilt.append(seg)
+        return rebuilt
+
+    def add_parity(self, seg, received):
+        """
+        Keep a parity, returns the segment it rebuilds right away, if any
+        """
+        self.active = True
+        self.k = max(self.k, seg.window)
+        key = (seg.seq, seg.offset)
+        if key in self.parities:
+            return []
+        self.parities[key] = (seg.window, max(seg.stream, 1), bytes(seg.data))
+        for seq in members(seg.seq, seg.window, max(seg.stream, 1), seg.offset):
+            self.covering.setdefault(seq, []).append(key)
+        seg = self.repair(key, received)
+        return [seg] if seg is not None else []
+
+    def repair(self, key, received):
+        """
+        Rebuild the missing member of a parity if exactly one is missing and the others are kept
+        """
+        entry = self.parities.get(key)
+        if entry is None:
+            return None
+        size, count, payload = entry
+        start, index = key
+        missing = [seq for seq in members(start, size, count, index) if seq not in self.inputs]
+        if not missing:
+            self.discard(key) # nothing lost
+            return None
+        if len(missing) > 1 or received(missing[0]):
+            return None # more losses than this parity covers, or a member arrived before the first parity and its content is gone
+        seq = missing[0]
+        data = xor([payload] + [self.inputs[other] for other in members(start, size, count, index) if other != seq])
+        end, stream, offset, length = PARITY_HEADER.unpack_from(data)
+        self.discard(key)
+        self.recovered += 1
+        return Segment(seq, data[PARITY_HEADER.size:PARITY_HEADER.size + length], stream=stream, offset=offset, end=bool(end), conn_id=0) # offset as sent, unwrapped on delivery
+
+    def discard(self, key):
+        size, count, _ = self.parities.pop(key)
+        for seq in members(key[0], size, count, key[1]):
+            keys = self.covering.get(seq)
+            if keys is not None:
+                keys.remove(key)
+                if not keys:
+                    del self.covering[seq]
+
+    def prune(self, base):
+        """
+        Drop what no group can need once everything below base is received
+        """
+        if not self.active:
+            return
+        for seq in range(self.pruned, base - self.k):
+            self.inputs.pop(seq, None)
+            for key in list(self.covering.get(seq, ())):
+                self.discard(key)
+        self.pruned = max(self.pruned, base - self.k)
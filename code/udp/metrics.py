@@ -0,0 +1,202 @@
+import bisect
+import json
+import logging
+import os
+import sys
+import time
+from threading import Thread, Lock, Event, local, current_thread
+
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(18)) # 0.1 ms to 13 s, upper bounds in seconds
+EXPORT_INTERVAL = 1.0 # seconds between two exports of the periodic exporter
+
+class Counter:
+    """
+    Monotonic count, incremented on the hot path without a lock: every thread adds to a cell of its own and a
+    snapshot sums the cells. The cells of threads that ended are folded into retired when a snapshot is taken.
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.local = local()
+        self.cells = [] # (thread, [count]) of the threads that incremented it
+        self.retired = 0 # counted by threads that ended
+        self.lock = Lock() # protects cells and retired, taken once per thread and per snapshot
+
+    def inc(self, n = 1):
+        try:
+            self.local.cell[0] += n # only this thread writes its cell
+        except AttributeError:
+            self.local.cell = cell = [n]
+            with self.lock:
+                self.cells.append((current_thread(), cell))
+
+    def snapshot(self):
+        with self.lock:
+            live = []
+            for thread, cell in self.cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    self.retired += cell[0] # it can not add to it any more
+            self.cells = live
+            return self.retired + sum(cell[0] for _, cell in live)
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets, cumulative like Prometheus histograms when exported
+    """
+    def __init__(self, name, help, buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets # upper bounds, ascending
+        self.counts = [0] * (len(buckets) + 1) # the last one counts values above every bound
+        self.sum = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        return {'count': sum(counts), 'sum': total, 'buckets': dict(zip([*self.buckets, float('inf')], counts))}
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile, None without observations
+        """
+        with self.lock:
+            counts = list(self.counts)
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip([*self.buckets, float('inf')], counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+class Gauge:
+    """
+    Current value of something that already exists (a queue depth, a window), read only when a snapshot is taken
+    so it costs nothing on the hot path. function may return None when there is nothing to measure.
+    """
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def snapshot(self):
+        try:
+            return self.function()
+        except Exception:
+            return None # measured while the state changes under it, skip this sample
+
+class Registry:
+    """
+    The metrics of a process by name. Metrics are created once at import or construction and updated in place,
+    a snapshot is a plain dict of their values, exported as a Prometheus text file or as JSON lines.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric) # the same metric when a module registers it again
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, function):
+        """
+        Register a gauge, replacing an earlier one of the same name, the latest server or client is the one measured
+        """
+        with self.lock:
+            self.metrics[name] = gauge = Gauge(name, help, function)
+        return gauge
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def prometheus(self):
+        """
+        Snapshot in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            value = metric.snapshot()
+            if value is None:
+                continue
+            kind = 'counter' if isinstance(metric, Counter) else 'histogram' if isinstance(metric, Histogram) else 'gauge'
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            if kind != 'histogram':
+                lines.append(f"{metric.name} {value}")
+                continue
+            cumulative = 0
+            for bound, count in value['buckets'].items():
+                cumulative += count
+                lines.append(f'{metric.name}_bucket{{le="{"+Inf" if bound == float("inf") else repr(bound)}"}} {cumulative}')
+            lines.append(f"{metric.name}_sum {value['sum']}")
+            lines.append(f"{metric.name}_count {value['count']}")
+        return "\n".join(lines) + "\n"
+
+class Exporter(Thread):
+    """
+    Writes the registry every interval seconds: a .prom path is rewritten in place for the node exporter textfile
+    collector, any other path gets one JSON line per snapshot. stop writes a last snapshot.
+    """
+    def __init__(self, registry, path, interval = EXPORT_INTERVAL):
+        super().__init__(daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def export(self):
+        try:
+            if self.path.endswith('.prom'):
+                with open(self.path + '.tmp', 'w') as f:
+                    f.write(self.registry.prometheus())
+                os.replace(self.path + '.tmp', self.path) # never read half written
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({'time': time.time(), **self.registry.snapshot()}, default=str) + "\n")
+        except OSError as e:
+            logging.getLogger(__name__).warning("Metrics not exported to %s, %s", self.path, e)
+
+    def stop(self):
+        self.stopped.set()
+        self.export()
+
+registry = Registry() # the metrics of this process, shared by every module
+
+def configure(level = None, path = None):
+    """
+    Set up the logging of a script and the periodic export of its metrics, from LOG_LEVEL and METRICS_FILE by default,
+    path '' exports nothing.
+    Log records are printed as bare messages on stdout at INFO, so the reports read as before, with the level in
+    front at DEBUG. Returns the exporter, None without a metrics file.
+    """
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+    path = path if path is not None else os.environ.get('METRICS_FILE')
+    logging.basicConfig(level=level.upper(), stream=sys.stdout, format="%(levelname)s %(name)s: %(message)s" if level.upper() == 'DEBUG' else "%(message)s")
+    if not path:
+        return None
+    exporter = Exporter(registry, path, float(os.environ.get('METRICS_INTERVAL', EXPORT_INTERVAL)))
+    exporter.start()
+    return exporter
@@ -1,10 +1,34 @@
+import struct
+import mmap
+import os
+import glob
+import time
+import tempfile
+from hashlib import md5
+from pathlib import Path
+import shared # code/common on the path, see shared.py
+from manifest import DIGEST_SIZE
+from compress import NONE, CompressionStats, compressed_blocks, decompress, timed
+import logging
 
-HEADER_SEGMENT_CURR_SIZE = 5 # size of the current fragment number
-HEADER_SEGMENT_END_SIZE = 5 # size of the total number of fragments
-HEADER_TOTAL_SIZE = 10 # size of the total size of the payload - used to get only the payload from the last fragment
-HEADER_NAME_SIZE = 20  # size of the name of the resource
+META = 0 # fragment carrying the size, digest and name of the resource, sent once before its data fragments, curr numbers the pieces of a long name
+DATA = 1 # fragment carrying a slice of the payload
+COPY = 2 # fragment listing ranges the receiver copies from resources it already holds instead of receiving them, see ManifestStore
+BLOCK = 3 # fragment carrying a piece of a compressed block of CHUNK_FRAGMENTS data fragments, see compress.py
+HEADER = struct.Struct('!BHI') # type, name id, current fragment number
+META_HEADER = struct.Struct('!Q{}sI'.format(DIGEST_SIZE)) # total size of the payload, digest of its version, length of the name, start the META fragments followed by the name
 
-SEGMENT_SIZE = 512 - HEADER_NAME_SIZE - HEADER_SEGMENT_CURR_SIZE - HEADER_SEGMENT_END_SIZE - HEADER_TOTAL_SIZE # possible maximum size of the payload
+SEGMENT_SIZE = 512 - HEADER.size # possible maximum size of the payload
+RESUME_ENTRY = struct.Struct('!H{}sH'.format(DIGEST_SIZE)) # length of the name, digest of the version held, number of ranges that follow the name
+RANGE = struct.Struct('!II') # first fragment number of a range, fragment number after its last
+JOURNAL = struct.Struct('!IQ{}s'.format(DIGEST_SIZE)) # last fragment number, total size of the payload, digest of its version, followed by the bitmap of received fragments
+JOURNAL_EVERY = 256 # fragments written between two journal updates, at least, see Reassembly.every
+SPOOL_SIZE = 64 * 1024 * 1024 # resources above this size are reassembled in a temporary file instead of memory when there is no directory
+COPY_ENTRY = struct.Struct('!BIII') # base number, first fragment number, fragment number after the last, first fragment number in the base
+CHUNK_FRAGMENTS = 64 # fragments per dedup chunk, chunks are aligned to fragments so a copied chunk is a range of fragments
+CHUNK_SIZE = CHUNK_FRAGMENTS * SEGMENT_SIZE
+BLOCK_HEADER = struct.Struct('!BBB') # codec, piece number, number of pieces, follows HEADER in BLOCK fragments, whose curr is the first fragment of the block
+log = logging.getLogger(__name__)
 
 class SegmentedPacket:
     """
@@ -13,60 +37,571 @@ class SegmentedPacket:
     This class handles the segmentation and reassembly of the payload, similar to a fragmented HTTP message.
     Note that this class may be renamed as a Fragment, but we decided to keep it as a Packet to avoid confusion with the Segment class.
     The wording segment is used to refer to the fragments of the payload, not to be confused with the Segment class, as this is further abstracted away from the reliable UDP layer.
+    Instead of repeating the name in every fragment, each resource gets a small numeric name id and the META fragments map the id
+    to the size, digest and name once, a name longer than a fragment is split over consecutive META fragments.
+    The digest (see manifest.DIGEST_SIZE) names the version of the resource: held ranges are only skipped for the same
+    version, and the receiver checks the reassembled resource against it.
+    Sizes are 64-bit, fragment numbers 32-bit, so a resource holds up to 2 ** 32 fragments (about 2 TB).
     """
-    def __init__(self,name,data):
+    def __init__(self, name, data, name_id = 0):
         self.name = name # name of the resource
-        self.data = data # payload
-        self.length = len(data) # length of payload
-        if len(data) % SEGMENT_SIZE != 0:
-            self.data += " " * (SEGMENT_SIZE - (len(data) % SEGMENT_SIZE)) # pad with spaces to make it a multiple of SEGMENT_SIZE to make it easier to decode
+        self.name_id = name_id # id of the resource used in the fragment headers
+        self.data = memoryview(data) # payload as any buffer (bytes, mmap), sliced without copying
+        self.length = len(self.data) # length of payload
+        self.digest = None # first bytes of the md5 of the payload, computed when the META fragments are built unless set
+        self.held = [] # (first, after last) ranges of data fragment numbers the receiver already holds, they are not sent again
+        self.copies = [] # (base, first, after last, source) ranges the receiver copies from its own resources, see ManifestStore
+        self.codec = NONE # compression negotiated with the receiver, data is sent in compressed blocks of CHUNK_FRAGMENTS fragments
+        self.stats = None # CompressionStats the compression is accounted in
     
+    @staticmethod
+    def from_file(path, name_id = 0):
+        """
+        Memory-map a file so its fragments are slices of the page cache instead of copies in memory
+        """
+        with open(path, 'rb') as f:
+            if Path(path).stat().st_size == 0:
+                data = b'' # empty files can not be mapped
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # the mapping stays valid after the file is closed
+        return SegmentedPacket(Path(path).name, data, name_id)
+
+    def end(self):
+        """
+        Last fragment number, an empty resource still has one fragment
+        """
+        return last_fragment(self.length)
+
+    def missing(self):
+        """
+        Ranges of the data fragment numbers that are neither held by the receiver nor copied by it
+        """
+        return missing_ranges(self.held + [(first, stop) for _, first, stop, _ in self.copies], self.end() + 1)
+
+    def meta(self):
+        """
+        Payload of the META fragments, the size, digest and name, cut in SEGMENT_SIZE pieces
+        """
+        if self.digest is None:
+            self.digest = md5(self.data).digest()[:DIGEST_SIZE]
+        name = self.name.encode()
+        meta = META_HEADER.pack(self.length, self.digest, len(name)) + name
+        return [meta[i:i + SEGMENT_SIZE] for i in range(0, len(meta), SEGMENT_SIZE)]
+
+    def remaining(self):
+        """
+        Number of data fragments to send
+        """
+        return sum(stop - start for start, stop in self.missing())
+
+    def copy_entries(self):
+        """
+        Payloads of the COPY fragments
+        """
+        per_fragment = SEGMENT_SIZE // COPY_ENTRY.size
+        return [b"".join(COPY_ENTRY.pack(*copy) for copy in self.copies[i:i + per_fragment]) for i in range(0, len(self.copies), per_fragment)]
+
+    def count(self):
+        """
+        Number of fragments to send including the META and COPY fragments
+        """
+        return self.remaining() + meta_pieces(len(self.name.encode())) + len(self.copy_entries())
+
+    def fragments(self):
+        """
+        Lazily split the resource into fragments, and give each fragment a header containing the type, name id and current fragment number
+        The META fragments that carry the size and name for the name id come first, COPY fragments follow them.
+        Each fragment is a (header, payload) pair of buffers, the payload being a memoryview slice of the resource.
+        Data fragments the receiver already holds (see held) are skipped.
+        """
+        for i, piece in enumerate(self.meta()):
+            yield (HEADER.pack(META, self.name_id, i), piece)
+        for i, entries in enumerate(self.copy_entries()):
+            yield (HEADER.pack(COPY, self.name_id, i), entries)
+        if self.codec != NONE:
+            yield from self.blocks()
+            return
+        for start, stop in self.missing():
+            for i in range(start, stop):
+                yield (HEADER.pack(DATA, self.name_id, i), self.data[i*SEGMENT_SIZE:(i+1)*SEGMENT_SIZE])
+
+    def blocks(self):
+        """
+        Data fragments compressed per block of CHUNK_FRAGMENTS fragments, a block is sent if any of its fragments is missing
+        The blocks are compressed in the worker pool ahead of sending, a block that does not get smaller by at least
+        one fragment is sent as plain DATA fragments.
+        """
+        end = self.end()
+        piece_size = SEGMENT_SIZE - BLOCK_HEADER.size
+        needed = sorted({b for start, stop in self.missing() for b in range(start // CHUNK_FRAGMENTS, (stop - 1) // CHUNK_FRAGMENTS + 1)})
+        blocks = ((b, self.data[b*CHUNK_SIZE:(b+1)*CHUNK_SIZE]) for b in needed)
+        for b, block, compressed in compressed_blocks(self.codec, blocks, self.stats):
+            first = b * CHUNK_FRAGMENTS
+            pieces = (len(compressed) + piece_size - 1) // piece_size
+            if pieces >= (len(block) + SEGMENT_SIZE - 1) // SEGMENT_SIZE:
+                for i in range(first, min(first + CHUNK_FRAGMENTS, end + 1)):
+                    yield (HEADER.pack(DATA, self.name_id, i), self.data[i*SEGMENT_SIZE:(i+1)*SEGMENT_SIZE])
+                continue
+            for piece in range(pieces):
+                yield (HEADER.pack(BLOCK, self.name_id, first) + BLOCK_HEADER.pack(self.codec, piece, pieces), compressed[piece*piece_size:(piece+1)*piece_size])
+
     def construct(self):
         """
-        Split the resource into fragments, and give each fragment a header containing the name, current fragment number, total number of fragments, and total size of the payload
+        Split the resource into encoded fragments
         """
-        segments = [] 
-        curr = 0
-        end = (len(self.data) // SEGMENT_SIZE)
-        for i in range(curr, end):
-            segments.append(f"{self.name:<{HEADER_NAME_SIZE}}{i:<{HEADER_SEGMENT_CURR_SIZE}}{end-1:<{HEADER_SEGMENT_END_SIZE}}{self.length:<{HEADER_TOTAL_SIZE}}{self.data[i*SEGMENT_SIZE:(i+1)*SEGMENT_SIZE]}")
-            # left align properties to have a fixed size to make decoding easier
-        return segments
+        return [b"".join(fragment) for fragment in self.fragments()]
     
     @staticmethod
     def reassemble(segments):
         """
-        Reassemble a list of fragments into a resource
-        """
-        print(segments)
-        if not segments:
-            return None # fragments not complete
-        segments = sorted(segments, key=lambda x: int(x[HEADER_NAME_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE])) # sort by fragment number
-        end = int(segments[0][HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE].strip())
-        complete = all([x in segments for x in range(end+1)]) # check if all fragments are present
-        if not complete:
-            return None # fragments not complete
-        assembled = ""
+        Reassemble a list of fragments of a single resource into a resource
+        """
+        assembler = Reassembler()
         for segment in segments:
-            name = segment[:HEADER_NAME_SIZE].strip()
-            curr = int(segment[HEADER_NAME_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE].strip())
-
-            total = int(segment[HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE+HEADER_TOTAL_SIZE].strip())
-            data = segment[HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE:] # get payload
-            assembled += data # add payload to assembled to have the complete resource
-        return name, assembled[:total] # return name and resource removing padding
+            done = assembler.add(segment)
+            if done is not None:
+                return done.name, bytes(done.data())
+        return None # fragments not complete
     
     @staticmethod
     def decode(data):
         """
-        Decode a fragment from a string
+        Decode a fragment from bytes, the payload is returned as a memoryview slice
+        """
+        view = memoryview(data)
+        kind, name_id, curr = HEADER.unpack_from(view)
+        return kind, name_id, curr, view[HEADER.size:]
+
+def last_fragment(total):
+    """
+    Last fragment number of a resource of total bytes, an empty resource still has one fragment
+    """
+    return max((total + SEGMENT_SIZE - 1) // SEGMENT_SIZE, 1) - 1
+
+def meta_pieces(length):
+    """
+    Number of META fragments of a resource whose name is length bytes long
+    """
+    return (META_HEADER.size + length + SEGMENT_SIZE - 1) // SEGMENT_SIZE
+
+def missing_ranges(held, count):
+    """
+    Complement of the held ranges in [0, count), held may overlap and be in any order
+    """
+    missing = []
+    start = 0
+    for first, stop in sorted(held):
+        if first > start:
+            missing.append((start, min(first, count)))
+        start = max(start, stop)
+        if start >= count:
+            break
+    if start < count:
+        missing.append((start, count))
+    return [(first, stop) for first, stop in missing if first < stop]
+
+def bitmap_ranges(bitmap, count):
+    """
+    Ranges of the set bits among the first count bits of a bitmap, bit i is bit i % 8 of byte i // 8
+    """
+    ranges = []
+    start = None
+    for i in range(count):
+        if bitmap[i >> 3] & (1 << (i & 7)):
+            if start is None:
+                start = i
+        elif start is not None:
+            ranges.append((start, i))
+            start = None
+    if start is not None:
+        ranges.append((start, count))
+    return ranges
+
+def encode_resume(held, bases = (), codecs = 0, limit = SEGMENT_SIZE):
+    """
+    Encode the ranges of fragments held per resource name, with the digest of the version they belong to, and the digests of the complete resources held (bases),
+    sent with CONNECT so the server skips the ranges and sends copies of the chunks found in the bases
+    A leading byte offers the codecs the client can decompress (see compress.supported), the server picks one.
+    The bases go next, at most as many as fit in half the limit. Resources with few ranges go next, when the ranges of
+    a resource do not fit in the limit only its largest ranges are sent, the fragments left out are simply sent again.
+    """
+    bases = list(bases)[:min(255, limit // 2 // DIGEST_SIZE)]
+    out = bytearray([codecs, len(bases)])
+    for digest in bases:
+        out += digest
+    entries = sorted(held.items(), key=lambda item: len(item[1][1]))
+    for name, (digest, ranges) in entries:
+        name = name.encode()
+        fit = (limit - len(out) - RESUME_ENTRY.size - len(name)) // RANGE.size
+        if fit <= 0:
+            continue # a long name, shorter ones may still fit
+        if len(ranges) > fit:
+            ranges = sorted(sorted(ranges, key=lambda r: r[1] - r[0], reverse=True)[:fit])
+        out += RESUME_ENTRY.pack(len(name), digest, len(ranges)) + name + b"".join(RANGE.pack(*r) for r in ranges)
+    return bytes(out)
+
+def decode_resume(data):
+    """
+    Decode the request of encode_resume into a dict of name -> (digest, held ranges), the list of base digests and the codecs offered
+    """
+    held = {}
+    view = memoryview(data)
+    if not view:
+        return held, [], 0
+    if len(view) < 2:
+        raise ValueError("Truncated resume request")
+    codecs, count = view[0], view[1]
+    offset = 2 + count * DIGEST_SIZE
+    if offset > len(view):
+        raise ValueError("Truncated base digests")
+    bases = [bytes(view[2 + i * DIGEST_SIZE:2 + (i + 1) * DIGEST_SIZE]) for i in range(count)]
+    while offset < len(view):
+        length, digest, count = RESUME_ENTRY.unpack_from(view, offset)
+        offset += RESUME_ENTRY.size
+        name = bytes(view[offset:offset + length]).decode()
+        offset += length
+        held[name] = (digest, [RANGE.unpack_from(view, offset + i * RANGE.size) for i in range(count)])
+        offset += count * RANGE.size
+    return held, bases, codecs
+
+def read_journal(path):
+    """
+    (end, total, digest, bitmap) from a progress journal, None if there is none
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        end, total, digest = JOURNAL.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+    bitmap = bytearray(data[JOURNAL.size:])
+    if len(bitmap) != end // 8 + 1:
+        return None # torn or foreign file
+    return end, total, digest, bitmap
+
+class Reassembly:
+    """
+    A single resource being reassembled.
+    Each fragment is written straight to its offset in a preallocated buffer, a bytearray, or a memory-mapped
+    output file when a path is given, so fragments may arrive in any order and nothing is joined at the end.
+    Without a path, resources above SPOOL_SIZE are mapped from an anonymous temporary file, so a large resource
+    streams through the page cache instead of being held in memory whole.
+    Received fragments are tracked in a bitmap, and the md5 is updated whenever the contiguous prefix grows,
+    so the digest is ready the moment the last fragment lands.
+    With a path, the data goes to path.part and the bitmap is saved to path.journal every few fragments (see every),
+    always after the data it covers was written, so a restarted receiver picks up where the journal says and only
+    asks for the rest (see Reassembler), as long as the resource is still the version the journal names by its digest.
+    On completion the md5 is checked against that digest: if it matches path.part becomes path, the journal is kept
+    as complete and the md5 is written to path.md5, otherwise the part and the journal are dropped (see discard). Ranges the server tells us to copy from resources we already hold are filled by copy.
+    """
+    def __init__(self, name_id, name, total, digest, path = None):
+        self.name_id = name_id
+        self.name = name
+        self.digest = digest # of the version sent, from the META fragments
+        end = last_fragment(total)
+        self.end = end # last fragment number
+        self.total = total # size of the resource
+        self.bitmap = bytearray(end // 8 + 1) # bit curr is set once fragment curr was written
+        self.prefix = 0 # fragments below this are hashed
+        self.hash = md5()
+        self.started = time.perf_counter() # time the first fragment arrived
+        self.path = path
+        self.file = None
+        self.unsaved = 0 # fragments written since the journal was saved
+        self.every = max(JOURNAL_EVERY, (end + 1) // 64) # the whole bitmap is rewritten, at most 8 bytes of it per fragment written
+        self.blocks = {} # first fragment -> pieces of a compressed block, None until received
+        if path is not None:
+            journal = read_journal(path + '.journal')
+            resumed = journal is not None and journal[:3] == (end, total, digest) and os.path.exists(path + '.part')
+            if resumed:
+                self.bitmap = journal[3]
+            self.file = open(path + '.part', 'r+b' if resumed else 'w+b')
+            self.file.truncate(total)
+            if not resumed:
+                self.save() # replace the journal of an earlier version of the resource, which may claim it complete
+        elif total > SPOOL_SIZE:
+            self.file = tempfile.TemporaryFile() # deleted when closed
+            self.file.truncate(total)
+        if self.file is not None and total > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), total)
+        else:
+            self.buffer = bytearray(total) # in memory, or an empty resource that can not be mapped
+        self.view = memoryview(self.buffer)
+        self.count = bin(int.from_bytes(self.bitmap, 'little')).count('1') # fragments written
+        self.advance() # hash what an earlier run already wrote
+
+    def add(self, curr, data):
+        """
+        Write fragment curr, returns False for duplicates and fragments out of range
+        """
+        if curr > self.end or self.bitmap[curr >> 3] & (1 << (curr & 7)):
+            return False
+        offset = curr * SEGMENT_SIZE
+        if offset + len(data) > self.total:
+            return False
+        self.view[offset:offset + len(data)] = data
+        self.bitmap[curr >> 3] |= 1 << (curr & 7)
+        self.count += 1
+        if curr == self.prefix:
+            self.advance()
+        self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+        return True
+
+    def copy(self, first, stop, source, base):
+        """
+        Write fragments [first, stop) from the buffer of a resource the receiver already holds, starting at fragment source
+        Returns False if the range does not fit either resource.
         """
-        name = data[:HEADER_NAME_SIZE].strip()
-        curr = int(data[HEADER_NAME_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE].strip())
-        end = int(data[HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE].strip())
-        total = int(data[HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE:HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE+HEADER_TOTAL_SIZE].strip())
-        data = data[HEADER_NAME_SIZE+HEADER_SEGMENT_CURR_SIZE+HEADER_SEGMENT_END_SIZE+HEADER_TOTAL_SIZE:]
-        return name, curr, end, total, data
+        length = min(stop * SEGMENT_SIZE, self.total) - first * SEGMENT_SIZE
+        offset = source * SEGMENT_SIZE
+        if first >= stop or stop > self.end + 1 or length < 0 or offset + length > len(base):
+            return False
+        return self.fill(first, base[offset:offset + length])
 
+    def fill(self, first, data):
+        """
+        Write a run of whole fragments starting at fragment first, the last one may be the short end of the resource
+        Returns False if it does not fit.
+        """
+        start = first * SEGMENT_SIZE
+        stop = first + (len(data) + SEGMENT_SIZE - 1) // SEGMENT_SIZE
+        if stop > self.end + 1 or start + len(data) > self.total or (len(data) % SEGMENT_SIZE and start + len(data) != self.total):
+            return False
+        self.view[start:start + len(data)] = data # same content as the server's, overwriting held fragments is harmless
+        for curr in range(first, stop):
+            if not self.bitmap[curr >> 3] & (1 << (curr & 7)):
+                self.bitmap[curr >> 3] |= 1 << (curr & 7)
+                self.count += 1
+                self.unsaved += 1
+        self.advance()
+        if self.unsaved >= self.every:
+            self.save()
+        return True
 
+    def advance(self):
+        """
+        Hash the contiguous run of fragments that starts at the prefix, all at once
+        """
+        prefix = self.prefix
+        while prefix <= self.end and self.bitmap[prefix >> 3] & (1 << (prefix & 7)):
+            prefix += 1
+        if prefix > self.prefix:
+            self.hash.update(self.view[self.prefix * SEGMENT_SIZE:prefix * SEGMENT_SIZE])
+            self.prefix = prefix
+
+    def save(self):
+        """
+        Replace the journal with the current bitmap, the data it covers is already in the mapping
+        """
+        self.unsaved = 0
+        if self.path is None:
+            return
+        with open(self.path + '.journal.tmp', 'wb') as f:
+            f.write(JOURNAL.pack(self.end, self.total, self.digest))
+            f.write(self.bitmap)
+        os.replace(self.path + '.journal.tmp', self.path + '.journal') # atomic, a crash leaves the old or the new journal
+
+    def complete(self):
+        return self.count == self.end + 1
+
+    def data(self):
+        """
+        The reassembled resource as a buffer, not copied
+        """
+        return self.view
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        """
+        Flush the output file and give it its name, returns its path (None if it is kept in memory or spooled, or
+        does not match its digest and was discarded)
+        """
+        if self.hash.digest()[:DIGEST_SIZE] != self.digest:
+            log.warning("Possible fault: %s does not match its digest, dropped", self.name)
+            self.discard()
+            return None
+        if self.file is None:
+            return None
+        self.release()
+        if self.path is None:
+            return None # the temporary file is gone with its data
+        os.replace(self.path + '.part', self.path)
+        self.save() # a complete journal tells the next run to advertise this resource as a base
+        with open(self.path + '.md5', 'w') as f:
+            f.write(self.hexdigest()) # the next run advertises the resource by this digest, see Reassembler
+        return self.path
+
+    def release(self):
+        """
+        Unmap and close the output file
+        """
+        self.view.release() # a mapping can not be closed while it is exported
+        if isinstance(self.buffer, mmap.mmap):
+            if self.path is not None:
+                self.buffer.flush()
+            self.buffer.close()
+        self.file.close()
+
+    def discard(self):
+        """
+        Drop a resource that came out corrupt: the part and the journal are removed so the next run fetches it again
+        """
+        if self.file is None:
+            return
+        self.release()
+        if self.path is None:
+            return
+        for suffix in ('.part', '.journal'):
+            try:
+                os.remove(self.path + suffix)
+            except OSError:
+                pass
+
+class Reassembler:
+    """
+    Reassembles the fragments of many resources interleaved in any order, keyed by name id
+    add returns the Reassembly once its resource is complete, the caller closes it.
+    With a directory, resources are written there under their names and the journals left by an earlier run are read
+    back: held maps each name to the digest and fragment ranges of an unfinished resource already on disk, and bases lists the
+    digests and paths of the complete ones, both sent to the server with encode_resume. The server answers with COPY
+    fragments for the chunks it finds in the bases, whatever their names, and only sends the chunks that changed.
+    """
+    def __init__(self, directory = None):
+        self.directory = directory # write the resources to memory-mapped files here instead of memory
+        self.objects = {} # name id -> Reassembly in progress
+        self.done = set() # name ids already completed, late duplicates of their fragments are dropped
+        self.early = {} # name id -> fragments that arrived before the size and name of their resource
+        self.names = {} # name id -> META fragments received, by piece number, until the name is complete
+        self.held = {} # name -> (digest of the version, ranges of data fragments) an earlier run left on disk
+        self.bases = [] # (digest, path) of the complete resources on disk, COPY fragments refer to them by position
+        self.mapped = {} # base number -> read-only mapping of its file, opened on the first copy
+        self.stats = CompressionStats() # decompression of the BLOCK fragments
+        if directory is not None:
+            self.restore()
+
+    def restore(self):
+        for journal in glob.glob(os.path.join(self.directory, '*.journal')):
+            path = journal[:-len('.journal')]
+            entry = read_journal(journal)
+            if entry is None:
+                continue
+            end, total, digest, bitmap = entry
+            ranges = bitmap_ranges(bitmap, end + 1)
+            full = ranges == [(0, end + 1)]
+            if full and os.path.exists(path + '.part'):
+                os.replace(path + '.part', path) # completed right before the earlier run stopped
+            if full and os.path.exists(path):
+                self.bases.append((self.digest(path), path))
+            elif os.path.exists(path + '.part'):
+                self.held[os.path.basename(path)] = (digest, ranges)
+            # otherwise the journal does not match the files, fetch everything again
+
+    @staticmethod
+    def digest(path):
+        """
+        Digest a complete resource is advertised by, from its .md5 file if the run that completed it wrote one
+        """
+        try:
+            with open(path + '.md5', 'r') as f:
+                hexdigest = f.read().strip()
+        except OSError:
+            md5sum = md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    md5sum.update(chunk) # a chunk at a time, the object may be larger than memory
+            hexdigest = md5sum.hexdigest()
+        return bytes.fromhex(hexdigest)[:DIGEST_SIZE]
+
+    def base(self, number):
+        """
+        Buffer of base number, None if there is no such base
+        """
+        if number >= len(self.bases):
+            return None
+        if number not in self.mapped:
+            with open(self.bases[number][1], 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                self.mapped[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        return self.mapped[number]
+
+    def apply(self, obj, kind, curr, data):
+        """
+        Write a DATA fragment, collect a piece of a compressed BLOCK or perform the copies of a COPY fragment
+        """
+        if kind == BLOCK:
+            codec, piece, count = BLOCK_HEADER.unpack_from(data)
+            pieces = obj.blocks.setdefault(curr, [None] * count)
+            if piece >= len(pieces):
+                log.warning("Block piece out of range, %s of %s", piece, len(pieces))
+                return
+            pieces[piece] = bytes(data[BLOCK_HEADER.size:])
+            if None in pieces:
+                return
+            del obj.blocks[curr]
+            try:
+                block = timed(decompress, codec, b"".join(pieces), self.stats)
+            except Exception as e: # zlib.error, lzma.LZMAError or an unknown codec
+                log.warning("Corrupt compressed block at %s, %s", curr, e)
+                return
+            if not obj.fill(curr, block):
+                log.warning("Decompressed block does not fit at %s, %s bytes", curr, len(block))
+            return
+        if kind != COPY:
+            obj.add(curr, data)
+            return
+        for offset in range(0, len(data) - COPY_ENTRY.size + 1, COPY_ENTRY.size):
+            number, first, stop, source = COPY_ENTRY.unpack_from(data, offset)
+            base = self.base(number)
+            if base is None or not obj.copy(first, stop, source, base):
+                log.warning("Invalid copy from base %s, fragments %s to %s", number, first, stop)
+
+    def meta(self, name_id, piece, data):
+        """
+        Collect a META fragment, returns (total, digest, name) once every piece of the name arrived, None before
+        """
+        pieces = self.names.setdefault(name_id, {})
+        pieces[piece] = bytes(data)
+        if 0 not in pieces:
+            return None # the size and length of the name come first
+        total, digest, length = META_HEADER.unpack_from(pieces[0])
+        count = meta_pieces(length)
+        if any(i not in pieces for i in range(count)):
+            return None
+        del self.names[name_id]
+        name = b"".join(pieces[i] for i in range(count))[META_HEADER.size:META_HEADER.size + length]
+        return total, digest, name.decode()
 
+    def add(self, fragment):
+        kind, name_id, curr, data = SegmentedPacket.decode(fragment)
+        if name_id in self.done:
+            return None
+        obj = self.objects.get(name_id)
+        if obj is None:
+            if kind != META:
+                self.early.setdefault(name_id, []).append(bytes(fragment)) # wait for the size and name to open the buffer
+                return None
+            meta = self.meta(name_id, curr, data)
+            if meta is None:
+                return None
+            total, digest, name = meta
+            path = None
+            if self.directory is not None:
+                if os.path.basename(name) != name:
+                    log.warning("Resource name is not a file name, %s", name)
+                    return None
+                path = os.path.join(self.directory, name)
+            obj = self.objects[name_id] = Reassembly(name_id, name, total, digest, path)
+            for early in self.early.pop(name_id, []):
+                kind, _, curr, data = SegmentedPacket.decode(early)
+                self.apply(obj, kind, curr, data)
+        elif kind != META: # a duplicate META once the resource is open
+            self.apply(obj, kind, curr, data)
+        if obj.complete():
+            del self.objects[name_id]
+            self.done.add(name_id)
+            return obj
+        return None
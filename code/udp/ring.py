@@ -0,0 +1,116 @@
+class SequenceRing:
+    """
+    State of the sequence numbers of a sliding window in a fixed-size ring, slot seq % size, instead of a dict or set
+    that grows with every segment ever sent. Usable as a set (add, discard, in) or as a dict (get, pop, item access).
+    The bulk methods (missing, held, fill, pop_many, pop_run) do the per segment work of a whole ack in one call.
+    Only size consecutive sequence numbers fit at a time, which the selective repeat window guarantees: entries are
+    popped as the window moves past them, and each slot remembers its sequence number so a later one reusing the slot
+    never reads an earlier one's value. A slot only moves forward, a late write for an older sequence number is dropped.
+    """
+    __slots__ = ('size', 'seqs', 'values', 'count') # accessed for every segment
+
+    def __init__(self, size):
+        self.size = size
+        self.seqs = [-1] * size # sequence number held in each slot, -1 when empty
+        self.values = [None] * size
+        self.count = 0 # occupied slots
+
+    def __contains__(self, seq):
+        return self.seqs[seq % self.size] == seq
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, seq):
+        i = seq % self.size
+        if self.seqs[i] != seq:
+            raise KeyError(seq)
+        return self.values[i]
+
+    def __setitem__(self, seq, value):
+        i = seq % self.size
+        held = self.seqs[i]
+        if held > seq:
+            return # stale, e.g. the send time of a retransmission that was acked before it left
+        if held == -1:
+            self.count += 1
+        self.seqs[i] = seq
+        self.values[i] = value
+
+    def get(self, seq, default = None):
+        i = seq % self.size
+        return self.values[i] if self.seqs[i] == seq else default
+
+    def pop(self, seq, default = None):
+        i = seq % self.size
+        if self.seqs[i] != seq:
+            return default
+        value = self.values[i]
+        self.seqs[i] = -1
+        self.values[i] = None # drop the reference, e.g. to a segment and its payload
+        self.count -= 1
+        return value
+
+    def add(self, seq):
+        self[seq] = True
+
+    def discard(self, seq):
+        self.pop(seq)
+
+    def missing(self, start, stop):
+        """
+        Sequence numbers from start to stop (excluded) that are not held
+        """
+        seqs, size = self.seqs, self.size
+        return [seq for seq in range(start, stop) if seqs[seq % size] != seq]
+
+    def held(self, start, stop):
+        """
+        Sequence numbers from start to stop (excluded) that are held
+        """
+        seqs, size = self.seqs, self.size
+        return [seq for seq in range(start, stop) if seqs[seq % size] == seq]
+
+    def fill(self, seqs, value):
+        """
+        Set every sequence number of seqs to value, like item assignment
+        """
+        held, values, size = self.seqs, self.values, self.size
+        for seq in seqs:
+            i = seq % size
+            if held[i] > seq:
+                continue
+            if held[i] == -1:
+                self.count += 1
+            held[i] = seq
+            values[i] = value
+
+    def pop_many(self, seqs):
+        """
+        Pop every sequence number of seqs, returns their values, None for those that were not held
+        """
+        held, values, size = self.seqs, self.values, self.size
+        popped = []
+        for seq in seqs:
+            i = seq % size
+            if held[i] != seq:
+                popped.append(None)
+                continue
+            popped.append(values[i])
+            held[i] = -1
+            values[i] = None
+            self.count -= 1
+        return popped
+
+    def pop_run(self, start):
+        """
+        Pop the run of consecutive sequence numbers held from start, returns the first one that is not held
+        """
+        seqs, values, size = self.seqs, self.values, self.size
+        seq = start
+        while seqs[seq % size] == seq:
+            seqs[seq % size] = -1
+            values[seq % size] = None
+            seq += 1
+        self.count -= seq - start
+        return seq
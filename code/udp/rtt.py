@@ -0,0 +1,67 @@
+ALPHA = 0.125 # gain of the smoothed RTT
+BETA = 0.25 # gain of the RTT variation
+K = 4 # RTO = SRTT + K * RTTVAR
+INITIAL_RTO = 0.5 # used until the first sample arrives
+MIN_RTO = 0.05 # lower bound, has to stay above the client's delayed ack timer
+MAX_RTO = 10 # cap timeout at 10 seconds to avoid waiting too long
+
+class RTTEstimator:
+    """
+    RFC 6298-style retransmission timeout estimation.
+    Keeps a smoothed RTT (SRTT) and its variation (RTTVAR) and sets RTO = SRTT + K * RTTVAR.
+    Samples must only be taken from segments that were sent once (Karn's algorithm), otherwise it is ambiguous which transmission the ack belongs to.
+    Every retransmission timeout doubles the RTO (exponential backoff) until a valid sample arrives.
+    """
+    def __init__(self, initial = INITIAL_RTO, min_rto = MIN_RTO, max_rto = MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.backoff = 1 # multiplier applied by exponential backoff
+        self.samples = 0
+
+    def sample(self, rtt):
+        """
+        Update the estimate with the RTT of a segment that was not retransmitted
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(max(self.srtt + K * self.rttvar, self.min_rto), self.max_rto)
+        self.backoff = 1 # a valid sample ends the backoff
+        self.samples += 1
+
+    def on_timeout(self):
+        """
+        Back off after a retransmission timeout
+        """
+        if self.rto * self.backoff < self.max_rto:
+            self.backoff *= 2
+
+    def timeout(self):
+        """
+        Current retransmission timeout including backoff
+        """
+        return min(self.rto * self.backoff, self.max_rto)
+
+    def rtt(self):
+        """
+        Best RTT estimate, falls back to the initial RTO before the first sample
+        """
+        return self.srtt if self.srtt is not None else self.rto
+
+    def state(self):
+        """
+        Snapshot for monitoring
+        """
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'rto': self.timeout(),
+            'backoff': self.backoff,
+            'samples': self.samples,
+        }
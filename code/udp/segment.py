@@ -1,25 +1,104 @@
+import struct
+
+VERSION = 7 # wire format version, bumped whenever the header layout or the fragment format it carries changes
 WINDOW_SIZE = 2000
-HEADER_SIZE = 10
+DATA = 0 # segment carrying payload
+ACK = 1 # cumulative acknowledgement, the payload is an optional SACK bitmap
+CONNECT = 2 # client asks the server to open a connection with the connection id it picked
+ACCEPT = 3 # server confirms the connection
+FIN = 4 # server has nothing more to send, seq is the sequence number after the last segment
+FIN_ACK = 5 # client confirms the FIN, the connection is closed
+PARITY = 6 # XOR parity of data segments sent for forward error correction, see fec.py, never acked or retransmitted
+ACK_NOW = 0x80 # flag in the type byte asking the receiver to ack without delay
+STREAM_END = 0x40 # flag in the type byte marking the last segment of a stream
+FLAGS = ACK_NOW | STREAM_END
+HEADER = struct.Struct('!BBIIHHI') # version, type, connection id, sequence number, advertised receive window, stream id, offset in the stream
+HEADER_SIZE = HEADER.size
 SEGMENT_SIZE = 512
 TOTAL_SIZE = HEADER_SIZE + SEGMENT_SIZE
+PARITY_HEADER = struct.Struct('!BHIH') # end flag, stream id, offset and payload length of a data segment, covered by the parity along with the payload
+DATAGRAM_SIZE = TOTAL_SIZE + PARITY_HEADER.size # largest datagram, a PARITY segment carries a full payload behind PARITY_HEADER
+SEQ_SPACE = 2 ** 32 # sequence numbers and stream offsets are sent modulo this, see unwrap
 class Segment:
     """
     Our TCP-like segment class containing a sequence number and data
-    HEADER_SIZE is the size of the sequence number, SEGMENT_SIZE is the size of the data
+    Every segment carries the id of the connection it belongs to, so one server socket can serve many clients.
+    Data segments also carry a stream id and their offset in the stream: seq orders the connection for acks and
+    retransmissions, while offset orders the stream for delivery, so a hole in one stream does not block the others.
+    The header is a packed binary struct (see HEADER), data is raw bytes of at most SEGMENT_SIZE.
+    seq and offset are unbounded integers, only their low 32 bits are sent: the receiver recovers the full value
+    with unwrap from a nearby one it already knows, so a connection or stream never runs out of numbers.
+    For ACK segments seq is the cumulative ack (next expected sequence number) and data is a SACK bitmap,
+    see sack_bitmap and sack_sequences, and window is the number of segments the receiver can still buffer.
+    data may also be a sequence of buffers (e.g. a fragment header and a memoryview into a mapped file),
+    which are handed to sendmsg as is so the payload is never concatenated before reaching the socket.
     """
-    def __init__(self, seq, data = ''):
+    def __init__(self, seq, data = b'', kind = DATA, window = 0, ack_now = False, conn_id = 0, stream = 0, offset = 0, end = False):
+        self.conn_id = conn_id
+        self.stream = stream
+        self.offset = offset
+        self.end = end # last segment of the stream
         self.seq = seq
         self.data = data
+        self.kind = kind
+        self.window = window
+        self.ack_now = ack_now # set by the sender when it can not send more until it gets an ack
     
+    def buffers(self):
+        """
+        Header and payload buffers for scatter-gather sending with socket.sendmsg
+        """
+        kind = self.kind | (ACK_NOW if self.ack_now else 0) | (STREAM_END if self.end else 0)
+        header = HEADER.pack(VERSION, kind, self.conn_id, self.seq % SEQ_SPACE, self.window, self.stream, self.offset % SEQ_SPACE)
+        if isinstance(self.data, (list, tuple)):
+            return [header, *self.data]
+        return [header, self.data]
+
     def encode(self):
-        return f"{self.seq:<{HEADER_SIZE}}{self.data:<{SEGMENT_SIZE}}" # left align data and sequence to have a fixed size to make decoding easier
+        return b"".join(self.buffers())
     
     @staticmethod
     def decode(data):
         """
-        Decode a segment from a string
+        Decode a segment from bytes, the payload is a memoryview slice of data so it is not copied
+        seq and offset are the 32-bit values sent, see unwrap.
         """
-        seq = int(data[:HEADER_SIZE].strip())
-        data = data[HEADER_SIZE:]
-        return Segment(seq, data)
+        view = memoryview(data)
+        version, kind, conn_id, seq, window, stream, offset = HEADER.unpack_from(view)
+        if version != VERSION:
+            raise ValueError("Unsupported segment version {}".format(version))
+        return Segment(seq, view[HEADER_SIZE:], kind & ~FLAGS, window, bool(kind & ACK_NOW), conn_id, stream, offset, bool(kind & STREAM_END))
     
+def unwrap(wire, near):
+    """
+    Full number a 32-bit wire value stands for, the one closest to near (serial number arithmetic, RFC 1982)
+    Exact as long as the sender's number is less than 2 ** 31 away from near, the window keeps it within a few thousand.
+    """
+    return near + (wire - near + SEQ_SPACE // 2) % SEQ_SPACE - SEQ_SPACE // 2
+
+def sack_bitmap(base, received, highest, limit = SEGMENT_SIZE * 8):
+    """
+    Bitmap of the out-of-order sequence numbers held above the cumulative ack base, bit i (most significant bit first) stands for base + 1 + i
+    received iterates over the sequence numbers held, only those up to highest are considered and the bitmap is capped
+    to limit bits to fit in a segment.
+    """
+    count = min(highest - base, limit)
+    if count <= 0:
+        return b''
+    bitmap = bytearray((count + 7) // 8)
+    for seq in received:
+        i = seq - base - 1
+        if 0 <= i < count:
+            bitmap[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bitmap)
+
+def sack_sequences(base, bitmap):
+    """
+    Sequence numbers marked as received in a SACK bitmap relative to the cumulative ack base
+    """
+    for i, byte in enumerate(bitmap):
+        if not byte:
+            continue # skip holes quickly
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                yield base + 1 + i * 8 + bit
@@ -1,107 +1,121 @@
 import socket
-from threading import Thread, Lock
-from segment import Segment, HEADER_SIZE, TOTAL_SIZE, WINDOW_SIZE
+from threading import Thread
+from segment import TOTAL_SIZE, DATA
 import queue
 import time
-from packet import SegmentedPacket
+from packet import SegmentedPacket, CHUNK_SIZE, CHUNK_FRAGMENTS
+import shared # code/common on the path, see shared.py
+from manifest import ManifestStore, copy_runs
+from compress import NONE, CODECS
 import glob
 import os
-from pathlib import Path
-
-ALPHA = 0.125
-
-class UDPServer(Thread):
+import sys
+from timer import RetransmitScheduler
+from batchio import BatchReceiver, BatchSender, BATCH_SIZE, set_buffer_sizes
+from congestion import AIMD, controller
+from connection import ConnectionTable
+from metrics import registry, configure
+import logging
+
+HOST = os.environ.get("SERVER_HOST", "server") # Set to the IP address of the server eth0 if you do not use docker compose
+PORT = int(os.environ.get("SERVER_PORT", 5000)) # both can be set from the environment, see bench/bench.py
+log = logging.getLogger(__name__)
+
+class UDPServer(ConnectionTable, Thread):
     """
     Our UDP-like server class that handles the sending of segments and receiving of acks to achieve in-order and reliable delivery.
     We implemented selective repeat as our windowing strategy to avoid retransmitting packets that have already been received.
     We tried to keep it clean as possible with least number of locks and thread-safe queues to avoid deadlocks.
+    The server listens on one socket and serves many clients at once: a client opens a connection with a CONNECT handshake,
+    and all further segments carry its connection id. Reliability state lives in one Connection per client (see connection.py),
+    returned by accept, while the socket, the ack receiver, the queue sender and the retransmission timer are shared.
     """
-    def __init__(self, host, port):
-        self.dest = (host, port)
-        self.socket = socket.socket(socket.AF_INET,
-                                    socket.SOCK_DGRAM)
-        self.seq = 0
-        self.window_size = WINDOW_SIZE
-        self.window_base = 0
-        self.lock = Lock() # lock to protect the packets dict
-        self.notify_sender = Lock() # lock to notify sender thread that window has moved
-        self.packets = {} # dict to store acked packets
-        self.constructed = {} # dict to store constructed packets
-        self.send_queue = queue.Queue() # queue to store segments to be sent to the socket
-        self.data_queue = queue.Queue() # queue to store data to be constructed into segments by the sender thread
-        self.segment_queue = queue.Queue()
-        self.timeout = 0.5 # initial timeout
-        super().__init__()
+    def __init__(self, host, port, sndbuf = None, rcvbuf = None, congestion = AIMD, compression = NONE, fec = None, sock = None):
+        ConnectionTable.__init__(self, congestion, compression, fec)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET,
+                                 socket.SOCK_DGRAM)
+            set_buffer_sizes(sock, sndbuf, rcvbuf)
+            sock.bind((host, port))
+        self.socket = sock # or a socket bound already, e.g. one of the SO_REUSEPORT group of a sharded server, see shard.py
+        self.receiver = BatchReceiver(self.socket, TOTAL_SIZE) # makes the socket non-blocking, acks are drained in batches
+        self.batch_sender = BatchSender(self.socket)
+        self.accept_queue = queue.Queue() # connections that completed the handshake but were not accepted yet
+        self.send_queue = queue.Queue() # queue to store (connection, segment) pairs to be sent to the socket
+        registry.gauge('udp_send_queue_depth', "Segments queued for the socket", self.send_queue.qsize)
+        registry.gauge('udp_accept_queue_depth', "Connections handshaken and not accepted yet", self.accept_queue.qsize)
+        self.scheduler = RetransmitScheduler(self.timer) # single timer thread for all in-flight segments of all connections
+        Thread.__init__(self)
 
     def ack_receiver(self):
-        while True:
-            data, addr = self.socket.recvfrom(TOTAL_SIZE)
-            if addr != self.dest:
-                print("Possible fault: Received packet from unknown source, expected: {}, received: {}".format(self.dest, addr))
-                continue
-            seg = Segment.decode(data)
-            ack = seg.seq
-            if ack < self.window_base:
-                # print("Possible fault: Received duplicate ack, {} < {}".format(ack, self.window_base))
-                continue
-            elif ack >= self.window_base + self.window_size:
-                print("Possible fault: Received ack out of window")
-                continue
-            else:
-                with self.lock:
-                    self.packets[ack] = seg # add ack'd packet to dict
-                    self.timeout = (self.timeout * (1-ALPHA) + ALPHA * (time.perf_counter() - self.constructed[ack])) # dynamic timeout using rolling average using RTT
-                    if self.timeout > 10:
-                        self.timeout = 10 # cap timeout at 10 seconds to avoid waiting too long
-                    if ack == self.window_base:
-                        self.window_base += 1
-                        while self.window_base in self.packets:
-                            self.window_base += 1 # advance window until unack'd packet
-                        try:
-                            self.notify_sender.release() # notify that the window is moved and new packets can be sent
-                        except:
-                            pass
-    def sender(self):
         """
-        Thread that only handles constructing segments from the data queue added by the send function.
+        Thread that demultiplexes everything clients send by connection id.
+        All acks that arrived since the last wakeup are handled under a single lock acquisition per connection.
         """
         while True:
-            self.notify_sender.acquire() # wait until window is moved to a unsent packet
-            for i in range(self.window_base, self.window_base + self.window_size):
-                if i not in self.packets and i not in self.constructed: # if packet is not in constructed (already sent once), it should not be in queue again by the sender, only by the timer when it fails
-                    data = self.data_queue.get() # construct segment from data by attaching the next sequence number
-                    seg = Segment(i, data)
-                    self.constructed[i] = time.perf_counter() # record time of construction to calculate RTT
-                    self.send_queue.put(seg) 
-    
-    def timer(self, seq, segment):
-        time.sleep(self.timeout) 
-        if seq not in self.packets: # if ACK is not received, resend after wait
-            self.send_queue.put(segment)
-        
+            batch = self.receiver.receive()
+            acks = {} # connection -> acks in this batch
+            for data, addr in batch:
+                found = self.demux(data, addr)
+                if found is not None:
+                    conn, seg = found
+                    acks.setdefault(conn, []).append(seg)
+            for conn, segs in acks.items():
+                moved = False
+                with conn.lock:
+                    for seg in segs:
+                        moved = conn.handle_ack(seg) or moved
+                if moved:
+                    conn.notify()
+
+    def send_control(self, seg, addr):
+        """
+        Send a handshake segment, these are not retransmitted by the timer but by whoever waits for the answer
+        """
+        self.batch_sender.send(seg.buffers(), addr)
+
+    def transmit(self, conn, seg):
+        """
+        Queue a segment of a connection for the queue sender
+        """
+        self.send_queue.put((conn, seg))
+
+    def send_parity(self, conn, seg):
+        """
+        Queue a parity segment behind the data segments it covers, it has no timer
+        """
+        self.send_queue.put((conn, seg))
+
+    def accept(self):
+        """
+        A TCP socket-like accept function that blocks until a client connects and returns its Connection
+        """
+        return self.accept_queue.get()
+
     def queue_sender(self):
         """
-        Thread that only handles sending packets to the socket from the queue added by the sender and timer thread.
+        Thread that only handles sending packets to the socket from the queue added by the connections' sender and timer threads.
         This is to avoid multiple threads sending to the socket at the same time, or block either of the threads
+        Every wakeup flushes a burst of up to BATCH_SIZE queued segments and arms their timers together.
         """
         while True:
-            seg = self.send_queue.get()
-            self.socket.sendto(seg.encode().encode(), self.dest)
-            thread = Thread(target=self.timer, args=(seg.seq,seg,)) # start timer thread to wait for ack, if not received, resend
-            thread.start()
-    
-    def send(self, data):
-        """
-        Our TCP-like send function that adds to the servers buffer
-        """
-        self.data_queue.put(data)
+            burst = [self.send_queue.get()]
+            while len(burst) < BATCH_SIZE:
+                try:
+                    burst.append(self.send_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for conn, seg in burst:
+                if seg.kind == DATA:
+                    conn.sent_times[seg.seq] = time.perf_counter() # record send time to calculate RTT, before sending so the ack can never arrive first
+                self.batch_sender.send(seg.buffers(), conn.addr) # scatter-gather, header and payload slice are not concatenated
+            self.scheduler.schedule_all([((conn.conn_id, seg.seq), seg, conn.rtt.timeout()) for conn, seg in burst if seg.kind == DATA]) # arm retransmission timers, cancelled when the ACK arrives
 
     def run(self):
         """
-        Starts the sender, ack_receiver and queue_sender threads
+        Starts the ack_receiver and queue_sender threads and the retransmission scheduler
         """
-        sender = Thread(target=self.sender)
-        sender.start()
+        self.scheduler.start()
         ack_receiver = Thread(target=self.ack_receiver)
         ack_receiver.start()
         queue_sender = Thread(target=self.queue_sender)
@@ -111,65 +125,113 @@ class UDPServer(Thread):
 Following only handles file operations and constructing the segments.
 """
 
+manifests = ManifestStore(CHUNK_SIZE) # chunk digests of every object version served, shared by all connections
+
 def getfiles(dir):
-    small_files = glob.glob(os.path.join(dir, 'small*.obj'))
-    large_files = glob.glob(os.path.join(dir, 'large*.obj'))
+    small_files = sorted(glob.glob(os.path.join(dir, 'small*.obj'))) # sorted, every worker of a sharded server must see the same order
+    large_files = sorted(glob.glob(os.path.join(dir, 'large*.obj')))
     return [f for f in small_files if os.path.isfile(f)], [f for f in large_files if os.path.isfile(f)]
 
-def construct_segments():
+def construct_segments(resume = None, bases = None, codec = NONE, stats = None, shard = None):
     """
-    Split the files into segments to fit the segment size
+    Open the files as packets to be sent as one stream each
+    Segments are produced on demand as (header, payload view) pairs, nothing is read into memory up front.
+    resume maps names to the digest and fragment ranges the client kept from an earlier transfer, only the rest is
+    sent, unless the object changed since: then the digest differs and the whole object is sent again.
+    bases are the digests of the objects the client holds complete, chunks found in them are sent as COPY ranges.
+    With a codec the data is sent in compressed blocks, accounted in stats.
+    With a shard (index, count) only every count-th object from index is sent, name ids stay those of the full list.
     """
     dir = '../objects'
     small_files, large_files = getfiles(dir)
-    small_segments = []
-    for n in small_files:
-        with open(n, 'r') as f:
-            small_segments.extend(SegmentedPacket(Path(f.name).name, f.read()).construct())
-    large_segments = []
-    for n in large_files:
-        with open(n, 'r') as f:
-            large_segments.extend(SegmentedPacket(Path(f.name).name, f.read()).construct())
-    return small_segments, large_segments
-
-def interleave(small, large):
+    # every resource gets its own name id, which is also its stream id, the name itself is only sent once in the META fragment
+    paths = list(enumerate(small_files + large_files))
+    if shard is not None:
+        paths = paths[shard[0]::shard[1]] # every shard gets some of the small and some of the large objects
+    packets = [SegmentedPacket.from_file(n, name_id) for name_id, n in paths]
+    index = manifests.index(bases or [])
+    for (_, path), packet in zip(paths, packets):
+        packet.digest, chunks = manifests.manifest(path, packet.data) # recorded even without bases, later clients may hold this version
+        digest, held = (resume or {}).get(packet.name, (None, []))
+        packet.held = held if digest == packet.digest else [] # fragments of another version are not ours
+        packet.codec = codec
+        packet.stats = stats
+        if index:
+            end = packet.end() + 1
+            packet.copies = [(base, first * CHUNK_FRAGMENTS, min(stop * CHUNK_FRAGMENTS, end), source * CHUNK_FRAGMENTS)
+                             for first, stop, base, source in copy_runs(chunks, index)]
+    return packets
+
+def parse_fec(arg):
     """
-    Interleave the segments from small and large files to handle simultaneous transmission.
-    This is to avoid the large files blocking the small files from being sent (HoL blocking).
+    FEC setting from the command line, "k/r" or "none"
     """
-    segments = []
-    for i in range(0, len(large)):
-        if len(small) > i:
-            segments.append(small[i])
-        segments.append(large[i])
-    return segments
+    if arg == 'none':
+        return None
+    k, r = (int(n) for n in arg.split('/'))
+    return k, r
 
+def parse_pacing(arg):
+    """
+    Pacing setting from the command line, "pacing" or "none"
+    """
+    if arg not in ('pacing', 'none'):
+        raise ValueError("Pacing is either pacing or none, not {}".format(arg))
+    return arg == 'pacing'
 
-if __name__ == "__main__":
-    server = UDPServer("172.30.0.3", 5000)
+def serve(conn, strategy):
+    """
+    Send every object to one client and close the connection
+    Objects are not interleaved up front: each one is a stream and the connection's scheduler sends the
+    smallest remaining stream first, so small objects are never stuck behind large ones (HoL blocking).
+    """
+    start = time.perf_counter()
+    packets = construct_segments(conn.resume, conn.bases, conn.codec, conn.compression, conn.shard)
+    names = {packet.name_id: packet.name for packet in packets}
+    for packet in packets:
+        conn.send(packet) # tcp-like send to socket, abstracting away the segmenting and scheduling
+    conn.drain()
+    report(conn, strategy, time.perf_counter() - start, names)
+    conn.close()
+
+def report(conn, strategy, elapsed, names):
+    """
+    Log how the transfer of a connection went once it is drained, names maps stream ids to object names
+    Shared by serve and aio.serve. An aborted connection is reported as a failure, its transfer did not finish.
+    """
+    if conn.aborted:
+        log.warning("Possible fault: Connection {}: strategy: {}, aborted after {:.1f} s, the client stopped acking, {} segments sent".format(conn.conn_id, strategy, elapsed, conn.sent_segments))
+        return
+    log.info("Connection {}: strategy: {}, goodput: {:.0f} segments/s, retransmitted {} of {} segments ({} fast retransmits)".format(conn.conn_id, strategy, conn.sent_segments / elapsed, conn.retransmitted_segments, conn.sent_segments, conn.fast_retransmits))
+    log.info("RTO state: {}".format(conn.rto_state()))
+    small_times = [t for stream_id, size, t in conn.completion_times() if names[stream_id].startswith("small")]
+    if small_times:
+        log.info("Small object completion: average {:.1f} ms, max {:.1f} ms".format(sum(small_times) / len(small_times) * 1000, max(small_times) * 1000))
+    if conn.codec != NONE:
+        log.info("Compression {}".format(conn.compression.report()))
+    if conn.fec is not None:
+        log.info("FEC: {} parity segments for {} data segments".format(conn.parity_segments, conn.sent_segments))
+
+def serve_forever(server, strategy):
+    """
+    Serve every client that connects, each from its own thread
+    """
     server.start()
-    small_segments, large_segments = construct_segments()
-    segments = interleave(small_segments, large_segments)
-    for seg in segments:
-        server.send(seg) # tcp-like send to socket, abstracting away the segmenting and interleaving
-
-
-        
-    
-
-
-
-
+    while True:
+        conn = server.accept()
+        Thread(target=serve, args=(conn, strategy)).start() # every client gets all the objects independently
 
-                        
 
-
-
-
-
-
-
-
-
-
-        
+if __name__ == "__main__":
+    strategy = sys.argv[1] if len(sys.argv) > 1 else 'aimd' # congestion controller, one of STRATEGIES
+    compression = CODECS[sys.argv[2] if len(sys.argv) > 2 else 'none'] # opt-in, used for the clients that offer it
+    fec = parse_fec(sys.argv[3] if len(sys.argv) > 3 else 'none') # e.g. 16/2 for 2 parity segments after every 16 data segments
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1 # processes sharing the port, see shard.py
+    pacing = parse_pacing(sys.argv[5] if len(sys.argv) > 5 else 'none') # spread each window over the RTT instead of sending it in one burst
+    if workers > 1:
+        from shard import ShardedServer
+        configure(path='') # the workers export their own metrics
+        ShardedServer(HOST, PORT, workers, strategy, compression, fec, pacing=pacing).run()
+    configure() # LOG_LEVEL and METRICS_FILE, see metrics.py
+    server = UDPServer(HOST, PORT, congestion=controller(strategy, pacing), compression=compression, fec=fec)
+    serve_forever(server, strategy + (" paced" if pacing else ""))
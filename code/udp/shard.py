@@ -0,0 +1,225 @@
+import ctypes
+import logging
+import os
+import queue
+import random
+import signal
+import socket
+import struct
+import sys
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from packet import Reassembler, encode_resume
+import shared # code/common on the path, see shared.py
+from manifest import DIGEST_SIZE
+from compress import supported, CompressionStats
+from batchio import set_buffer_sizes
+from congestion import controller
+from metrics import configure
+import server
+import client
+
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, 'SO_ATTACH_REUSEPORT_CBPF', 51) # Linux, not exported by the socket module
+CONN_ID_OFFSET = struct.calcsize('!BB') # the connection id follows the version and type bytes, see segment.HEADER
+ENTRY = struct.Struct('!HqQ{}sI'.format(DIGEST_SIZE)) # length of the path, mtime in ns, size, object digest, number of chunk digests
+RESULT_POLL = 1.0 # seconds between two checks that the client processes are still alive
+log = logging.getLogger(__name__)
+
+def reuseport_sockets(host, port, count, sndbuf = None, rcvbuf = None):
+    """
+    count UDP sockets bound to the same address with SO_REUSEPORT, in the order the kernel numbers them in the group
+    """
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        set_buffer_sizes(sock, sndbuf, rcvbuf)
+        sock.bind((host, port))
+        sockets.append(sock)
+    return sockets
+
+def steer_by_connection(sock, count):
+    """
+    Attach a classic BPF program to the SO_REUSEPORT group of sock that hands every datagram to socket conn_id % count.
+    All segments of a connection then reach the worker that holds its state, and the consecutive ids of the connections
+    of one client land on different workers instead of wherever the hash of their addresses falls.
+    Returns False where the kernel does not support it, it then hashes the addresses, which is still consistent per connection.
+    """
+    program = b"".join(struct.pack('HBBI', *instruction) for instruction in (
+        (0x20, 0, 0, CONN_ID_OFFSET), # BPF_LD | BPF_W | BPF_ABS: load the connection id, the packet starts after the UDP header
+        (0x94, 0, 0, count), # BPF_ALU | BPF_MOD | BPF_K
+        (0x16, 0, 0, 0), # BPF_RET | BPF_A: index of the socket in the group
+    ))
+    instructions = ctypes.create_string_buffer(program, len(program))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, struct.pack('HP', len(program) // 8, ctypes.addressof(instructions)))
+    except OSError as e:
+        log.warning("Connections are spread by address hash, %s", e)
+        return False
+    return True
+
+def publish(paths, store):
+    """
+    Hash the objects once into store and copy their manifests to a shared memory block the workers read with attach,
+    so no worker hashes them again. Objects that change later are hashed by the workers that serve them.
+    """
+    entries = []
+    for path in paths:
+        digest, chunks = store.manifest(path)
+        stat = os.stat(path)
+        name = path.encode()
+        entries.append(ENTRY.pack(len(name), stat.st_mtime_ns, stat.st_size, digest, len(chunks)) + name + b"".join(chunks))
+    table = struct.pack('!I', len(entries)) + b"".join(entries)
+    block = shared_memory.SharedMemory(create=True, size=len(table))
+    block.buf[:len(table)] = table
+    return block
+
+def attach(name, store):
+    """
+    Fill store with the manifests a coordinator published under name
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        view = block.buf
+        count, = struct.unpack_from('!I', view)
+        offset = 4
+        for _ in range(count):
+            length, mtime, size, digest, chunks = ENTRY.unpack_from(view, offset)
+            offset += ENTRY.size
+            path = bytes(view[offset:offset + length]).decode()
+            offset += length
+            size_chunks = chunks * DIGEST_SIZE
+            digests = [bytes(view[i:i + DIGEST_SIZE]) for i in range(offset, offset + size_chunks, DIGEST_SIZE)]
+            offset += size_chunks
+            with store.lock:
+                store.files[path] = ((mtime, size), digest)
+                store.manifests[digest] = digests
+        del view # the block can not be closed while a view of it exists
+    finally:
+        block.close()
+
+def metrics_path(index):
+    """
+    METRICS_FILE of one process of a sharded server or client, the index goes before the extension
+    """
+    path = os.environ.get('METRICS_FILE')
+    if not path:
+        return ''
+    root, extension = os.path.splitext(path)
+    return "{}.{}{}".format(root, index, extension)
+
+def worker(index, sock, table, strategy, compression, fec, pacing):
+    """
+    One process of a ShardedServer, a complete UDPServer on its own socket of the group
+    """
+    configure(path=metrics_path(index))
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # forked after the coordinator installed its handlers
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the coordinator stops the workers
+    attach(table, server.manifests)
+    udp_server = server.UDPServer(None, None, congestion=controller(strategy, pacing), compression=compression, fec=fec, sock=sock)
+    server.serve_forever(udp_server, strategy + (" paced" if pacing else ""))
+
+class ShardedServer:
+    """
+    Serves from several processes that share the port with SO_REUSEPORT, so segmentation, encoding and sending of
+    different connections run on different cores instead of contending for one GIL.
+    Every worker owns one socket of the group and the complete state of the connections that reach it: a connection
+    is never split, its acks arrive at the socket its segments leave from (see steer_by_connection). A client spreads
+    the objects over several connections by asking for a shard of them in its CONNECT, see receive_sharded.
+    The coordinator only hashes the objects once, shares their manifests with the workers (see publish) and stops them.
+    """
+    def __init__(self, host, port, workers, strategy, compression, fec, sndbuf = None, rcvbuf = None, pacing = False):
+        self.sockets = reuseport_sockets(host, port, workers, sndbuf, rcvbuf)
+        steer_by_connection(self.sockets[0], workers)
+        small_files, large_files = server.getfiles('../objects')
+        self.table = publish(small_files + large_files, server.manifests)
+        self.processes = [multiprocessing.Process(target=worker, args=(i, sock, self.table.name, strategy, compression, fec, pacing), daemon=True)
+                          for i, sock in enumerate(self.sockets)]
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for process in self.processes:
+            process.start()
+        for sock in self.sockets:
+            sock.close() # each worker holds its own, the group keeps its order while they are open
+        log.info("Serving with {} worker processes".format(len(self.processes)))
+        for process in self.processes:
+            process.join()
+        self.stop()
+
+    def stop(self, *args):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join() # reaped, so their CPU time is accounted to the coordinator
+        self.table.close()
+        self.table.unlink()
+        sys.exit(0)
+
+def fetch(directory, conn_id, shard, results):
+    """
+    One process of receive_sharded: receive the objects of a shard on its own connection, reassemble and hash them here,
+    and put (name, transfer start, object start, md5) of each on results, then (None, blocks, CPU, rebuilt segments)
+    """
+    configure(path=metrics_path(shard[0]))
+    assembler = Reassembler(directory)
+    udp_client = client.UDPClient(client.SERVER, client.PORT, resume=encode_resume(assembler.held, [digest for digest, _ in assembler.bases], supported()), conn_id=conn_id, shard=shard)
+    udp_client.daemon = True # the FIN_ACK is sent before receive returns empty, nothing is left for this thread to do
+    udp_client.start()
+    start = None
+    try:
+        while True:
+            packets = udp_client.receive()
+            if not packets:
+                break # the server ended the connection and everything was delivered
+            for packet in packets:
+                if start is None:
+                    start = time.perf_counter()
+                obj = assembler.add(packet.data)
+                if obj is not None:
+                    md5sum = obj.hexdigest()
+                    obj.close()
+                    results.put((obj.name, start, obj.started, md5sum))
+    finally:
+        results.put((None, assembler.stats.blocks, assembler.stats.cpu, udp_client.fec.recovered))
+
+def receive_sharded(directory, count):
+    """
+    Receive the objects over count connections, each from its own process, and report them like a single client.
+    The connection ids are consecutive, so a server steering by conn_id % workers serves each on a different worker.
+    """
+    base = random.randrange(2 ** 32 - count)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=fetch, args=(directory, base + i, (i, count), results), daemon=True) for i in range(count)]
+    for process in processes:
+        process.start()
+    large_times = []
+    small_times = []
+    stats = CompressionStats()
+    recovered = 0
+    start = None
+    done = 0
+    while done < count:
+        try:
+            result = results.get(timeout=RESULT_POLL)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                log.warning("Possible fault: %d of %d connections ended without a report", count - done, count)
+                break
+            continue
+        if result[0] is None:
+            done += 1
+            stats.blocks += result[1]
+            stats.cpu += result[2]
+            recovered += result[3]
+            continue
+        name, started, object_started, md5sum = result
+        start = started if start is None else min(start, started) # perf_counter is the same clock in every process
+        client.received(name, start, object_started, md5sum, large_times, small_times)
+    for process in processes:
+        process.join()
+    if large_times and small_times:
+        client.report(large_times, small_times, time.perf_counter() - start, stats, recovered)
@@ -0,0 +1,137 @@
+import heapq
+import time
+from concurrent.futures import Future
+from threading import Condition
+
+SEND_BUFFER = 8192 # unsent segments the open streams of a connection may hold together, about 4 MB of payload
+
+class Stream:
+    """
+    One object sent over a connection, its segments are numbered by offset independently of the other streams
+    so the client can deliver each stream in order without waiting for the others.
+    """
+    def __init__(self, stream_id, fragments, size, weight = 1):
+        self.stream_id = stream_id
+        self.fragments = iter(fragments) # lazily produced payloads of the segments
+        self.lookahead = next(self.fragments, None) # payload of the next segment, None once the fragments ran out
+        self.size = size # number of segments in the stream, an upper bound while they are produced on the fly (compression)
+        self.weight = weight # larger weights are scheduled as if the stream were that many times smaller
+        self.offset = 0 # offset of the next segment to send
+        self.unacked = 0 # segments sent but not acked yet
+        self.added = time.perf_counter() # time the stream was opened, completion times are measured from here
+        self.completed = None # time the last segment was acked
+        self.future = Future() # resolved with the completion time, returned by Connection.send
+
+    def remaining(self):
+        if self.lookahead is None:
+            return 0
+        return max(self.size - self.offset, 1)
+
+    def priority(self):
+        """
+        Smallest remaining first, scaled by the weight
+        """
+        return self.remaining() / self.weight
+
+class StreamScheduler:
+    """
+    Picks the next segment to send across the open streams of a connection instead of interleaving them in a fixed order.
+    The stream with the fewest (weighted) segments left is served first, so a small object added while a large one is
+    being sent overtakes it instead of waiting behind it (shortest remaining processing time minimizes the mean completion time).
+    Streams live in a min-heap keyed by priority, taking a segment is O(log streams).
+    The unsent segments of the streams are bounded by limit: add blocks until the streams already added drained enough,
+    so a sender that opens streams faster than the window lets them out is held back instead of piling them up.
+    """
+    def __init__(self, limit = SEND_BUFFER):
+        self.heap = [] # (priority, tiebreaker, stream) of streams with unsent segments
+        self.counter = 0 # tiebreaker so equal priorities never compare streams and older streams win ties
+        self.cond = Condition() # reentrant, get calls take with it held
+        self.closed = False
+        self.limit = limit
+        self.buffered = 0 # unsent segments of the streams in the heap
+        self.needed = float('inf') # segments of the smallest stream waiting in add, take wakes it once they fit
+
+    def fits(self, stream):
+        """
+        Whether stream can be added without exceeding the limit, a stream larger than the limit fits an empty buffer
+        """
+        return not self.buffered or self.buffered + stream.remaining() <= self.limit
+
+    def add(self, stream):
+        with self.cond:
+            while not self.fits(stream) and not self.closed:
+                self.needed = min(self.needed, stream.remaining())
+                self.cond.wait()
+            if stream.remaining() > 0 and not self.closed:
+                self.buffered += stream.remaining()
+                self.push(stream)
+                self.cond.notify_all() # get and the other callers of add wait on the same condition
+
+    def push(self, stream):
+        self.counter += 1
+        heapq.heappush(self.heap, (stream.priority(), self.counter, stream))
+
+    def get(self):
+        """
+        Block until a segment is available, returns (stream, offset, data, last) or None once closed and empty
+        """
+        with self.cond:
+            while not self.heap:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            return self.take()
+
+    def take(self):
+        """
+        Take the next segment without blocking, returns (stream, offset, data, last) or None if no stream has unsent segments
+        """
+        with self.cond:
+            if not self.heap:
+                return None
+            _, _, stream = heapq.heappop(self.heap)
+            before = stream.remaining()
+            offset = stream.offset
+            data = stream.lookahead
+            stream.lookahead = next(stream.fragments, None)
+            stream.offset += 1
+            stream.unacked += 1
+            if stream.lookahead is None:
+                stream.size = stream.offset # exact now
+            self.buffered -= before - stream.remaining()
+            if stream.remaining() > 0:
+                self.push(stream) # requeue with its new priority, it usually stays on top
+            else:
+                self.cond.notify_all() # wake join
+            if self.buffered + self.needed <= self.limit:
+                self.needed = float('inf') # the waiters register again if they still do not fit
+                self.cond.notify_all() # room for the streams waiting in add, not woken for every segment
+            return stream, offset, data, stream.remaining() == 0
+
+    def join(self):
+        """
+        Block until every segment of every stream was taken by get
+        """
+        with self.cond:
+            while self.heap:
+                self.cond.wait()
+
+    def close(self):
+        """
+        get returns None once the remaining streams are sent
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        """
+        Drop the unsent segments and close, get, join and add return at once. Returns the streams that were dropped.
+        """
+        with self.cond:
+            streams = [stream for _, _, stream in self.heap]
+            self.heap = []
+            self.buffered = 0
+            self.closed = True
+            self.cond.notify_all()
+            return streams
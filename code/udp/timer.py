@@ -0,0 +1,130 @@
+import heapq
+import time
+from threading import Thread, Condition
+
+class RetransmitScheduler(Thread):
+    """
+    Single retransmission timer shared by every in-flight segment.
+    Instead of one sleeping thread per segment, deadlines are kept in a min-heap and one thread
+    waits for the earliest one, so scheduling and cancelling cost O(log n) and the thread count stays constant.
+    Cancelled entries are removed lazily: they stay in the heap but are skipped when they expire.
+    """
+    def __init__(self, callback):
+        super().__init__(daemon=True)
+        self.callback = callback # called with (key, item) when a timer expires
+        self.heap = [] # (deadline, tiebreaker, key) entries ordered by deadline
+        self.pending = {} # key -> (deadline, item) of the live timer for that key
+        self.counter = 0 # tiebreaker so equal deadlines never compare keys
+        self.cond = Condition()
+
+    def schedule(self, key, item, timeout):
+        """
+        Arm (or re-arm) the timer for key, item is handed back to the callback on expiry
+        """
+        deadline = time.perf_counter() + timeout
+        with self.cond:
+            self.pending[key] = (deadline, item)
+            self.counter += 1
+            heapq.heappush(self.heap, (deadline, self.counter, key))
+            if self.heap[0][2] == key:
+                self.cond.notify() # new earliest deadline, wake the timer thread to shorten its wait
+
+    def schedule_all(self, items):
+        """
+        Arm the timers for many (key, item, timeout) triples under a single lock acquisition
+        """
+        now = time.perf_counter()
+        with self.cond:
+            for key, item, timeout in items:
+                deadline = now + timeout
+                self.pending[key] = (deadline, item)
+                self.counter += 1
+                heapq.heappush(self.heap, (deadline, self.counter, key))
+            self.cond.notify()
+
+    def cancel(self, key):
+        """
+        Disarm the timer for key, the heap entry is dropped when it reaches the top
+        """
+        with self.cond:
+            self.pending.pop(key, None)
+
+    def take(self, key):
+        """
+        Disarm the timer for key and return its item, None if it is not armed (acked or already expired)
+        """
+        with self.cond:
+            entry = self.pending.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def cancel_all(self, keys):
+        """
+        Disarm the timers for many keys at once, e.g. everything covered by a cumulative ack
+        """
+        with self.cond:
+            for key in keys:
+                self.pending.pop(key, None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.perf_counter()
+                    while self.heap:
+                        deadline, _, key = self.heap[0]
+                        entry = self.pending.get(key)
+                        if entry is None or entry[0] != deadline:
+                            heapq.heappop(self.heap) # cancelled or re-armed since, discard stale entry
+                            continue
+                        break
+                    if not self.heap:
+                        self.cond.wait()
+                    elif self.heap[0][0] > now:
+                        self.cond.wait(self.heap[0][0] - now)
+                    else:
+                        deadline, _, key = heapq.heappop(self.heap)
+                        _, item = self.pending.pop(key)
+                        break
+            self.callback(key, item) # called outside the lock so the callback can schedule again
+
+class LoopScheduler:
+    """
+    Same interface as RetransmitScheduler for the asyncio transport (see aio.py): every timer is a call_later handle of the
+    event loop, which keeps its own heap of deadlines, so retransmissions run on the loop thread and need no locking.
+    """
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback # called with (key, item) when a timer expires
+        self.pending = {} # key -> (timer handle, item) of the live timer for that key
+
+    def schedule(self, key, item, timeout):
+        """
+        Arm (or re-arm) the timer for key, item is handed back to the callback on expiry
+        """
+        self.cancel(key)
+        self.pending[key] = (self.loop.call_later(timeout, self.expire, key), item)
+
+    def schedule_all(self, items):
+        for key, item, timeout in items:
+            self.schedule(key, item, timeout)
+
+    def expire(self, key):
+        _, item = self.pending.pop(key)
+        self.callback(key, item)
+
+    def cancel(self, key):
+        self.take(key)
+
+    def take(self, key):
+        """
+        Disarm the timer for key and return its item, None if it is not armed (acked or already expired)
+        """
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return None
+        entry[0].cancel() # the loop drops cancelled handles lazily
+        return entry[1]
+
+    def cancel_all(self, keys):
+        for key in keys:
+            self.take(key)